@@ -0,0 +1,103 @@
+import numpy as np
+
+
+# Colors a whole frame or sequence at a time. Anything shaped (..., 3) of uint8 is RGB,
+# packed colors are uint32 0xRRGGBB (or 0xGGRRBB for the GRB that ws281x wants) and
+# hex colors are "#rrggbb" strings. Packing and the hex text are both done by writing
+# bytes into a buffer and viewing it as another dtype, so nothing loops per pixel.
+
+hex_pairs = [f"{value:02x}" for value in range(256)]
+# the two ascii characters of every byte value, and the value of every hex character
+hex_digits = np.array([list(pair.encode("ascii")) for pair in hex_pairs], dtype=np.uint8)
+hex_code_points = hex_digits.astype("<u4")
+nibble_values = np.full(256, 255, dtype=np.uint8)
+for character in b"0123456789":
+    nibble_values[character] = character - ord("0")
+for character in b"abcdef":
+    nibble_values[character] = character - ord("a") + 10
+    nibble_values[character - 32] = character - ord("a") + 10
+
+# where each channel goes in the little endian bytes of a packed uint32
+rgb_byte_order = [2, 1, 0]  # 0xRRGGBB is stored B, G, R, 0
+grb_byte_order = [2, 0, 1]  # 0xGGRRBB is stored B, R, G, 0
+
+
+def as_bytes(frames) -> np.ndarray:
+    """colors as uint8, anything below 0 or above 255 is clamped rather than wrapped"""
+    frames = np.asarray(frames)
+    if frames.dtype == np.uint8:
+        return frames
+    return np.clip(np.round(frames), 0, 255).astype(np.uint8)
+
+
+def pack(frames: np.ndarray, byte_order: list[int]) -> np.ndarray:
+    frames = as_bytes(frames)
+    packed = np.zeros(frames.shape[:-1] + (4,), dtype=np.uint8)
+    packed[..., :3] = frames[..., byte_order]
+    return packed.view("<u4")[..., 0]
+
+
+def unpack(packed: np.ndarray, byte_order: list[int]) -> np.ndarray:
+    packed = np.asarray(packed, dtype="<u4")
+    flat = np.ascontiguousarray(packed.reshape(-1))
+    packed_bytes = flat.view(np.uint8).reshape(packed.shape + (4,))
+    # byte_order says which byte each channel lands in, so invert it to read back
+    return packed_bytes[..., np.argsort(byte_order)]
+
+
+def pack_rgb(frames: np.ndarray) -> np.ndarray:
+    """(..., 3) RGB uint8 to (...) uint32 0xRRGGBB"""
+    return pack(frames, rgb_byte_order)
+
+
+def pack_grb(frames: np.ndarray) -> np.ndarray:
+    """(..., 3) RGB uint8 to (...) uint32 0xGGRRBB, the order the ws281x strip wants"""
+    return pack(frames, grb_byte_order)
+
+
+def unpack_rgb(packed: np.ndarray) -> np.ndarray:
+    return unpack(packed, rgb_byte_order)
+
+
+def unpack_grb(packed: np.ndarray) -> np.ndarray:
+    return unpack(packed, grb_byte_order)
+
+
+def rgb_to_hex(frames: np.ndarray) -> np.ndarray:
+    """(..., 3) RGB uint8 to a (...) array of "#rrggbb" strings. Other numbers are
+    clamped to 0 to 255 first"""
+    frames = as_bytes(frames)
+    # numpy keeps str arrays as one uint32 code point per character, so the text is
+    # written as code points and viewed as 7 character strings
+    text = np.empty(frames.shape[:-1] + (7,), dtype="<u4")
+    text[..., 0] = ord("#")
+    text[..., 1:].reshape(frames.shape[:-1] + (3, 2))[:] = hex_code_points[frames]
+    return text.view("<U7")[..., 0]
+
+
+def hex_to_rgb(hex_colors) -> np.ndarray:
+    """"#rrggbb" strings (any shape, upper or lower case) to (..., 3) RGB uint8"""
+    text = np.asarray(hex_colors)
+    if text.dtype.kind == "S":
+        text = np.array(text, dtype="S7")
+        characters = text.reshape(-1).view(np.uint8).reshape(text.shape + (7,))
+    else:
+        text = np.array(text, dtype="<U7")
+        characters = text.reshape(-1).view("<u4").reshape(text.shape + (7,))
+        # anything past latin-1 is not a hex digit either
+        characters = np.minimum(characters, 255)
+    if not np.all(characters[..., 0] == ord("#")):
+        raise ValueError("hex colors have to look like #rrggbb")
+    nibbles = nibble_values[characters[..., 1:]]
+    if np.any(nibbles == 255):
+        raise ValueError("hex colors have to look like #rrggbb")
+    return nibbles[..., 0::2] * 16 + nibbles[..., 1::2]
+
+
+def packed_to_hex(packed: np.ndarray) -> np.ndarray:
+    """(...) uint32 0xRRGGBB to "#rrggbb" strings"""
+    return rgb_to_hex(unpack_rgb(packed))
+
+
+def hex_to_packed(hex_colors) -> np.ndarray:
+    return pack_rgb(hex_to_rgb(hex_colors))
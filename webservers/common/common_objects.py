@@ -5,15 +5,33 @@ import functools
 from pathlib import Path
 import pandas as pd
 import logging
+import logging.handlers
+import atexit
+import os
+import queue
 from functools import lru_cache
 import colorlog
 import time
+from collections import deque
+import numpy as np
 
+try:
+    from common import colors
+except ImportError:
+    import colors
 
-def setup_common_logger(logger: logging.Logger) -> logging.Logger:
-    formatter = logging.Formatter(
-        "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-    )
+
+# every module logger hands its records to one queue and a single listener thread does
+# the slow console writes, so a stalled terminal can never hold up the display thread
+log_queue: queue.SimpleQueue = queue.SimpleQueue()
+log_queue_handler = logging.handlers.QueueHandler(log_queue)
+log_listener: logging.handlers.QueueListener | None = None
+
+
+def start_log_listener() -> logging.handlers.QueueListener:
+    global log_listener
+    if log_listener is not None:
+        return log_listener
     color_formatter = colorlog.ColoredFormatter(
         "%(log_color)s%(asctime)s %(name)s - %(levelname)s - %(message)s",
         datefmt="%Y-%m-%d %H:%M:%S",
@@ -27,19 +45,117 @@ def setup_common_logger(logger: logging.Logger) -> logging.Logger:
     )
     console_handler = logging.StreamHandler()
     console_handler.setFormatter(color_formatter)
-    logger.addHandler(console_handler)
+    log_listener = logging.handlers.QueueListener(
+        log_queue, console_handler, respect_handler_level=True
+    )
+    log_listener.start()
+    # stop() writes out whatever is still in the queue
+    atexit.register(log_listener.stop)
+    return log_listener
+
+
+def setup_common_logger(logger: logging.Logger) -> logging.Logger:
+    start_log_listener()
+    # adding the same handler twice is a no-op, so calling this again is harmless
+    logger.addHandler(log_queue_handler)
     logger.setLevel(logging.DEBUG)
     return logger
 
 
+class RateLimitedLog:
+    """For log lines in a loop that runs every frame. ready() is true at most once
+    every interval seconds, and skipped says how many calls were dropped since then"""
+
+    def __init__(self, interval: float = 1.0) -> None:
+        self.interval = interval
+        self.next_time = 0.0
+        self.skipped = 0
+
+    def ready(self) -> bool:
+        now = time.monotonic()
+        if now < self.next_time:
+            self.skipped += 1
+            return False
+        self.next_time = now + self.interval
+        return True
+
+    def take_skipped(self) -> int:
+        skipped = self.skipped
+        self.skipped = 0
+        return skipped
+
+
+class RingBufferHandler(logging.Handler):
+    """Keeps the last capacity records in memory. Records are only formatted when
+    someone asks for them, so capturing a debug line costs an append"""
+
+    def __init__(self, capacity: int = 5000, level: int = logging.NOTSET) -> None:
+        super().__init__(level)
+        self.records: deque[logging.LogRecord] = deque(maxlen=capacity)
+        self.setFormatter(
+            logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+        )
+
+    def handle(self, record: logging.LogRecord) -> bool:
+        # deque.append is atomic, so this skips the handler lock
+        if not self.filter(record):
+            return False
+        self.emit(record)
+        return True
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if record.exc_info:
+            # keeping the traceback would keep every frame in it alive too
+            if not record.exc_text:
+                record.exc_text = self.formatter.formatException(record.exc_info)  # type: ignore
+            record.exc_info = None
+        self.records.append(record)
+
+    def get_records(
+        self,
+        level: int = logging.NOTSET,
+        name: str | None = None,
+        since: float | None = None,
+        limit: int | None = None,
+    ) -> list[str]:
+        """formatted records at or above level, from the logger called name (or its
+        children), created after the since timestamp. limit keeps the newest ones"""
+        selected = []
+        for record in list(self.records):
+            if record.levelno < level:
+                continue
+            if since is not None and record.created <= since:
+                continue
+            if name and record.name != name and not record.name.startswith(name + "."):
+                continue
+            selected.append(record)
+        if limit is not None:
+            selected = selected[-limit:] if limit > 0 else []
+        return [self.format(record) for record in selected]
+
+    def clear(self) -> None:
+        self.records.clear()
+
+
+# decorators run at import time, so this has to come from the environment
+trace_function_calls: bool = os.environ.get("TRACE_FUNCTION_CALLS", "") not in ("", "0")
+
+
 def log_when_functions_start_and_stop(
     func, logger: logging.Logger = logging.getLogger("")
 ):
+    if not trace_function_calls:
+        # hand back the function itself so there is nothing extra to call
+        return func
+    function_logger = logger.getChild(func.__name__)
+
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        logger.getChild(func.__name__).debug(f"Function {func.__name__} started.")
+        if not function_logger.isEnabledFor(logging.DEBUG):
+            return func(*args, **kwargs)
+        function_logger.debug(f"Function {func.__name__} started.")
         result = func(*args, **kwargs)
-        logger.getChild(func.__name__).debug(f"Function {func.__name__} ended.")
+        function_logger.debug(f"Function {func.__name__} ended.")
         return result
 
     return wrapper
@@ -64,14 +180,13 @@ class Color(NamedTuple):
     b: int
 
     def to_hex(self) -> str:
-        # self.enforce_bounds()
-        return f"#{self.r:02x}{self.g:02x}{self.b:02x}"
+        # one color, for whole frames use colors.rgb_to_hex
+        pairs = colors.hex_pairs
+        return f"#{pairs[self.r]}{pairs[self.g]}{pairs[self.b]}"
 
 
 def color_from_hex(hex_string: str) -> Color:
-    return Color(
-        int(hex_string[1:3], 16), int(hex_string[3:5], 16), int(hex_string[5:7], 16)
-    )
+    return Color(*colors.hex_to_rgb(hex_string).tolist())
 
 
 @dataclass
@@ -109,19 +224,28 @@ def all_standard_column_names(num: int) -> list[str]:
     return results
 
 
+def create_filled_dataframe(color: list[int], led_num: int) -> pd.DataFrame:
+    """one frame of every led set to the same [r, g, b] color"""
+    data = list(color) * led_num
+    return pd.DataFrame(
+        [data], index=range(1), columns=all_standard_column_names(led_num), dtype="uint8"
+    )
+
+
 @dataclass
 class Frame:
     id: int
     lights: list[Led]
 
+    def rgb_array(self) -> np.ndarray:
+        """(led_num, 3) uint8 of the colors of the lights"""
+        return np.array([led.color for led in self.lights], dtype=np.uint8).reshape(-1, 3)
+
     def as_array(self) -> list[str]:
-        return list(map(Color.to_hex, [x.color for x in self.lights]))
+        return colors.rgb_to_hex(self.rgb_array()).tolist()
 
     def to_hex_color_dict(self) -> dict[int, str]:
-        results = {}
-        for led in self.lights:
-            results[led.id] = led.color.to_hex()
-        return results
+        return dict(zip([led.id for led in self.lights], self.as_array()))
 
     def create_from_series(
         self, input_series: pd.Series, frame_id: int, hex_colors: bool = True
@@ -130,16 +254,15 @@ class Frame:
         self.lights = []
         self.id = frame_id
 
-        for index, value in input_series.items():
-            hex_color = color_from_hex(value)
-            led = Led(index, hex_color)  # type: ignore
+        rgb = colors.hex_to_rgb(input_series.to_numpy(dtype=str)).tolist()
+        for index, (r, g, b) in zip(input_series.index, rgb):
+            led = Led(index, Color(r, g, b))  # type: ignore
             self.lights.append(led)
 
     def convert_to_df(self) -> pd.DataFrame:
         led_num = len(self.lights)
         columns = create_led_names(led_num)
-        led_colors = [x.color for x in self.lights]
-        data = [x.to_hex() for x in led_colors]
+        data = self.as_array()
 
         df = pd.DataFrame([], columns=columns)
         df.loc[0] = data
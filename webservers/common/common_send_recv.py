@@ -1,7 +1,9 @@
 import logging
 import socket
+from typing import Iterator
 
 from common.common_objects import setup_common_logger
+from common import metrics
 
 
 logger = logging.getLogger("common")
@@ -10,20 +12,37 @@ logger = setup_common_logger(logger)
 verbose: bool = False
 default_chunk_size = 4096
 
+bytes_received = metrics.counter("network_received_bytes_total", "Bytes received")
+bytes_sent = metrics.counter("network_sent_bytes_total", "Bytes sent")
+messages_received = metrics.counter(
+    "network_received_messages_total", "Messages received"
+)
+messages_sent = metrics.counter("network_sent_messages_total", "Messages sent")
+framing_errors = metrics.counter(
+    "network_framing_errors_total",
+    "Messages where the connection closed before the whole message arrived",
+)
 
-def receive_message(client_socket: socket.socket) -> bytes:
+
+def receive_message_length(client_socket: socket.socket) -> int:
     # Assuming the first 8 bytes represent the length of the message
     if verbose:
         logger.getChild("recv").debug(
             f"Getting the first 8 bytes to tell how big things are"
         )
     message_length_bytes = client_socket.recv(8)
+    bytes_received.inc(len(message_length_bytes))
     message_length = int.from_bytes(message_length_bytes, byteorder="big")
 
     if verbose:
         logger.getChild("recv").debug(f"{message_length=}")
+    return message_length
+
 
-    received_data = b""
+def receive_message_chunks(
+    client_socket: socket.socket, message_length: int
+) -> Iterator[bytes]:
+    """the body of a message a chunk at a time, for ones too big to hold all at once"""
     remaining_bytes = message_length
 
     while remaining_bytes > 0:
@@ -36,14 +55,51 @@ def receive_message(client_socket: socket.socket) -> bytes:
             )
         if not chunk:
             # Connection closed prematurely
-            break
-        received_data += chunk
+            framing_errors.inc()
+            return
+        bytes_received.inc(len(chunk))
         remaining_bytes -= len(chunk)
+        yield chunk
     if verbose:
         logger.getChild("recv").debug(f"Finished Receiving")
+
+
+def receive_message(client_socket: socket.socket) -> bytes:
+    message_length = receive_message_length(client_socket)
+    # joined once at the end, adding every chunk onto a bytes copies it all each time
+    received_data = b"".join(receive_message_chunks(client_socket, message_length))
+    if received_data:
+        messages_received.inc()
     return received_data
 
 
+class MessageBuffer:
+    """Puts messages back together from whatever recv() happened to hand over, so a
+    socket can be read without waiting for the rest of a message. Each message is
+    the 8 byte length and then that many bytes"""
+
+    def __init__(self) -> None:
+        self.data = bytearray()
+
+    def feed(self, chunk: bytes) -> list[bytes]:
+        """add what was received, returns every message that is now complete"""
+        bytes_received.inc(len(chunk))
+        self.data += chunk
+        messages = []
+        while len(self.data) >= 8:
+            message_length = int.from_bytes(self.data[:8], byteorder="big")
+            if len(self.data) < 8 + message_length:
+                break
+            messages.append(bytes(self.data[8 : 8 + message_length]))
+            del self.data[: 8 + message_length]
+        messages_received.inc(len(messages))
+        return messages
+
+    def partial(self) -> bool:
+        """part of a message has arrived and the rest has not"""
+        return len(self.data) > 0
+
+
 def send_message(server_socket: socket.socket, message: bytes) -> None:
     # Disable Nagle algorithm
     server_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
@@ -69,3 +125,5 @@ def send_message(server_socket: socket.socket, message: bytes) -> None:
         offset = end_offset
     if verbose:
         logger.getChild("send").debug(f"Finished Sending")
+    bytes_sent.inc(len(message_length_bytes) + message_length)
+    messages_sent.inc()
@@ -2,7 +2,6 @@
 from pathlib import Path
 
 import pandas as pd
-from functools import lru_cache
 
 try:
     from common_objects import (
@@ -11,8 +10,9 @@ try:
         Frame,
         Led_Location,
         Sequence,
-        get_all_info_in_df,
     )
+    from colors import hex_pairs
+    from sequence_validation import SequenceReport, column_pattern, normalize_sequence
 except ImportError:
     import sys, os
 
@@ -23,8 +23,9 @@ except ImportError:
         Frame,
         Led_Location,
         Sequence,
-        get_all_info_in_df,
     )
+    from colors import hex_pairs
+    from sequence_validation import SequenceReport, column_pattern, normalize_sequence
 import logging
 import time
 import numpy as np
@@ -32,30 +33,18 @@ import numpy as np
 logger = logging.getLogger("file_parser")
 
 
-def hex_to_int(hex_color: str):
-    """Convert a hex color string to an integer."""
-    return int(hex_color[1:], 16)
+# single colors, whole frames and sequences go through colors.py
+upper_hex_pairs = [pair.upper() for pair in hex_pairs]
 
 
-def int_to_hex(int_color: int):
-    """Convert an integer color to a hex string."""
-    return f"#{int_color:06X}"
+def clamp_byte(value: int) -> int:
+    return min(max(int(value), 0), 255)
 
 
 def rgb_to_hex(r: int, g: int, b: int) -> str:
-    """Convert RGB values to hex color code."""
-    hex_color = f"#{int(r):02X}{int(g):02X}{int(b):02X}"
-    return hex_color
-
-
-@lru_cache(maxsize=128, typed=False)
-def rgb_to_int(r: int, g: int, b: int) -> int:
-    return int((r << 16) | (g << 8) | b)
-
-
-@lru_cache(maxsize=16777216, typed=False)
-def grb_to_int(g: int, r: int, b: int) -> int:
-    return int((r << 16) | (g << 8) | b)
+    """Convert RGB values to hex color code, each clamped to 0 to 255."""
+    pairs = upper_hex_pairs
+    return f"#{pairs[clamp_byte(r)]}{pairs[clamp_byte(g)]}{pairs[clamp_byte(b)]}"
 
 
 def read_GIFT_file(file_path: Path) -> tuple[list[Led_Location], pd.DataFrame]:
@@ -68,6 +57,12 @@ def read_GIFT_file(file_path: Path) -> tuple[list[Led_Location], pd.DataFrame]:
     return (leds, df)
 
 
+def read_GIFT_array(file_path: Path) -> np.ndarray:
+    """Load a GIFT file as a (led_num, 3) array of x, y, z"""
+    # some of the coordinate files were saved with a byte order mark
+    return np.loadtxt(file_path, delimiter=",", ndmin=2, encoding="utf-8-sig")
+
+
 def save_GIFT_file(lights: list[Led_Location], file_path: Path) -> str:
     # sorted_led_list = lights.sort(key=operator.attrgetter("led_id"))
     file_path.touch(exist_ok=True)
@@ -82,6 +77,53 @@ def create_led_names(led_num: int) -> list[str]:
     return [f"LED_{LED_NUMBER}" for LED_NUMBER in range(led_num)]
 
 
+def read_sequence_dataframe(file_path: Path) -> pd.DataFrame:
+    """Load a sequence CSV straight into a dataframe. The R_#, G_# and B_# columns are
+    clamped to unsigned bytes the same way load_sequence does it and anything else
+    (FRAME_ID) is left as it was, use load_sequence to have everything checked"""
+    start = time.time()
+    results = pd.read_csv(file_path)
+    positions = [
+        position
+        for position, name in enumerate(results.columns)
+        if column_pattern.match(str(name).strip())
+    ]
+    try:
+        colors = results.to_numpy(dtype=np.float64, na_value=0.0)
+    except (TypeError, ValueError):
+        # something in the file is not a number
+        numbers = results.apply(pd.to_numeric, errors="coerce")
+        colors = numbers.to_numpy(dtype=np.float64, na_value=0.0)
+    # clipped as one numpy array by position, DataFrame.clip and picking the columns
+    # out by name are each slower than reading the file
+    colors = np.clip(np.round(colors[:, positions]), 0, 255).astype(np.ubyte)
+    clipped = pd.DataFrame(colors, columns=results.columns[positions])
+    kept = sorted(set(range(results.shape[1])) - set(positions))
+    others = results.iloc[:, kept]
+    results = pd.concat([others, clipped], axis=1)[results.columns]
+    end = time.time()
+    logger.getChild("read_sequence").debug(
+        f"loaded {file_path.name} to a dataframe and it took {end-start:0.3f}s"
+    )
+    return results
+
+
+def load_sequence(
+    file_path: Path, led_num: int | None = None
+) -> tuple[np.ndarray, SequenceReport]:
+    """Load a sequence CSV as a clean (frames, led_num, 3) uint8 array and a report of
+    what had to be fixed to get it there, see normalize_sequence"""
+    frames, report = normalize_sequence(pd.read_csv(file_path), led_num)
+    logger.getChild("load_sequence").debug(f"{file_path.name}: {report.describe()}")
+    return frames, report
+
+
+def read_sequence_frames(file_path: Path, led_num: int | None = None) -> np.ndarray:
+    """Load a sequence CSV as a (frames, led_num, 3) uint8 array. led_num defaults to
+    however many leds the file has"""
+    return load_sequence(file_path, led_num)[0]
+
+
 def read_from_csv(file_path: Path) -> Sequence:
     df = pd.read_csv(file_path)
     # column names are [RGB]_[#]
@@ -105,15 +147,16 @@ def create_frame_from_df_row(row: pd.Series) -> Frame:
         # data_value will be [RGB]_[LED #]
         color_str, led_str = column_name.split("_")
         converted_led_number = int(led_str)
-        converted_color_value = float(row[column_name])
+        converted_color_value = int(row[column_name])
         working_color = led_dict.get(converted_led_number, Color(0, 0, 0))
+        # Color is a NamedTuple, so each channel makes a new one
         match color_str:
             case "R":
-                working_color.r = converted_color_value
+                working_color = working_color._replace(r=converted_color_value)
             case "G":
-                working_color.g = converted_color_value
+                working_color = working_color._replace(g=converted_color_value)
             case "B":
-                working_color.b = converted_color_value
+                working_color = working_color._replace(b=converted_color_value)
             case _:
                 raise ValueError(
                     f"Got a color of {color_str} for led {led_str}, which is not R,G, or B"
@@ -0,0 +1,203 @@
+import bisect
+import threading
+from abc import ABC, abstractmethod
+from typing import Optional
+
+
+default_buckets = (
+    0.0001,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+)
+
+
+def escape_label_value(value: str) -> str:
+    """backslash, double quote and newline escaped, as the text format wants them"""
+    return value.replace("\\", r"\\").replace('"', r'\"').replace("\n", r"\n")
+
+
+def escape_help(help_text: str) -> str:
+    return help_text.replace("\\", r"\\").replace("\n", r"\n")
+
+
+def format_labels(labels: tuple[tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    inside = ",".join(f'{key}="{escape_label_value(value)}"' for key, value in labels)
+    return "{" + inside + "}"
+
+
+class Metric(ABC):
+    kind = "untyped"
+
+    def __init__(
+        self, name: str, help_text: str, labels: tuple[tuple[str, str], ...] = ()
+    ) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.label_values = labels
+        self.children: dict[tuple[tuple[str, str], ...], "Metric"] = {}
+        self.lock = threading.Lock()
+
+    def labels(self, **labels: str) -> "Metric":
+        """the same metric split out by label, made the first time it is asked for"""
+        key = tuple(sorted((k, str(v)) for k, v in labels.items()))
+        child = self.children.get(key)
+        if child is None:
+            with self.lock:
+                child = self.children.get(key)
+                if child is None:
+                    child = self.new_child(key)
+                    self.children[key] = child
+        return child
+
+    def new_child(self, labels: tuple[tuple[str, str], ...]) -> "Metric":
+        return type(self)(self.name, self.help_text, labels)
+
+    @abstractmethod
+    def samples(self, prefix: str = "") -> list[str]:
+        """the lines of this metric, without its children"""
+
+    def render(self, prefix: str = "") -> list[str]:
+        name = prefix + self.name
+        lines = [
+            f"# HELP {name} {escape_help(self.help_text)}",
+            f"# TYPE {name} {self.kind}",
+        ]
+        if not self.children:
+            lines.extend(self.samples(prefix))
+        for child in list(self.children.values()):
+            lines.extend(child.samples(prefix))
+        return lines
+
+
+class Counter(Metric):
+    """only ever goes up. inc() is a single add, no lock"""
+
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+    def samples(self, prefix: str = "") -> list[str]:
+        return [f"{prefix}{self.name}{format_labels(self.label_values)} {self.value}"]
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.value = 0.0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.value -= amount
+
+    def samples(self, prefix: str = "") -> list[str]:
+        return [f"{prefix}{self.name}{format_labels(self.label_values)} {self.value}"]
+
+
+class Histogram(Metric):
+    """counts per bucket are kept un-summed, so observe() is a bisect and two adds"""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labels: tuple[tuple[str, str], ...] = (),
+        buckets: tuple[float, ...] = default_buckets,
+    ) -> None:
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+        # the last one is everything above the largest bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def new_child(self, labels: tuple[tuple[str, str], ...]) -> "Metric":
+        return Histogram(self.name, self.help_text, labels, self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self, prefix: str = "") -> list[str]:
+        name = prefix + self.name
+        lines = []
+        running_total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            running_total += count
+            labels = format_labels(self.label_values + (("le", str(bound)),))
+            lines.append(f"{name}_bucket{labels} {running_total}")
+        running_total += self.counts[-1]
+        labels = format_labels(self.label_values + (("le", "+Inf"),))
+        lines.append(f"{name}_bucket{labels} {running_total}")
+        plain_labels = format_labels(self.label_values)
+        lines.append(f"{name}_sum{plain_labels} {self.sum}")
+        lines.append(f"{name}_count{plain_labels} {running_total}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self.metrics: dict[str, Metric] = {}
+        self.lock = threading.Lock()
+
+    def get_or_create(self, metric_type: type, name: str, help_text: str, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = metric_type(name, help_text, **kwargs)
+                self.metrics[name] = metric
+            elif not isinstance(metric, metric_type):
+                raise TypeError(f"{name} is already a {metric.kind}")
+            return metric
+
+    def render(self, prefix: str = "") -> str:
+        """everything in the Prometheus text format. The prefix goes in front of every
+        name, for when this is served next to another registry with the same metrics"""
+        lines = []
+        with self.lock:
+            metrics = list(self.metrics.values())
+        for metric in metrics:
+            lines.extend(metric.render(prefix))
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+
+def counter(name: str, help_text: str) -> Counter:
+    return registry.get_or_create(Counter, name, help_text)
+
+
+def gauge(name: str, help_text: str) -> Gauge:
+    return registry.get_or_create(Gauge, name, help_text)
+
+
+def histogram(
+    name: str, help_text: str, buckets: Optional[tuple[float, ...]] = None
+) -> Histogram:
+    if buckets is None:
+        buckets = default_buckets
+    return registry.get_or_create(Histogram, name, help_text, buckets=buckets)
@@ -0,0 +1,94 @@
+import io
+import struct
+import zlib
+
+import numpy as np
+
+
+# A sequence as raw frames: a 16 byte header and then frame_count * led_num * 3 RGB
+# bytes, frame after frame. With FLAG_ZLIB everything after the header is one zlib
+# stream, so it can be decompressed as it arrives.
+magic = b"XMSF"
+format_version = 1
+header = struct.Struct(">4sBBHII")  # magic, version, flags, unused, frames, led_num
+FLAG_ZLIB = 1
+
+formats = ("raw", "npy")
+
+
+class SequenceFormatError(ValueError):
+    pass
+
+
+def encode_header(frame_count: int, led_num: int, flags: int = 0) -> bytes:
+    return header.pack(magic, format_version, flags, 0, frame_count, led_num)
+
+
+def decode_header(data: bytes) -> tuple[int, int, int]:
+    """(frame_count, led_num, flags) from the first header.size bytes"""
+    if len(data) < header.size:
+        raise SequenceFormatError(f"needed {header.size} bytes of header, got {len(data)}")
+    found_magic, version, flags, _, frame_count, led_num = header.unpack_from(data)
+    if found_magic != magic:
+        raise SequenceFormatError(f"not a raw sequence, it starts with {found_magic!r}")
+    if version != format_version:
+        raise SequenceFormatError(f"raw sequence version {version} is not supported")
+    return frame_count, led_num, flags
+
+
+def slice_frames(frames: np.ndarray, start: int | None, stop: int | None) -> np.ndarray:
+    """frames[start:stop], with the same meaning for negative and missing ends"""
+    return frames[slice(start, stop)]
+
+
+def encode_frames(frames: np.ndarray, compress: bool = False, level: int = 6) -> bytes:
+    """a (frames, led_num, 3) uint8 array as a raw sequence"""
+    frames = np.ascontiguousarray(frames, dtype=np.uint8)
+    frame_count, led_num = frames.shape[0], frames.shape[1]
+    body = frames.tobytes()
+    flags = 0
+    if compress:
+        body = zlib.compress(body, level)
+        flags |= FLAG_ZLIB
+    return encode_header(frame_count, led_num, flags) + body
+
+
+def decode_frames(data: bytes) -> np.ndarray:
+    frame_count, led_num, flags = decode_header(data)
+    body = data[header.size :]
+    expected = frame_count * led_num * 3
+    if flags & FLAG_ZLIB:
+        # inflated no further than the header says it should, one byte past that is
+        # enough to know it is wrong without a small message growing without limit
+        decompressor = zlib.decompressobj()
+        try:
+            body = decompressor.decompress(body, expected + 1)
+        except zlib.error as e:
+            raise SequenceFormatError(f"the frames could not be decompressed, {e}")
+        if len(body) > expected or decompressor.unconsumed_tail:
+            raise SequenceFormatError(
+                f"the frames inflate to more than the {expected} bytes they should"
+            )
+    if len(body) != expected:
+        raise SequenceFormatError(f"needed {expected} bytes of frames, got {len(body)}")
+    return np.frombuffer(body, dtype=np.uint8).reshape(frame_count, led_num, 3)
+
+
+def encode_npy(frames: np.ndarray, compress: bool = False, level: int = 6) -> bytes:
+    """the frames as a .npy file, or a zlib compressed one"""
+    buffer = io.BytesIO()
+    np.save(buffer, np.ascontiguousarray(frames, dtype=np.uint8), allow_pickle=False)
+    data = buffer.getvalue()
+    if compress:
+        data = zlib.compress(data, level)
+    return data
+
+
+def encode(
+    frames: np.ndarray, file_format: str = "raw", compress: bool = False
+) -> bytes:
+    if file_format == "npy":
+        return encode_npy(frames, compress)
+    if file_format == "raw":
+        return encode_frames(frames, compress)
+    raise SequenceFormatError(f"{file_format} is not one of {formats}")
@@ -0,0 +1,249 @@
+import codecs
+import zlib
+from abc import ABC, abstractmethod
+from typing import Iterator
+
+import numpy as np
+
+from common import sequence_binary
+from common.sequence_binary import SequenceFormatError
+from common.sequence_validation import (
+    SequenceReport,
+    channels,
+    clean_values,
+    column_pattern,
+)
+
+
+class SequenceStreamDecoder(ABC):
+    """Turns a sequence that arrives a piece at a time into batches of (frames,
+    led_num, 3) uint8 frames, checking it as it goes. Only one batch is ever held, so
+    it takes the same memory however long the sequence is. Values are fixed the same
+    way normalize_sequence does it and counted in report.
+
+    A batch is reused once it has been handed out, so use it up (encode or copy it)
+    before asking for the next one."""
+
+    def __init__(self, batch_frames: int = 32) -> None:
+        self.batch_frames = max(batch_frames, 1)
+        self.led_num: int | None = None
+        self.frame_count = 0
+        self.batch = np.zeros((0, 0, 3), dtype=np.uint8)
+        self.batch_used = 0
+        self.report = SequenceReport()
+
+    @abstractmethod
+    def feed(self, data: bytes) -> Iterator[np.ndarray]:
+        """every batch the new bytes fill up"""
+
+    @abstractmethod
+    def finish(self) -> Iterator[np.ndarray]:
+        """the last batch, raises SequenceFormatError if the sequence stopped part way"""
+
+    def start_batches(self, led_num: int) -> None:
+        if led_num <= 0:
+            raise SequenceFormatError("the sequence has no leds in it")
+        self.led_num = led_num
+        self.report.led_num = self.report.source_leds = led_num
+        self.batch = np.zeros((self.batch_frames, led_num, 3), dtype=np.uint8)
+
+    def add_frames(self, flat: np.ndarray) -> Iterator[np.ndarray]:
+        """copy in (frames, led_num * 3) values, handing out each batch that fills up"""
+        batch_flat = self.batch.reshape(self.batch_frames, -1)
+        while len(flat):
+            taken = flat[: self.batch_frames - self.batch_used]
+            batch_flat[self.batch_used : self.batch_used + len(taken)] = taken
+            self.batch_used += len(taken)
+            self.frame_count += len(taken)
+            self.report.frames = self.frame_count
+            flat = flat[len(taken) :]
+            if self.batch_used == self.batch_frames:
+                yield from self.flush()
+
+    def flush(self) -> Iterator[np.ndarray]:
+        if self.batch_used:
+            used = self.batch_used
+            self.batch_used = 0
+            yield self.batch[:used]
+
+
+class CsvStreamDecoder(SequenceStreamDecoder):
+    """A sequence CSV with a header of R_0,G_0,B_0,... columns and one frame per line.
+    Other columns such as FRAME_ID are skipped, leds without a column are black and
+    values that are blank, not numbers or out of range are fixed, the same as loading
+    the whole file does"""
+
+    def __init__(self, batch_frames: int = 32) -> None:
+        super().__init__(batch_frames)
+        self.text = codecs.getincrementaldecoder("utf-8-sig")()
+        self.pending = ""
+        self.line_number = 0
+        self.field_count = 0
+        # which fields of a line are colors, and where each goes in the frame
+        self.value_fields: list[int] = []
+        self.targets = np.zeros(0, dtype=np.intp)
+        self.row = np.zeros((1, 0), dtype=np.uint8)
+
+    def feed(self, data: bytes) -> Iterator[np.ndarray]:
+        try:
+            self.pending += self.text.decode(data)
+        except UnicodeDecodeError as e:
+            raise SequenceFormatError(f"the CSV is not utf-8 text, {e}") from e
+        lines = self.pending.split("\n")
+        self.pending = lines.pop()
+        for line in lines:
+            yield from self.add_line(line)
+
+    def finish(self) -> Iterator[np.ndarray]:
+        self.pending += self.text.decode(b"", final=True)
+        if self.pending:
+            yield from self.add_line(self.pending)
+            self.pending = ""
+        if self.led_num is None:
+            raise SequenceFormatError("the CSV had no header line")
+        yield from self.flush()
+
+    def read_header(self, fields: list[str]) -> None:
+        value_fields = []
+        targets = []
+        for index, name in enumerate(fields):
+            match = column_pattern.match(name.strip())
+            if match is None:
+                self.report.dropped_columns.append(name.strip())
+                continue
+            target = int(match[2]) * 3 + channels.index(match[1])
+            if target in targets:
+                # the first one is used, like normalize_sequence
+                self.report.duplicate_columns.append(name.strip())
+                continue
+            value_fields.append(index)
+            targets.append(target)
+        if not targets:
+            raise SequenceFormatError(
+                f"the CSV header has no R_#, G_# or B_# columns, it starts {fields[:4]}"
+            )
+        self.field_count = len(fields)
+        self.value_fields = value_fields
+        self.targets = np.array(targets, dtype=np.intp)
+        self.start_batches(int(self.targets.max()) // 3 + 1)
+        self.report.missing_channels = self.batch.shape[1] * 3 - len(targets)
+        self.row = np.zeros((1, self.batch.shape[1] * 3), dtype=np.uint8)
+
+    def add_line(self, line: str) -> Iterator[np.ndarray]:
+        self.line_number += 1
+        line = line.strip()
+        if not line:
+            return
+        fields = line.split(",")
+        if self.led_num is None:
+            self.read_header(fields)
+            return
+        if len(fields) != self.field_count:
+            raise SequenceFormatError(
+                f"line {self.line_number} has {len(fields)} values, the header has {self.field_count}"
+            )
+        values = [fields[i] for i in self.value_fields]
+        try:
+            numbers = np.array(values, dtype=np.float64)
+        except ValueError:
+            numbers = np.array([as_number(value) for value in values])
+        self.row[0, self.targets] = clean_values(numbers, self.report)
+        yield from self.add_frames(self.row)
+
+
+class RawStreamDecoder(SequenceStreamDecoder):
+    """raw frames as written by sequence_binary.encode_frames, compressed or not"""
+
+    def __init__(self, batch_frames: int = 32) -> None:
+        super().__init__(batch_frames)
+        self.header = b""
+        self.expected_frames = 0
+        self.decompressor = None
+        self.partial = bytearray()
+
+    def feed(self, data: bytes) -> Iterator[np.ndarray]:
+        if self.led_num is None:
+            self.header += data
+            if len(self.header) < sequence_binary.header.size:
+                return
+            frame_count, led_num, flags = sequence_binary.decode_header(self.header)
+            data = self.header[sequence_binary.header.size :]
+            self.header = b""
+            self.expected_frames = frame_count
+            self.start_batches(led_num)
+            if flags & sequence_binary.FLAG_ZLIB:
+                self.decompressor = zlib.decompressobj()
+        if self.decompressor is not None:
+            yield from self.decompress(data)
+        else:
+            yield from self.add_bytes(data)
+
+    def decompress(self, data: bytes) -> Iterator[np.ndarray]:
+        """a batch worth of bytes at most is inflated at a time, so a message that
+        inflates to far more than the frames it claims is stopped by add_checked
+        before it is all in memory"""
+        while data:
+            try:
+                inflated = self.decompressor.decompress(data, self.batch.nbytes)
+            except zlib.error as e:
+                raise SequenceFormatError(f"the frames could not be decompressed, {e}")
+            data = self.decompressor.unconsumed_tail
+            yield from self.add_bytes(inflated)
+
+    def add_bytes(self, data: bytes) -> Iterator[np.ndarray]:
+        frame_size = self.batch.shape[1] * 3
+        if self.partial:
+            taken = frame_size - len(self.partial)
+            self.partial += data[:taken]
+            data = data[taken:]
+            if len(self.partial) < frame_size:
+                return
+            yield from self.add_checked(np.frombuffer(bytes(self.partial), np.uint8))
+            self.partial.clear()
+        whole = len(data) // frame_size * frame_size
+        if whole:
+            values = np.frombuffer(data, dtype=np.uint8, count=whole)
+            yield from self.add_checked(values)
+        self.partial += data[whole:]
+
+    def add_checked(self, values: np.ndarray) -> Iterator[np.ndarray]:
+        flat = values.reshape(-1, self.batch.shape[1] * 3)
+        if self.frame_count + len(flat) > self.expected_frames:
+            raise SequenceFormatError(
+                f"the header said there were {self.expected_frames} frames, there are more"
+            )
+        yield from self.add_frames(flat)
+
+    def finish(self) -> Iterator[np.ndarray]:
+        if self.led_num is None:
+            # raises for a header that is cut short
+            sequence_binary.decode_header(self.header)
+        if self.decompressor is not None:
+            if not self.decompressor.eof:
+                raise SequenceFormatError("the compressed frames stopped part way")
+            yield from self.add_bytes(self.decompressor.flush())
+        if self.partial:
+            raise SequenceFormatError("the sequence stopped part way through a frame")
+        if self.frame_count != self.expected_frames:
+            raise SequenceFormatError(
+                f"the header said there were {self.expected_frames} frames, got {self.frame_count}"
+            )
+        yield from self.flush()
+
+
+def as_number(value: str) -> float:
+    """nan for a value that is blank or not a number, like pd.to_numeric(errors=
+    "coerce") makes it when loading the whole file"""
+    try:
+        return float(value)
+    except ValueError:
+        return np.nan
+
+
+decoders = {"csv": CsvStreamDecoder, "raw": RawStreamDecoder}
+
+
+def create_decoder(file_format: str, batch_frames: int = 32) -> SequenceStreamDecoder:
+    if file_format not in decoders:
+        raise SequenceFormatError(f"{file_format} is not one of {tuple(decoders)}")
+    return decoders[file_format](batch_frames)
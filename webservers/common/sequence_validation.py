@@ -0,0 +1,134 @@
+import re
+import time
+from dataclasses import asdict, dataclass, field
+
+import numpy as np
+import pandas as pd
+
+
+column_pattern = re.compile(r"^([RGB])_(\d+)$")
+channels = "RGB"
+
+
+@dataclass
+class SequenceReport:
+    """what normalize_sequence had to change to make a sequence playable"""
+
+    frames: int = 0
+    led_num: int = 0
+    source_leds: int = 0  # leds in the sequence as it came in
+    dropped_columns: list[str] = field(default_factory=list)  # FRAME_ID and the like
+    duplicate_columns: list[str] = field(default_factory=list)
+    missing_channels: int = 0  # channels with no column, they are left black
+    truncated_leds: int = 0  # leds past led_num that were cut off
+    blank_values: int = 0  # empty or not numbers, made 0
+    rounded_values: int = 0
+    clamped_values: int = 0  # below 0 or above 255
+    errors: list[str] = field(default_factory=list)  # why it can not be played at all
+    seconds: float = 0.0
+
+    def changed_values(self) -> int:
+        return self.blank_values + self.rounded_values + self.clamped_values
+
+    def is_playable(self) -> bool:
+        return not self.errors
+
+    def is_clean(self) -> bool:
+        """nothing was changed apart from dropping extra columns"""
+        return (
+            self.is_playable()
+            and self.changed_values() == 0
+            and not self.duplicate_columns
+            and self.missing_channels == 0
+            and self.truncated_leds == 0
+        )
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    def describe(self) -> str:
+        parts = [f"{self.frames} frames of {self.source_leds} leds"]
+        if self.errors:
+            parts.append(f"can not be played, {'; '.join(self.errors)}")
+        if self.dropped_columns:
+            parts.append(f"dropped {self.dropped_columns}")
+        if self.duplicate_columns:
+            parts.append(f"ignored duplicates {self.duplicate_columns}")
+        if self.missing_channels:
+            parts.append(f"{self.missing_channels} channels missing")
+        if self.truncated_leds:
+            parts.append(f"{self.truncated_leds} leds cut off")
+        if self.blank_values:
+            parts.append(f"{self.blank_values} blank values")
+        if self.rounded_values:
+            parts.append(f"{self.rounded_values} values rounded")
+        if self.clamped_values:
+            parts.append(f"{self.clamped_values} values clamped")
+        return ", ".join(parts) + f" in {self.seconds:0.3f}s"
+
+
+def clean_values(values: np.ndarray, report: SequenceReport) -> np.ndarray:
+    """Blank (nan) values made 0, then everything rounded and clamped to 0 to 255
+    rather than wrapped. What was changed is added to report's counts, so a sequence
+    can be cleaned a piece at a time"""
+    blank = np.isnan(values)
+    report.blank_values += int(blank.sum())
+    values = np.where(blank, 0.0, values)
+    rounded = np.round(values)
+    report.rounded_values += int(np.count_nonzero(rounded != values))
+    report.clamped_values += int(np.count_nonzero((rounded < 0) | (rounded > 255)))
+    return np.clip(rounded, 0, 255, out=rounded)
+
+
+def normalize_sequence(
+    dataframe: pd.DataFrame, led_num: int | None = None
+) -> tuple[np.ndarray, SequenceReport]:
+    """Turn a sequence dataframe into a contiguous (frames, led_num, 3) uint8 array
+    once, so nothing after has to check it again. Columns are matched by name
+    (R_#, G_#, B_#) in any order, anything else is dropped, missing leds are black,
+    leds past led_num are cut off and values are rounded and clamped to 0 to 255
+    rather than wrapped. led_num defaults to however many leds the sequence has.
+    A sequence with no frames or no leds comes back with report.errors, since there is
+    nothing in it to play"""
+    start = time.perf_counter()
+    report = SequenceReport(frames=len(dataframe))
+    positions = []
+    targets = []
+    seen = set()
+    for position, name in enumerate(dataframe.columns):
+        match = column_pattern.match(str(name).strip())
+        if match is None:
+            report.dropped_columns.append(str(name))
+            continue
+        target = int(match[2]) * 3 + channels.index(match[1])
+        if target in seen:
+            report.duplicate_columns.append(str(name))
+            continue
+        seen.add(target)
+        positions.append(position)
+        targets.append(target)
+    report.source_leds = max(targets) // 3 + 1 if targets else 0
+    if led_num is None:
+        led_num = report.source_leds
+    report.led_num = led_num
+    report.truncated_leds = max(report.source_leds - led_num, 0)
+    if len(dataframe) == 0:
+        report.errors.append("there are no frames")
+    if not targets:
+        report.errors.append("there are no R_#, G_# or B_# columns")
+    if led_num <= 0:
+        report.errors.append(f"{led_num=}")
+
+    columns = dataframe.iloc[:, positions]
+    if not all(pd.api.types.is_numeric_dtype(dtype) for dtype in columns.dtypes):
+        columns = columns.apply(pd.to_numeric, errors="coerce")
+    values = columns.to_numpy(dtype=np.float64, na_value=np.nan)
+    rounded = clean_values(values, report)
+
+    target_array = np.array(targets, dtype=np.intp)
+    kept = target_array < led_num * 3
+    frames = np.zeros((len(dataframe), led_num * 3), dtype=np.uint8)
+    frames[:, target_array[kept]] = rounded[:, kept]
+    report.missing_channels = led_num * 3 - int(np.count_nonzero(kept))
+    report.seconds = time.perf_counter() - start
+    return frames.reshape(len(dataframe), led_num, 3), report
@@ -0,0 +1,308 @@
+"""Drives several pis as one display. Each controller owns a run of the leds in one
+global led space, commands go to all of them at once and a sequence is cut up so each
+one gets only its own leds. Beacons keep them on the same frame (see
+rpi/cluster_sync.py) and report how far each one is from where it should be.
+
+    python cluster.py controllers.json sequence.csv --fps 20
+
+where controllers.json is a list of
+    {"name": "tree_1", "host": "192.168.4.205", "port": 12345,
+     "led_start": 0, "led_count": 500}
+"""
+import argparse
+import json
+import logging
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+import numpy as np
+
+import os
+import sys
+
+# Add the root directory to the Python path
+current_directory = os.path.dirname(os.path.abspath(__file__))
+webservers_directory = os.path.abspath(os.path.join(current_directory, ".."))
+sys.path.append(webservers_directory)
+
+from common.common_send_recv import send_message, receive_message
+from common.common_objects import setup_common_logger
+from common import metrics
+from common import sequence_binary
+from common.file_parser import read_sequence_frames
+
+logger = logging.getLogger("cluster")
+logger = setup_common_logger(logger)
+
+upload_batch_frames = 32  # frames sent to a pi in each message of an upload
+
+beacon_seconds = metrics.histogram(
+    "cluster_beacon_round_trip_seconds", "Time for a pi to answer a sync beacon"
+)
+cluster_skew = metrics.gauge(
+    "cluster_skew_frames", "Frames between the furthest ahead and behind controllers"
+)
+
+
+@dataclass
+class Controller:
+    """one pi and the leds it drives, led_start to led_start + led_count of the
+    global led space. The rest is what the last beacon found out about it"""
+
+    name: str
+    host: str
+    port: int = 12345
+    led_start: int = 0
+    led_count: int = 500
+    reachable: bool = False
+    round_trip: Optional[float] = None
+    clock_error: Optional[float] = None  # its idea of the coordinator clock, minus ours
+    skew_frames: Optional[float] = None  # frames ahead of where it should be
+
+    def connect(self, timeout: float) -> socket.socket:
+        return socket.create_connection((self.host, self.port), timeout=timeout)
+
+    def send(self, message: dict, timeout: float, reply: bool = False) -> Any:
+        """send one command, and wait for what it sends back if it sends something"""
+        with self.connect(timeout) as connection:
+            send_message(connection, json.dumps(message).encode("utf-8"))
+            if reply:
+                return json.loads(receive_message(connection).decode("utf-8"))
+        return None
+
+    def upload(
+        self, frames: np.ndarray, timeout: float, compress: bool = False
+    ) -> dict:
+        """stream (frames, led_count, 3) frames to it, they play once they are all
+        there so every controller starts with the whole sequence"""
+        with self.connect(timeout) as connection:
+            begin = {
+                "command": "stream_begin",
+                "args": {"start_frames": len(frames), "crossfade": 0},
+            }
+            send_message(connection, json.dumps(begin).encode("utf-8"))
+            for start in range(0, len(frames), upload_batch_frames):
+                batch = frames[start : start + upload_batch_frames]
+                send_message(connection, sequence_binary.encode_frames(batch, compress))
+            end = {"command": "stream_end", "args": {"ok": True}}
+            send_message(connection, json.dumps(end).encode("utf-8"))
+            return json.loads(receive_message(connection).decode("utf-8"))
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "host": self.host,
+            "port": self.port,
+            "led_start": self.led_start,
+            "led_count": self.led_count,
+            "reachable": self.reachable,
+            "round_trip": self.round_trip,
+            "clock_error": self.clock_error,
+            "skew_frames": self.skew_frames,
+        }
+
+
+class Cluster:
+    """The registry of controllers and the clock they all follow. Everything sent to
+    them goes to each one from its own thread, so one slow or missing pi holds up
+    nothing but itself"""
+
+    def __init__(self, controllers: list[Controller], timeout: float = 2.0) -> None:
+        self.controllers: dict[str, Controller] = {}
+        self.lock = threading.Lock()
+        self.timeout = timeout
+        self.epoch: Optional[float] = None
+        self.fps = 0.0
+        self.frame_count = 0
+        self.executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="cluster")
+        for controller in controllers:
+            self.add(controller)
+
+    @classmethod
+    def from_file(cls, path: Path, timeout: float = 2.0) -> "Cluster":
+        controllers = [Controller(**entry) for entry in json.loads(path.read_text())]
+        return cls(controllers, timeout)
+
+    def add(self, controller: Controller) -> None:
+        with self.lock:
+            end = controller.led_start + controller.led_count
+            for other in self.controllers.values():
+                if other.name == controller.name:
+                    continue
+                if controller.led_start < other.led_start + other.led_count and (
+                    other.led_start < end
+                ):
+                    raise ValueError(f"{controller.name} overlaps {other.name}")
+            self.controllers[controller.name] = controller
+
+    def remove(self, name: str) -> None:
+        with self.lock:
+            self.controllers.pop(name, None)
+
+    @property
+    def led_num(self) -> int:
+        """how big the global led space is"""
+        return max(
+            (c.led_start + c.led_count for c in self.controllers.values()), default=0
+        )
+
+    def fan_out(self, action: Callable[[Controller], Any]) -> dict[str, Any]:
+        """run action for every controller at once. A controller that failed has the
+        exception instead of a result"""
+        with self.lock:
+            controllers = list(self.controllers.values())
+        futures = {c.name: self.executor.submit(action, c) for c in controllers}
+        results = {}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                logger.getChild("fan_out").warning(f"{name} failed, {e}")
+                results[name] = e
+        return results
+
+    def broadcast(self, command: str, args: Any = "") -> dict[str, Any]:
+        """the same command to every controller, like fps or brightness"""
+        message = {"command": command, "args": args}
+        return self.fan_out(lambda c: c.send(message, self.timeout))
+
+    def play(self, frames: np.ndarray, fps: float, lead: float = 0.5) -> dict[str, Any]:
+        """Upload each controller its slice of (frames, led_num, 3) frames in the global
+        led space, then start them all on frame 0 lead seconds after the last upload
+        finished. If any controller did not get the whole sequence none of them are
+        started together, a RuntimeError says which ones failed"""
+        if frames.shape[1] < self.led_num:
+            raise ValueError(f"{frames.shape[1]} leds do not cover all {self.led_num}")
+
+        def upload(controller: Controller) -> dict:
+            end = controller.led_start + controller.led_count
+            leds = np.ascontiguousarray(frames[:, controller.led_start : end])
+            return controller.upload(leds, self.timeout)
+
+        results = self.fan_out(upload)
+        failed = {
+            name: result
+            for name, result in results.items()
+            if isinstance(result, Exception)
+            or not isinstance(result, dict)
+            or result.get("frames") != len(frames)
+        }
+        if failed:
+            reasons = ", ".join(f"{name} ({result})" for name, result in failed.items())
+            raise RuntimeError(
+                f"not started, the sequence did not get to {reasons}. The others play "
+                "it on their own"
+            )
+        self.epoch = time.time() + lead
+        self.fps = float(fps)
+        self.frame_count = len(frames)
+        self.beacon()
+        logger.getChild("play").info(
+            f"{len(frames)} frames on {len(results)} controllers from {self.epoch:.3f}"
+        )
+        return results
+
+    def leave(self) -> None:
+        """let every controller play on its own again"""
+        self.epoch = None
+        self.beacon()
+
+    def beacon(self) -> dict:
+        """Send every controller the time, the epoch and the fps, and work out the skew
+        from what they send back. Half way between sending and the answer coming back
+        is when the controller read its clock, so the difference from that is its
+        clock error, give or take half the round trip"""
+        beacon_args = {"epoch": self.epoch, "fps": self.fps}
+        self.fan_out(lambda c: self.beacon_one(c, beacon_args))
+        return self.report()
+
+    def beacon_one(self, controller: Controller, beacon_args: dict) -> None:
+        """A controller that does not answer, or answers with something that is not a
+        beacon reply, counts as unreachable"""
+        sent = time.time()
+        message = {"command": "cluster_sync", "args": {"time": sent, **beacon_args}}
+        try:
+            reply = controller.send(message, self.timeout, reply=True)
+            answered = time.time()
+            clock = float(reply["clock"])
+            frame = None if reply["frame"] is None else float(reply["frame"])
+            frame_count = int(reply.get("frames") or self.frame_count)
+        except Exception as e:
+            controller.reachable = False
+            controller.round_trip = controller.clock_error = None
+            controller.skew_frames = None
+            logger.getChild("beacon").warning(
+                f"{controller.name} gave no beacon reply, {type(e).__name__}: {e}"
+            )
+            return
+        middle = (sent + answered) / 2
+        controller.reachable = True
+        controller.round_trip = answered - sent
+        controller.clock_error = clock - middle
+        beacon_seconds.observe(controller.round_trip)
+        controller.skew_frames = None
+        if self.epoch is not None and frame is not None:
+            expected = (middle - self.epoch) * self.fps
+            skew = frame - expected
+            if frame_count:
+                # the sequence loops, so the shortest way round
+                skew = (skew + frame_count / 2) % frame_count - frame_count / 2
+            controller.skew_frames = skew
+
+    def report(self) -> dict:
+        """every controller as the last beacon found it, and the spread between the
+        furthest ahead and furthest behind"""
+        with self.lock:
+            controllers = [c.to_dict() for c in self.controllers.values()]
+        skews = [c["skew_frames"] for c in controllers if c["skew_frames"] is not None]
+        spread = max(skews) - min(skews) if skews else None
+        if spread is not None:
+            cluster_skew.set(spread)
+        return {
+            "epoch": self.epoch,
+            "fps": self.fps,
+            "skew_frames": spread,
+            "controllers": controllers,
+        }
+
+    def run_beacons(self, stop_event: threading.Event, interval: float = 1.0) -> None:
+        """beacon every interval seconds until stop_event is set"""
+        local_logger = logger.getChild("beacons")
+        while not stop_event.wait(interval):
+            report = self.beacon()
+            if report["skew_frames"] is not None:
+                local_logger.debug(f"skew is {report['skew_frames']:.2f} frames")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("controllers", type=Path, help="json list of the controllers")
+    parser.add_argument("sequence", type=Path, help="a sequence of the global leds")
+    parser.add_argument("--fps", type=float, default=20.0)
+    parser.add_argument("--interval", type=float, default=1.0, help="between beacons")
+    args = parser.parse_args()
+
+    cluster = Cluster.from_file(args.controllers)
+    frames = read_sequence_frames(args.sequence, cluster.led_num)
+    cluster.broadcast("playback", {"timed": True, "speed": 1.0})
+    cluster.play(frames, args.fps)
+    try:
+        while True:
+            time.sleep(args.interval)
+            report = cluster.beacon()
+            for controller in report["controllers"]:
+                logger.info(
+                    f"{controller['name']}: skew {controller['skew_frames']} frames, "
+                    f"round trip {controller['round_trip']}"
+                )
+    except KeyboardInterrupt:
+        cluster.leave()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,18 @@
 from datetime import datetime
 from pathlib import Path
-from dash import Dash, dcc, html, Input, Output
-from numpy import size
-import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
-import common_objects as co
+from dash import Dash, Patch, dcc, html, Input, Output, State, no_update
+from dash.exceptions import PreventUpdate
+from flask import abort, jsonify, request
 
-# import file_parser as fp
+import os
+import sys
+
+# Add the root directory to the Python path
+current_directory = os.path.dirname(os.path.abspath(__file__))
+webservers_directory = os.path.abspath(os.path.join(current_directory, ".."))
+sys.path.append(webservers_directory)
+
+from preview_cache import PreviewCache
 
 
 app = Dash(__name__)
@@ -16,207 +21,137 @@ coordinate_file_path = Path(
     r"C:\Users\joell\OneDrive\Documents\GitHub\xmastree2023\fixed_coords_2021.gift"
 )
 
-test_sequence_path = Path(
-    r"C:\Users\joell\OneDrive\Documents\GitHub\xmastree2023\examples\rainbow_sine.csv"
+sequence_folder = Path(r"C:\Users\joell\OneDrive\Documents\GitHub\xmastree2023\examples")
+test_sequence_path = sequence_folder / "rainbow_sine.csv"
+
+sequence_paths = sorted(sequence_folder.glob("*.csv"))
+sequences_by_name = {path.name: path for path in sequence_paths}
+
+# what the browser is sent up front, the play head fetches single full frames. The
+# dashboard places every led so those frames fit, preview_points is for /figure
+preview_frames = 120
+preview_points = 250
+keyframe_threshold = 0.0  # above 0 only frames that change by more than it are kept
+window_frames_limit = 240
+frame_duration_ms = 50
+
+# every sequence is loaded in the background straight away, so picking one is quick
+preview_cache = PreviewCache(max_entries=max(len(sequence_paths), 8))
+preview_cache.warm(
+    [test_sequence_path] + [path for path in sequence_paths if path != test_sequence_path],
+    coordinate_file_path,
 )
-led_sequence = fp.read_from_csv(test_sequence_path)
-
-sequence_df = led_sequence.convert_to_df(include_led_column=False)
-
-
-# get all the locations
-led_locations, df = fp.read_GIFT_file(coordinate_file_path)
 
-xdata, ydata, zdata = co.get_xyz_from_locations(led_locations)
-
-all_info_melted = co.all_info_for_plotting(led_locations, led_sequence)
-all_info = co.get_all_info_in_df(led_locations, led_sequence)
+print(f"reloaded data at {datetime.now()}")
 
 
-# df = px.data.gapminder()
-# print(sequence_df.melt(id_vars=["led_id"], var_name="frame_id", value_name="led_color"))
+def preview_for(name: str):
+    if name not in sequences_by_name:
+        abort(404)
+    return preview_cache.get(sequences_by_name[name], coordinate_file_path)
 
-# print(sequence_df)
 
-print(f"reloaded data at {datetime.now()}")
+def callback_preview_for(name: str):
+    """abort only works in a flask route, a callback leaves the graph as it is"""
+    if name not in sequences_by_name:
+        raise PreventUpdate
+    return preview_for(name)
 
 
-frames = []
-for frame in sequence_df.T.itertuples(index=False):
-    # print(frame)
-    local_color = list(frame)
-    frames.append(
-        go.Frame(
-            data=go.Scatter3d(
-                x=xdata,
-                y=ydata,
-                z=zdata,
-                mode="markers",
-                marker=dict(color=local_color),
-            )
-        )
+@app.server.route("/preview/<name>/figure")
+def preview_figure(name: str):
+    """the figure with at most max_frames frames and max_points leds"""
+    preview = preview_for(name)
+    figure = preview.figure(
+        request.args.get("max_frames", preview_frames, type=int),
+        request.args.get("max_points", preview_points, type=int),
+        request.args.get("threshold", keyframe_threshold, type=float),
+        frame_duration_ms,
     )
-
-# print(frames)
-
-manual_ani_fig = go.Figure(
-    data=[go.Scatter3d(x=xdata, y=ydata, z=zdata, mode="markers")],
-    frames=frames,
-    layout=go.Layout(
-        title="Start Title",
-        updatemenus=[
-            dict(
-                type="buttons",
-                buttons=[
-                    dict(
-                        label="Play",
-                        method="animate",
-                        args=[
-                            None,
-                            {
-                                "frame": {
-                                    "duration": 50,
-                                    "redraw": True,
-                                },
-                                "transition": {
-                                    "duration": 30,
-                                    "easing": "cubic-in-out",
-                                },
-                            },
-                        ],
-                    ),
-                    dict(
-                        label="Pause",
-                        method="animate",
-                        args=[
-                            [None],
-                            {
-                                "frame": {
-                                    "duration": 0,
-                                    "redraw": True,
-                                },
-                                "transition": {
-                                    "duration": 0,
-                                    "easing": "cubic-in-out",
-                                },
-                            },
-                        ],
-                    ),
-                ],
-            )
-        ],
-    ),
-)
-# all_slider_steps = []
-# for index, row in sequence_df.T.iterrows():
-#     slider_step = {
-#         "args": [
-#             [index],
-#             {
-#                 "frame": {"duration": 300, "redraw": True},
-#                 "mode": "immediate",
-#                 "transition": {"duration": 300},
-#             },
-#         ],
-#         "label": f"{index}",
-#         "method": "animate",
-#     }
-#     all_slider_steps.append(slider_step)
-
-# sliders_dict = {
-#     "active": 0,
-#     "yanchor": "top",
-#     "xanchor": "left",
-#     "currentvalue": {
-#         "font": {"size": 20},
-#         "prefix": "Frame:",
-#         "visible": True,
-#         "xanchor": "right",
-#     },
-#     "transition": {"duration": 300, "easing": "cubic-in-out"},
-#     "pad": {"b": 10, "t": 50},
-#     "len": 0.9,
-#     "x": 0.1,
-#     "y": 0,
-#     "steps": all_slider_steps,
-# }
-
-# manual_ani_fig.update_layout(
-#     {
-#         "updatemenus": [
-#             {
-#                 "buttons": [
-#                     {
-#                         "args": [
-#                             None,
-#                             {
-#                                 "frame": {"duration": 100, "redraw": True},
-#                                 "fromcurrent": True,
-#                                 "transition": {
-#                                     "duration": 100,
-#                                     "easing": "quadratic-in-out",
-#                                 },
-#                             },
-#                         ],
-#                         "label": "Play",
-#                         "method": "animate",
-#                     },
-#                     {
-#                         "args": [
-#                             [None],
-#                             {
-#                                 "frame": {"duration": 0, "redraw": True},
-#                                 "mode": "immediate",
-#                                 "transition": {"duration": 0},
-#                             },
-#                         ],
-#                         "label": "Pause",
-#                         "method": "animate",
-#                     },
-#                 ],
-#                 "direction": "left",
-#                 "pad": {"r": 10, "t": 87},
-#                 "showactive": False,
-#                 "type": "buttons",
-#                 "x": 0.1,
-#                 "xanchor": "right",
-#                 "y": 0,
-#                 "yanchor": "top",
-#             }
-#         ]
-#     }
-# )
-
-# manual_ani_fig.update_layout({"sliders": [sliders_dict]})
+    return jsonify(figure)
+
+
+@app.server.route("/preview/<name>/frames")
+def preview_window(name: str):
+    """full resolution colors of count frames from start, every step-th one"""
+    preview = preview_for(name)
+    count = min(request.args.get("count", 60, type=int), window_frames_limit)
+    window = preview.window(
+        request.args.get("start", 0, type=int),
+        count,
+        request.args.get("step", 1, type=int),
+        request.args.get("max_points", type=int),
+    )
+    return jsonify(window)
 
 
 app.layout = html.Div(
     [
         html.H4("Display tree in 3D coordinates"),
+        dcc.Dropdown(
+            id="sequence",
+            options=[{"label": path.name, "value": path.name} for path in sequence_paths],
+            value=test_sequence_path.name,
+            clearable=False,
+        ),
         dcc.Graph(
             id="3D_christmas_tree",
-            figure=manual_ani_fig,
-            style={"width": "90vw", "height": "90vh"},
+            style={"width": "90vw", "height": "80vh"},
         ),
+        html.Button("Play full frames", id="play_head_button", n_clicks=0),
+        dcc.Slider(id="play_head", min=0, max=0, step=1, value=0, marks=None),
+        dcc.Interval(id="play_head_timer", interval=frame_duration_ms, disabled=True),
     ]
 )
 
 
-# @app.callback(Output("3D_christmas_tree", "figure"), Input("range-slider", "value"))
-# def update_bar_chart(slider_range):
-#     df = px.data.iris()  # replace with your own data source
-#     low, high = slider_range
-#     mask = (df.petal_width > low) & (df.petal_width < high)
-
-#     fig = px.scatter_3d(
-#         df[mask],
-#         x="sepal_length",
-#         y="sepal_width",
-#         z="petal_width",
-#         color="species",
-#         hover_data=["petal_width"],
-#     )
-#     return fig
+@app.callback(
+    Output("3D_christmas_tree", "figure"),
+    Output("play_head", "max"),
+    Output("play_head", "value"),
+    Input("sequence", "value"),
+)
+def show_sequence(name: str):
+    """the preview with fewer frames but every led, the slider reaches every frame of
+    the whole sequence"""
+    preview = callback_preview_for(name)
+    figure = preview.figure(preview_frames, None, keyframe_threshold, frame_duration_ms)
+    return figure, max(preview.frame_count - 1, 0), 0
+
+
+@app.callback(
+    Output("3D_christmas_tree", "figure", allow_duplicate=True),
+    Input("play_head", "value"),
+    State("sequence", "value"),
+    prevent_initial_call=True,
+)
+def show_frame(position: int, name: str):
+    """only the colors of the one full resolution frame under the play head are sent"""
+    window = callback_preview_for(name).window(position, 1)
+    if not window["colors"]:
+        return no_update
+    figure = Patch()
+    figure["data"][0]["marker"]["color"] = window["colors"][0]
+    return figure
+
+
+@app.callback(
+    Output("play_head_timer", "disabled"),
+    Input("play_head_button", "n_clicks"),
+)
+def toggle_play_head(n_clicks: int):
+    return n_clicks % 2 == 0
+
+
+@app.callback(
+    Output("play_head", "value", allow_duplicate=True),
+    Input("play_head_timer", "n_intervals"),
+    State("play_head", "value"),
+    State("play_head", "max"),
+    prevent_initial_call=True,
+)
+def advance_play_head(n_intervals: int, position: int, last_frame: int):
+    return 0 if position >= last_frame else position + 1
 
 
 app.run_server(debug=True)
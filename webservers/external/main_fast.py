@@ -8,8 +8,10 @@ import logging
 from fastapi import FastAPI
 from pydantic import BaseModel
 from fastapi import Request
+from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse, StreamingResponse
 import json
-from pathlib import Path
 import random
 
 
@@ -21,9 +23,16 @@ current_directory = os.path.dirname(os.path.abspath(__file__))
 webservers_directory = os.path.abspath(os.path.join(current_directory, ".."))
 sys.path.append(webservers_directory)
 
-import common.common_send_recv as common_send_recv
-from common.common_send_recv import send_message, receive_message
+from common.common_send_recv import (
+    send_message,
+    receive_message,
+    receive_message_length,
+    receive_message_chunks,
+)
 from common.common_objects import setup_common_logger
+from common import metrics
+from common import sequence_binary
+from common import sequence_stream
 
 logger = logging.getLogger("christmas_lights_web")
 logger = setup_common_logger(logger)
@@ -31,6 +40,7 @@ logger = setup_common_logger(logger)
 # rpi_ip = "localhost"
 rpi_ip = "192.168.4.205"
 rpi_port = 12345
+upload_batch_frames = 32  # frames sent to the pi in each message of an upload
 
 
 class JsonData(BaseModel):
@@ -66,8 +76,19 @@ def send_and_receive_one_message_to_rpi(message: bytes) -> bytes:
 
 
 @app.get("/get_logs")
-def get_logs():
-    data = {"command": "get_log", "args": ""}
+def get_logs(
+    level: str | None = None,
+    logger_name: str | None = None,
+    since: float | None = None,
+    limit: int | None = None,
+):
+    """Logs from the pi, optionally only from one level up, one logger (and its
+    children) or after a unix timestamp"""
+    filters = {"level": level, "logger": logger_name, "since": since, "limit": limit}
+    data = {
+        "command": "get_log",
+        "args": {key: value for key, value in filters.items() if value is not None},
+    }
     json_data = json.dumps(data)
     with socket.create_connection((rpi_ip, rpi_port)) as connection_to_rpi:
         send_message(connection_to_rpi, json_data.encode("utf-8"))
@@ -92,6 +113,76 @@ def set_one_led(index: int, r: int = 255, g: int = 0, b: int = 0):
     logger.getChild("set_one").info(f"sent {data=}")
 
 
+@app.post("/plane")
+def draw_plane(
+    axis: str,
+    value: float,
+    tolerance: float = 0.05,
+    r: int = 0,
+    g: int = 255,
+    b: int = 0,
+    opacity: float = 1.0,
+    z_order: int = 0,
+):
+    """Highlight the leds near a plane on top of the current sequence"""
+    data = {
+        "command": "plane",
+        "args": {
+            "axis": axis,
+            "value": value,
+            "tolerance": tolerance,
+            "color": [r, g, b],
+            "opacity": opacity,
+            "z_order": z_order,
+        },
+    }
+    send_dict_to_rpi(data)
+
+
+@app.post("/text")
+def draw_text(
+    text: str, r: int = 255, g: int = 255, b: int = 255, opacity: float = 1.0
+):
+    """Write text across the front of the tree on top of the current sequence"""
+    data = {
+        "command": "text",
+        "args": {"text": text, "color": [r, g, b], "opacity": opacity},
+    }
+    send_dict_to_rpi(data)
+
+
+@app.post("/layer")
+def set_layer(name: str, opacity: float | None = None, z_order: int | None = None):
+    """Change the opacity or order of an overlay layer"""
+    data = {
+        "command": "layer",
+        "args": {"name": name, "opacity": opacity, "z_order": z_order},
+    }
+    send_dict_to_rpi(data)
+
+
+@app.post("/remove_layer")
+def remove_layer(name: str):
+    """Remove one overlay layer (set_one, plane, text, ...)"""
+    data = {"command": "remove_layer", "args": name}
+    send_dict_to_rpi(data)
+
+
+@app.post("/clear_layers")
+def clear_layers():
+    """Remove every overlay so only the sequence is showing"""
+    data = {"command": "clear_layers", "args": ""}
+    send_dict_to_rpi(data)
+
+
+@app.get("/layers")
+def get_layers():
+    """List the overlay layers on top of the current sequence"""
+    data = {"command": "get_layers", "args": ""}
+    json_bytes = send_and_receive_one_message_to_rpi(json.dumps(data).encode("utf-8"))
+    return json.loads(json_bytes.decode("utf-8"))
+
+
 @app.post("/allRGB")
 def allred(r: int, g: int, b: int):
     """Turn on the RGB lights"""
@@ -114,6 +205,22 @@ def set_speed(fps: float):
     logger.getChild("speed").info(f"setting the {fps=}")
 
 
+@app.post("/playback")
+def set_playback(timed: bool | None = None, speed: float | None = None):
+    """Play sequences by time instead of a frame per push. Played by time the leds are
+    pushed as fast as they can go and the sequence moves at the fps times speed, with
+    the frames in between blended, so slowed down sequences stay smooth. Without timed
+    the speed only multiplies the fps"""
+    args = {}
+    if timed is not None:
+        args["timed"] = timed
+    if speed is not None:
+        args["speed"] = speed
+    data = {"command": "playback", "args": args}
+    send_dict_to_rpi(data)
+    logger.getChild("playback").info(f"setting the playback to {args}")
+
+
 @app.post("/toggle_fps")
 def toggle_fps():
     """toggle the bit that says if I should print the current FPS to the console (DEFAULT: FALSE)"""
@@ -173,6 +280,25 @@ def fillWithRandomColor():
     )
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """Prometheus metrics from the pi, followed by the ones from this gateway. Both
+    count network_* traffic through common_send_recv, so the gateway's are prefixed
+    with gateway_ or the names would repeat and the whole scrape would be rejected"""
+    data = {"command": "get_metrics", "args": ""}
+    try:
+        rpi_metrics = send_and_receive_one_message_to_rpi(
+            json.dumps(data).encode("utf-8")
+        ).decode("utf-8")
+        rpi_up = 1
+    except OSError as e:
+        logger.getChild("metrics").warning(f"could not reach the pi: {e}")
+        rpi_metrics = ""
+        rpi_up = 0
+    metrics.gauge("rpi_up", "1 when the pi answered the last scrape").set(rpi_up)
+    return rpi_metrics + metrics.registry.render(prefix="gateway_")
+
+
 @app.get("/temp")
 def get_rpi_temp():
     """measure the temperature of the raspberry pi"""
@@ -197,6 +323,21 @@ def get_fps_arr():
     return json_text
 
 
+@app.get("/power")
+def get_power():
+    """how much current the leds are drawing and how often the power limit kicked in"""
+    data = {"command": "get_power", "args": ""}
+    json_bytes = send_and_receive_one_message_to_rpi(json.dumps(data).encode("utf-8"))
+    return json.loads(json_bytes.decode("utf-8"))
+
+
+@app.post("/power_budget")
+def set_power_budget(milliamps: float):
+    """Set the most current the leds can draw in mA, 0 turns the limit off"""
+    data = {"command": "power_budget", "args": milliamps}
+    send_dict_to_rpi(data)
+
+
 @app.get("/get_current_df")
 def get_current_df():
     """get the currently displayed dataframe"""
@@ -211,6 +352,112 @@ def get_current_df():
     return f"{received_dataframe}"
 
 
+@app.get("/sequence_report")
+def get_sequence_report():
+    """what the pi had to fix when it loaded the sequence that is showing, null for a
+    sequence that was not loaded from a file"""
+    data = {"command": "get_sequence_report", "args": ""}
+    reply = send_and_receive_one_message_to_rpi(json.dumps(data).encode("utf-8"))
+    return json.loads(reply.decode("utf-8"))
+
+
+@app.get("/download_sequence")
+def download_sequence(
+    file_format: str = "raw",
+    start: int | None = None,
+    stop: int | None = None,
+    compress: bool = False,
+):
+    """Download the sequence that is showing as raw frames (see
+    common/sequence_binary.py) or a .npy file, optionally only frames start to stop
+    and zlib compressed. It is passed along as it comes off the pi"""
+    args = {"format": file_format, "start": start, "stop": stop, "compress": compress}
+    data = {"command": "get_current_df", "args": args}
+    connection_to_rpi = socket.create_connection((rpi_ip, rpi_port))
+    send_message(connection_to_rpi, json.dumps(data).encode("utf-8"))
+    message_length = receive_message_length(connection_to_rpi)
+    if message_length == 0:
+        connection_to_rpi.close()
+        raise HTTPException(status_code=404, detail="the pi had no sequence to send")
+
+    def stream_from_rpi():
+        try:
+            yield from receive_message_chunks(connection_to_rpi, message_length)
+        finally:
+            connection_to_rpi.close()
+
+    file_name = "sequence.npy" if file_format == "npy" else "sequence.frames"
+    if compress and file_format == "npy":
+        file_name += ".zlib"
+    logger.getChild("download_sequence").info(f"sending {file_name} {message_length}b")
+    return StreamingResponse(
+        stream_from_rpi(),
+        media_type="application/octet-stream",
+        headers={
+            "Content-Length": str(message_length),
+            "Content-Disposition": f'attachment; filename="{file_name}"',
+        },
+    )
+
+
+@app.post("/upload_sequence")
+async def upload_sequence(
+    request: Request,
+    file_format: str = "csv",
+    start_frames: int | None = None,
+    crossfade: int | None = None,
+    compress: bool = False,
+):
+    """Upload a sequence as the request body, a CSV with R_0,G_0,B_0,... columns or
+    raw frames (see common/sequence_binary.py). It is checked as it arrives and
+    passed on to the pi a few frames at a time over one connection, so it can start
+    playing before the upload finishes"""
+    local_logger = logger.getChild("upload_sequence")
+    try:
+        decoder = sequence_stream.create_decoder(file_format, upload_batch_frames)
+    except sequence_binary.SequenceFormatError as e:
+        raise HTTPException(status_code=400, detail=f"{e}")
+
+    connection_to_rpi = await run_in_threadpool(
+        socket.create_connection, (rpi_ip, rpi_port)
+    )
+
+    async def send_to_rpi(message: bytes) -> None:
+        await run_in_threadpool(send_message, connection_to_rpi, message)
+
+    async def end_upload(ok: bool) -> dict:
+        end = {"command": "stream_end", "args": {"ok": ok}}
+        await send_to_rpi(json.dumps(end).encode("utf-8"))
+        reply = await run_in_threadpool(receive_message, connection_to_rpi)
+        return json.loads(reply.decode("utf-8"))
+
+    try:
+        begin = {
+            "command": "stream_begin",
+            "args": {"start_frames": start_frames, "crossfade": crossfade},
+        }
+        await send_to_rpi(json.dumps(begin).encode("utf-8"))
+        try:
+            async for chunk in request.stream():
+                for batch in decoder.feed(chunk):
+                    await send_to_rpi(sequence_binary.encode_frames(batch, compress))
+            for batch in decoder.finish():
+                await send_to_rpi(sequence_binary.encode_frames(batch, compress))
+        except sequence_binary.SequenceFormatError as e:
+            summary = await end_upload(False)
+            local_logger.warning(f"stopped after {decoder.frame_count} frames, {e}")
+            raise HTTPException(
+                status_code=400, detail=f"{e}, the pi kept {summary['frames']} frames"
+            )
+        summary = await end_upload(True)
+    finally:
+        connection_to_rpi.close()
+    if not decoder.report.is_clean():
+        local_logger.warning(f"had to fix the upload, {decoder.report.describe()}")
+    local_logger.info(f"uploaded {decoder.led_num} leds {summary}")
+    return summary
+
+
 @app.post("/brightness")
 def set_light_brightness(brightness: float):
     """Set the brightness precentage. Valid numbers between 1 and 100"""
@@ -220,6 +467,20 @@ def set_light_brightness(brightness: float):
         send_message(connection_to_rpi, json_data.encode("utf-8"))
 
 
+@app.post("/gamma")
+def set_gamma(gamma: float):
+    """Set the gamma correction, 1.0 is off and around 2.2 looks linear to the eye"""
+    data = {"command": "gamma", "args": gamma}
+    send_dict_to_rpi(data)
+
+
+@app.post("/white_balance")
+def set_white_balance(r: float = 1.0, g: float = 1.0, b: float = 1.0):
+    """Scale each color channel between 0.0 and 1.0"""
+    data = {"command": "white_balance", "args": [r, g, b]}
+    send_dict_to_rpi(data)
+
+
 @app.post("/loadfile")
 def load_csv_file_on_rpi(file_path: str):
     """Tell the controller what file you want it to load"""
@@ -245,6 +506,35 @@ def get_list_of_csvs():
     return json_text
 
 
+@app.get("/library")
+def get_library(
+    search: str = "",
+    sort: str = "name",
+    descending: bool = False,
+    limit: int | None = None,
+    min_frames: int = 0,
+    refresh: bool = True,
+):
+    """Every sequence on the pi with its frame count, size, checksum, fps, duration,
+    brightness and a strip of thumbnail colors, read from the pi's library index so no
+    sequence is loaded. sort is one of name, frames, size, duration,
+    average_brightness, peak_brightness or indexed_at"""
+    args = {
+        "search": search,
+        "sort": sort,
+        "descending": descending,
+        "limit": limit,
+        "min_frames": min_frames,
+        "refresh": refresh,
+    }
+    data = {"command": "get_library", "args": args}
+    reply = send_and_receive_one_message_to_rpi(json.dumps(data).encode("utf-8"))
+    library = json.loads(reply.decode("utf-8"))
+    if "error" in library:
+        raise HTTPException(status_code=400, detail=library["error"])
+    return library["sequences"]
+
+
 @app.post("/receivedf")
 async def receive_dataframe(request: Request):
     """
@@ -0,0 +1,255 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
+
+from common import file_parser as fp
+from common.colors import rgb_to_hex
+from common.common_objects import setup_common_logger
+
+
+logger = logging.getLogger("preview_cache")
+logger = setup_common_logger(logger)
+
+
+def animation_buttons(frame_duration_ms: int) -> list[dict]:
+    play = {
+        "label": "Play",
+        "method": "animate",
+        "args": [
+            None,
+            {
+                "frame": {"duration": frame_duration_ms, "redraw": True},
+                "fromcurrent": True,
+                "transition": {"duration": 0},
+            },
+        ],
+    }
+    pause = {
+        "label": "Pause",
+        "method": "animate",
+        "args": [
+            [None],
+            {
+                "frame": {"duration": 0, "redraw": True},
+                "mode": "immediate",
+                "transition": {"duration": 0},
+            },
+        ],
+    }
+    return [{"type": "buttons", "buttons": [play, pause]}]
+
+
+def keyframe_indices(
+    frames: np.ndarray, max_frames: int, threshold: float = 0.0
+) -> np.ndarray:
+    """Which frames to keep so there are at most max_frames. With a threshold, only
+    frames that differ from the one before by more than it (mean change per channel,
+    0 to 255) are kept, otherwise it is every Nth frame. The first frame is always in"""
+    frame_count = len(frames)
+    if frame_count == 0:
+        return np.zeros(0, dtype=np.intp)
+    if threshold > 0:
+        change = np.zeros(frame_count)
+        for start in range(1, frame_count, 256):
+            # a few frames at a time so the int16 copy stays small
+            block = frames[start - 1 : start + 256].astype(np.int16)
+            block_change = np.abs(np.diff(block, axis=0)).mean(axis=(1, 2))
+            change[start : start + len(block_change)] = block_change
+        indices = np.flatnonzero(change > threshold)
+        indices = np.concatenate([[0], indices[indices > 0]])
+    else:
+        indices = np.arange(frame_count)
+    if len(indices) > max_frames:
+        step = -(-len(indices) // max(max_frames, 1))
+        indices = indices[::step]
+    return indices.astype(np.intp)
+
+
+def sample_points(coordinates: np.ndarray, max_points: int) -> np.ndarray:
+    """Indices of at most about max_points leds spread over the whole tree, one per
+    cell of a grid laid over it, rather than every Nth led along the string"""
+    led_count = len(coordinates)
+    if led_count <= max_points:
+        return np.arange(led_count)
+    low = coordinates.min(axis=0)
+    size = np.maximum(coordinates.max(axis=0) - low, 1e-9)
+    cells_per_axis = max(int(np.ceil(max_points ** (1 / 3))), 1)
+    while True:
+        cells = np.minimum(
+            ((coordinates - low) / size * cells_per_axis).astype(np.int64),
+            cells_per_axis - 1,
+        )
+        cell_ids = (
+            cells[:, 0] * cells_per_axis + cells[:, 1]
+        ) * cells_per_axis + cells[:, 2]
+        _, first_leds = np.unique(cell_ids, return_index=True)
+        if len(first_leds) <= max_points or cells_per_axis == 1:
+            return np.sort(first_leds)
+        cells_per_axis -= 1
+
+
+@dataclass
+class Preview:
+    """A loaded sequence and the coordinates of its leds, with the figures that have
+    been made from it at each level of detail. Only the max_figures most recently
+    used figures are kept, every threshold asked for is a level of its own"""
+
+    sequence_path: Path
+    coordinate_path: Path
+    frames: np.ndarray
+    coordinates: np.ndarray
+    build_seconds: float
+    max_figures: int = 4
+    figures: OrderedDict = field(default_factory=OrderedDict)
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    @property
+    def frame_count(self) -> int:
+        return len(self.frames)
+
+    def figure(
+        self,
+        max_frames: int | None = None,
+        max_points: int | None = None,
+        threshold: float = 0.0,
+        frame_duration_ms: int = 50,
+    ) -> dict:
+        """The animated 3D figure as a plain dict, which skips plotly's validation of
+        every frame. The leds are placed once in the trace and each frame only carries
+        the marker colors, which plotly merges into the trace. Frames are named by
+        their index in the whole sequence"""
+        key = (max_frames, max_points, threshold, frame_duration_ms)
+        with self.lock:
+            figure = self.figures.get(key)
+            if figure is not None:
+                self.figures.move_to_end(key)
+                return figure
+        frame_indices = np.arange(self.frame_count)
+        if max_frames is not None:
+            frame_indices = keyframe_indices(self.frames, max_frames, threshold)
+        leds = self.points(max_points)
+        colors = rgb_to_hex(self.frames[frame_indices][:, leds])
+        points = self.coordinates[leds]
+        figure = {
+            "data": [
+                {
+                    "type": "scatter3d",
+                    "x": points[:, 0].tolist(),
+                    "y": points[:, 1].tolist(),
+                    "z": points[:, 2].tolist(),
+                    "mode": "markers",
+                    "marker": {
+                        "color": colors[0].tolist() if len(colors) else "#000000",
+                        "size": 3,
+                    },
+                }
+            ],
+            "layout": {
+                "title": self.sequence_path.stem,
+                "scene": {"aspectmode": "data"},
+                "uirevision": str(self.sequence_path),
+                "updatemenus": animation_buttons(frame_duration_ms),
+            },
+            "frames": [
+                {"name": str(index), "traces": [0], "data": [{"marker": {"color": row}}]}
+                for index, row in zip(frame_indices.tolist(), colors.tolist())
+            ],
+        }
+        with self.lock:
+            self.figures[key] = figure
+            while len(self.figures) > self.max_figures:
+                self.figures.popitem(last=False)
+        return figure
+
+    def points(self, max_points: int | None) -> np.ndarray:
+        if max_points is None:
+            return np.arange(len(self.coordinates))
+        return sample_points(self.coordinates, max_points)
+
+    def window(
+        self, start: int, count: int, step: int = 1, max_points: int | None = None
+    ) -> dict:
+        """full resolution colors of count frames from start, for loading the part of
+        the sequence being looked at. Wraps around the end of the sequence"""
+        if self.frame_count == 0:
+            return {"frames": [], "colors": []}
+        indices = (start + np.arange(max(count, 0)) * max(step, 1)) % self.frame_count
+        colors = rgb_to_hex(self.frames[indices][:, self.points(max_points)])
+        return {"frames": indices.tolist(), "colors": colors.tolist()}
+
+
+def build_preview(sequence_path: Path, coordinate_path: Path) -> Preview:
+    start = time.perf_counter()
+    coordinates = fp.read_GIFT_array(coordinate_path)
+    frames = fp.read_sequence_frames(sequence_path, len(coordinates))
+    build_seconds = time.perf_counter() - start
+    logger.getChild("build").info(
+        f"loaded {sequence_path.name} with {len(frames)} frames in {build_seconds:0.3f}s"
+    )
+    return Preview(sequence_path, coordinate_path, frames, coordinates, build_seconds)
+
+
+class PreviewCache:
+    """Loaded previews keyed by (sequence, coordinate file). Each is loaded once on a
+    background thread, warm() queues them up before anyone asks. The key has the
+    files' modified times in it, so an edited file is built again. Only the
+    max_entries most recently used are kept"""
+
+    def __init__(self, max_entries: int = 8) -> None:
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries: OrderedDict[tuple, Future] = OrderedDict()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="preview")
+
+    @staticmethod
+    def key_for(sequence_path: Path, coordinate_path: Path) -> tuple:
+        return (
+            str(sequence_path.resolve()),
+            sequence_path.stat().st_mtime_ns,
+            str(coordinate_path.resolve()),
+            coordinate_path.stat().st_mtime_ns,
+        )
+
+    def submit(self, sequence_path: Path, coordinate_path: Path) -> Future:
+        """the preview, or the build of it that is already queued"""
+        key = self.key_for(sequence_path, coordinate_path)
+        with self.lock:
+            future = self.entries.get(key)
+            if future is None:
+                future = self.executor.submit(
+                    build_preview, sequence_path, coordinate_path
+                )
+                self.entries[key] = future
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return future
+
+    def warm(self, sequence_paths: Iterable[Path], coordinate_path: Path) -> None:
+        for sequence_path in sequence_paths:
+            self.submit(sequence_path, coordinate_path)
+
+    def get(self, sequence_path: Path, coordinate_path: Path) -> Preview:
+        future = self.submit(sequence_path, coordinate_path)
+        if future.cancel():
+            # still queued behind the warm up, so build it here rather than wait
+            preview = build_preview(sequence_path, coordinate_path)
+            future = Future()
+            future.set_result(preview)
+            with self.lock:
+                self.entries[self.key_for(sequence_path, coordinate_path)] = future
+            return preview
+        try:
+            return future.result()
+        except Exception:
+            # not kept, so the next ask tries again
+            with self.lock:
+                self.entries.pop(self.key_for(sequence_path, coordinate_path), None)
+            raise
@@ -0,0 +1,98 @@
+import logging
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+from common import metrics
+from common.common_objects import setup_common_logger
+
+
+logger = logging.getLogger("cluster_sync")
+logger = setup_common_logger(logger)
+
+beacons_received = metrics.counter(
+    "cluster_beacons_total", "Sync beacons received from the cluster coordinator"
+)
+clock_offset = metrics.gauge(
+    "cluster_clock_offset_seconds", "Coordinator clock minus this pi's clock"
+)
+
+
+class ClusterClock:
+    """The coordinator's clock as this pi sees it, and the epoch every controller in
+    the cluster counts frames from.
+
+    Each beacon carries the coordinator's time when it was sent, so the time it
+    arrives here minus that is the offset between the clocks plus however long the
+    beacon took to get here. Taking the largest of the last few is the one that got
+    here quickest. With an epoch, the frame to show at any moment is
+    (coordinator time - epoch) * fps on every controller, so they all stay on the
+    same frame however they were started. Without one the pi plays on its own"""
+
+    def __init__(self, samples: int = 8) -> None:
+        self.lock = threading.Lock()
+        self.offsets: deque[float] = deque(maxlen=samples)
+        self.epoch: Optional[float] = None
+        self.fps = 0.0
+        # the epoch, coordinator time and position of the last frame made in step
+        # with it. None until a frame has been made since the epoch last changed
+        self.rendered: Optional[tuple[float, float, float]] = None
+
+    def offset(self) -> float:
+        with self.lock:
+            return max(self.offsets) if self.offsets else 0.0
+
+    def now(self) -> float:
+        """the coordinator's time right now, as best this pi knows it"""
+        return time.time() + self.offset()
+
+    def beacon(self, sent: float, epoch: Optional[float], fps: float) -> dict:
+        """take in a beacon and say where this pi has got to, so the coordinator can
+        work out how far each controller is from where it should be"""
+        received = time.time()
+        with self.lock:
+            self.offsets.append(float(sent) - received)
+            synced_before = self.epoch is not None
+            epoch = None if epoch is None else float(epoch)
+            if epoch != self.epoch:
+                self.rendered = None
+            self.epoch = epoch
+            self.fps = max(float(fps), 0.0)
+        beacons_received.inc()
+        clock_offset.set(self.offset())
+        if synced_before != (epoch is not None):
+            logger.getChild("beacon").info(
+                f"{'following' if epoch is not None else 'left'} the cluster clock"
+            )
+        now = self.now()
+        return {"clock": now, "frame": self.frame_at(now), "epoch": self.epoch}
+
+    def position_at(self, due: float) -> Optional[float]:
+        """which frame (with the fraction between frames) should be on the leds at
+        due, a time.perf_counter() time. None when there is no cluster to follow"""
+        with self.lock:
+            epoch, fps = self.epoch, self.fps
+        if epoch is None:
+            return None
+        coordinator_due = due + time.time() - time.perf_counter() + self.offset()
+        position = (coordinator_due - epoch) * fps
+        with self.lock:
+            self.rendered = (epoch, coordinator_due, position)
+        return position
+
+    def frame_at(self, coordinator_time: float) -> Optional[float]:
+        """the frame this pi is showing at a coordinator time, carried on from the
+        last frame it made at the cluster's fps. Until it has made one under the
+        current epoch, the frame it is about to show"""
+        with self.lock:
+            epoch, fps, rendered = self.epoch, self.fps, self.rendered
+        if epoch is None:
+            return None
+        if rendered is None or rendered[0] != epoch:
+            return (coordinator_time - epoch) * fps
+        _, rendered_time, position = rendered
+        return position + (coordinator_time - rendered_time) * fps
+
+
+cluster_clock = ClusterClock()
@@ -0,0 +1,67 @@
+import numpy as np
+
+import config
+from shared_state import DisplaySettings, state
+
+
+def build_channel_lut(
+    brightness: float, gamma: float, balance: float, limit: int
+) -> np.ndarray:
+    """256 entry table of what each input value of one channel should be sent out as"""
+    values = np.arange(256, dtype=np.float64) / 255.0
+    values = np.power(values, gamma) * brightness * balance * 255.0
+    values = np.minimum(np.round(values), limit)
+    return np.clip(values, 0, 255).astype(np.uint8)
+
+
+class ColorCorrection:
+    """Brightness, gamma, white balance and a per channel limit as one lookup table per
+    channel. Changing any of them only rebuilds the 768 entry table, the sequence itself
+    is never touched."""
+
+    def __init__(self, led_num: int) -> None:
+        # the three tables are stored end to end so one np.take does every channel.
+        # Offsets and index are full size intp so neither the add nor the take has to
+        # cast or broadcast through a temporary every frame
+        offsets = np.array([0, 256, 512], dtype=np.intp)
+        self.channel_offsets = np.tile(offsets, (led_num, 1))
+        self.lut: np.ndarray = np.tile(np.arange(256, dtype=np.uint8), 3)
+        self.is_identity = True
+        self.version = 0
+        self.index = np.zeros((led_num, 3), dtype=np.intp)
+        self.output = np.zeros((led_num, 3), dtype=np.uint8)
+        self.rebuild()
+
+    def rebuild(self, settings: DisplaySettings | None = None) -> None:
+        if settings is None:
+            settings = state.settings
+        balance = list(settings.white_balance)
+        lut = np.concatenate(
+            [
+                build_channel_lut(
+                    settings.brightness,
+                    settings.gamma,
+                    balance[channel],
+                    settings.channel_limit,
+                )
+                for channel in range(3)
+            ]
+        )
+        # swapped rather than edited in place, at worst one frame goes out uncorrected
+        self.lut = lut
+        self.is_identity = np.array_equal(
+            lut, np.tile(np.arange(256, dtype=np.uint8), 3)
+        )
+        self.version += 1
+
+    def apply(self, frame: np.ndarray) -> np.ndarray:
+        """correct a (led_num, 3) frame. Hands back the same frame when nothing changes"""
+        if self.is_identity:
+            return frame
+        np.copyto(self.index, frame)
+        np.add(self.index, self.channel_offsets, out=self.index)
+        np.take(self.lut, self.index, out=self.output, mode="clip")
+        return self.output
+
+
+color_correction = ColorCorrection(config.led_num)
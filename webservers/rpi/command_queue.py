@@ -0,0 +1,164 @@
+import queue
+import threading
+import time
+from collections import deque
+from typing import Any, Optional
+
+from common import metrics
+
+
+# these stop or skip what is playing, so they go ahead of everything else
+priority_commands = {"stop", "playlist_stop", "playlist_next"}
+
+# a newer command with the same key makes the older one pointless, so the older one
+# is dropped if it is still waiting. Everything that replaces the sequence shares a key
+sequence_commands = {"fill", "loadfile"}
+# these add to the sequence instead of replacing it, so they never drop anything but
+# are dropped along with the sequence they were added to
+appending_commands = {"addlist"}
+setting_commands = {
+    "fps",
+    "brightness",
+    "gamma",
+    "white_balance",
+    "channel_limit",
+    "power_budget",
+    "crossfade",
+}
+# the layer each drawing command replaces when it is not given a name
+default_layer_names = {
+    "set_one": "set_one",
+    "plane": "plane",
+    "mask": "mask",
+    "text": "text",
+}
+
+queue_depth = metrics.gauge("command_queue_depth", "Commands waiting to be handled")
+commands_coalesced = metrics.counter(
+    "commands_coalesced_total", "Commands dropped because a newer one replaced them"
+)
+queue_wait_seconds = metrics.histogram(
+    "command_queue_wait_seconds", "Time a command spent waiting to be handled"
+)
+
+
+def coalesce_key(command: Any) -> Optional[str]:
+    """what a command overwrites, None when every one of them has to run"""
+    if type(command) != dict:
+        return None
+    name = command.get("command")
+    args = command.get("args")
+    if name in sequence_commands or name in appending_commands:
+        return "sequence"
+    if name in setting_commands:
+        return name
+    if name in default_layer_names:
+        layer_name = default_layer_names[name]
+        if type(args) == dict:
+            layer_name = str(args.get("name", layer_name))
+        return f"layer:{layer_name}"
+    if name == "remove_layer":
+        # removing a layer and drawing it again both decide what the layer ends up as
+        return f"layer:{args}"
+    if name == "layer" and type(args) == dict:
+        return f"layer_settings:{args.get('name')}"
+    return None
+
+
+def barrier_keys(command: Any, key: Optional[str], waiting: list[str]) -> list[str]:
+    """the keys of waiting commands this one has to run in order with. Those can not
+    be coalesced with the same command put after this one, or it would jump over it"""
+    if type(command) == dict and command.get("command") == "clear_layers":
+        return [
+            waiting_key
+            for waiting_key in waiting
+            if waiting_key.startswith(("layer:", "layer_settings:"))
+        ]
+    # drawing a layer replaces its settings, and the settings need the layer drawn
+    if key is not None and key.startswith("layer:"):
+        return ["layer_settings:" + key.removeprefix("layer:")]
+    if key is not None and key.startswith("layer_settings:"):
+        return ["layer:" + key.removeprefix("layer_settings:")]
+    return []
+
+
+class CommandQueue:
+    """A stand in for the queue.Queue between networking and the dispatcher.
+
+    Commands in priority_commands skip the line. A newer command with the same
+    coalesce_key as ones still waiting goes to the back like any other and the older
+    ones are dropped where they wait (blanked out rather than taken out of the queue),
+    so a burst of fills or brightness changes only does the last one. Commands that
+    have to stay in order with others, like clear_layers and the drawing of a layer
+    and its settings, stop anything waiting before them from being coalesced with
+    what comes after, see barrier_keys."""
+
+    def __init__(self) -> None:
+        self.condition = threading.Condition()
+        self.priority: deque[tuple[float, dict]] = deque()
+        # [command, key, time it was put]. command is None once superseded
+        self.normal: deque[list] = deque()
+        # the entries still waiting for each key, oldest first
+        self.waiting: dict[str, list[list]] = {}
+        self.count = 0
+
+    def put(self, command: Any, block: bool = True, timeout: Optional[float] = None):
+        now = time.monotonic()
+        with self.condition:
+            if type(command) == dict and command.get("command") in priority_commands:
+                self.priority.append((now, command))
+            else:
+                key = coalesce_key(command)
+                for barrier in barrier_keys(command, key, list(self.waiting)):
+                    # still in the queue, just no longer something to coalesce with
+                    self.waiting.pop(barrier, None)
+                waiting = self.waiting.setdefault(key, []) if key is not None else []
+                if waiting and command.get("command") not in appending_commands:
+                    for superseded in waiting:
+                        superseded[0] = None
+                        self.count -= 1
+                    commands_coalesced.inc(len(waiting))
+                    waiting.clear()
+                entry = [command, key, now]
+                self.normal.append(entry)
+                if key is not None:
+                    waiting.append(entry)
+            self.count += 1
+            queue_depth.set(self.count)
+            self.condition.notify()
+
+    def put_nowait(self, command: Any) -> None:
+        self.put(command, block=False)
+
+    def get(self, block: bool = True, timeout: Optional[float] = None) -> Any:
+        with self.condition:
+            if not block:
+                timeout = 0
+            if not self.condition.wait_for(lambda: self.count > 0, timeout):
+                raise queue.Empty
+            if self.priority:
+                put_time, command = self.priority.popleft()
+            else:
+                entry = self.normal.popleft()
+                while entry[0] is None:
+                    entry = self.normal.popleft()
+                command, key, put_time = entry
+                waiting = self.waiting.get(key) if key is not None else None
+                # not there if a barrier put after it stopped it from being coalesced
+                if waiting and waiting[0] is entry:
+                    waiting.pop(0)
+                    if not waiting:
+                        del self.waiting[key]
+            self.count -= 1
+            queue_depth.set(self.count)
+        queue_wait_seconds.observe(time.monotonic() - put_time)
+        return command
+
+    def get_nowait(self) -> Any:
+        return self.get(block=False)
+
+    def qsize(self) -> int:
+        return self.count
+
+    def empty(self) -> bool:
+        return self.count == 0
@@ -1,4 +1,4 @@
-from numpy import ubyte
+import numpy as np
 import pandas as pd
 
 import threading
@@ -18,9 +18,28 @@ webservers_directory = os.path.abspath(os.path.join(current_directory, ".."))
 sys.path.append(webservers_directory)
 
 import common.common_send_recv as common_send_recv
-from common.common_objects import setup_common_logger, all_standard_column_names
+from common import metrics
+from common.common_objects import (
+    setup_common_logger,
+    all_standard_column_names,
+    create_filled_dataframe,
+)
+from common.file_parser import load_sequence
+from common import sequence_binary
 
 import config
+import layers
+from library import library
+from frame_buffer import FrameBuffer
+import playlist
+from layers import layer_stack
+from color_correction import color_correction
+from power_limiter import power_limiter
+from shared_state import state
+from cluster_sync import cluster_clock
+from display import convert_df_to_frames
+import sequence_upload
+from sequence_upload import SequenceUpload
 
 logger = logging.getLogger("commands")
 logger = setup_common_logger(logger)
@@ -31,26 +50,115 @@ logger.info(f"{config.fps=}")
 
 column_names = all_standard_column_names(config.led_num)
 
-
-def handle_get_logs(*, send_back, send_queue: queue.Queue, **kwargs):
-    data = json.dumps(config.log_capture.getvalue()).encode("utf-8")
+command_seconds = metrics.histogram(
+    "command_seconds", "Time to handle each command, by command"
+)
+command_errors = metrics.counter(
+    "command_errors_total", "Commands that raised an exception"
+)
+
+
+def handle_get_logs(*, value, send_back, send_queue: queue.Queue, **kwargs):
+    """send back the captured logs as one string. value can be a dict to filter them
+    {"level": "INFO", "logger": "display", "since": unix time, "limit": int}"""
+    local_logger = logger.getChild("get_log")
+    filters = value if type(value) == dict else {}
+    level = filters.get("level") or logging.NOTSET
+    if type(level) == str:
+        level = logging.getLevelName(level.upper())
+        if type(level) != int:
+            local_logger.error(f"{filters['level']} is not a log level")
+            level = logging.NOTSET
+    since = filters.get("since")
+    limit = filters.get("limit")
+    lines = []
+    if config.log_capture is not None:
+        lines = config.log_capture.get_records(
+            level=level,
+            name=filters.get("logger"),
+            since=None if since is None else float(since),
+            limit=None if limit is None else int(limit),
+        )
+    data = json.dumps("\n".join(lines)).encode("utf-8")
     send_queue.put((send_back, data))
 
 
 def handle_fps(*, value: float, **kwargs) -> None:
-    config.fps = float(value)
+    state.update_settings(fps=max(float(value), 0.0))
 
 
-def handle_brightness(*, value: float, display_queue: queue.Queue, **kwargs) -> None:
+def handle_playback(*, value: dict, **kwargs) -> None:
+    """{"timed": bool, "speed": float}, either can be left out. Played by time the leds
+    are pushed as fast as they go and the sequence moves at fps * speed, blending the
+    frames in between, otherwise speed only scales the fps"""
+    if type(value) != dict:
+        logger.getChild("playback").error(f"needed a dict, got {value=}")
+        return
+    changes = {}
+    if "timed" in value:
+        changes["timed_playback"] = bool(value["timed"])
+    if "speed" in value:
+        changes["speed"] = max(float(value["speed"]), 0.0)
+    state.update_settings(**changes)
+
+
+def handle_brightness(*, value: float, **kwargs) -> None:
     limit = lambda x: min(max(float(x), 0.0), 1.0)
-    config.brightness = limit(value)  # type: ignore
-    scaled_brightness = int(config.brightness * 255)
-    config.pixels.setBrightness(scaled_brightness)  # type: ignore
+    settings = state.update_settings(brightness=limit(value))
+    # takes effect on the next frame, the sequence doesnt need converting again
+    color_correction.rebuild(settings)
     logger.getChild("set_brightness").debug(
-        f"setting brightness to {config.brightness}/{scaled_brightness}"
+        f"setting brightness to {settings.brightness}"
+    )
+
+
+def handle_gamma(*, value: float, **kwargs) -> None:
+    settings = state.update_settings(gamma=min(max(float(value), 0.1), 5.0))
+    color_correction.rebuild(settings)
+    logger.getChild("gamma").debug(f"setting gamma to {settings.gamma}")
+
+
+def handle_white_balance(*, value: list[float], **kwargs) -> None:
+    """scale each channel [r, g, b] between 0.0 and 1.0"""
+    if type(value) != list or len(value) != 3:
+        logger.getChild("white_balance").error(f"needed [r, g, b], got {value=}")
+        return
+    settings = state.update_settings(
+        white_balance=tuple(min(max(float(x), 0.0), 1.0) for x in value)
+    )
+    color_correction.rebuild(settings)
+    logger.getChild("white_balance").debug(f"{settings.white_balance=}")
+
+
+def handle_channel_limit(*, value: int, **kwargs) -> None:
+    settings = state.update_settings(channel_limit=min(max(int(value), 0), 255))
+    color_correction.rebuild(settings)
+    logger.getChild("channel_limit").debug(f"{settings.channel_limit=}")
+
+
+def handle_power_budget(*, value: float, **kwargs) -> None:
+    """the most current in mA the leds are allowed to draw, 0 turns the limit off"""
+    config.power_budget_ma = max(float(value), 0.0)
+    power_limiter.settings_changed()
+    logger.getChild("power_budget").debug(f"{config.power_budget_ma=}")
+
+
+def handle_get_power(*, send_back, send_queue: queue.Queue, **kwargs) -> None:
+    """send back how much current the leds are drawing and how often it was limited"""
+    data = json.dumps(power_limiter.to_dict()).encode("utf-8")
+    send_queue.put((send_back, data))
+
+
+def handle_crossfade(*, value: list, **kwargs) -> None:
+    """set how switching sequences fades, [frames, "alpha" | "add" | "wipe"]"""
+    local_logger = logger.getChild("crossfade")
+    if type(value) != list or len(value) != 2:
+        local_logger.error(f"needed [frames, mode], got {type(value)=} {value=}")
+        return
+    settings = state.update_settings(
+        crossfade_frames=max(int(value[0]), 0), blend_mode=str(value[1])
     )
-    # this triggers a refresh of the current dataframe.
-    # display_queue.put(config.current_dataframe)
+    local_logger.debug(f"{settings.crossfade_frames=} {settings.blend_mode=}")
 
 
 def handle_getting_temp(*, send_back, send_queue: queue.Queue, **kwargs) -> None:
@@ -77,7 +185,15 @@ def handle_getting_last_fps(*, send_back, send_queue: queue.Queue, **kwargs) ->
     logger.getChild("fps_dump").debug(f"Sent back {json_string}")
 
 
-def handle_fill(*, value: list[int], display_queue: queue.Queue, **kwargs):
+def stop_playlist_for(command: str) -> None:
+    """a sequence was asked for by hand, so the playlist must not cover it up when it
+    moves on to its next item"""
+    if playlist.player.enabled:
+        playlist.player.enabled = False
+        logger.getChild("playlist").info(f"stopped the playlist for {command}")
+
+
+def handle_fill(*, value: list[int], **kwargs):
     # converts RGB into a GRB hex
     if type(value) != list:
         logger.getChild("fill").error(
@@ -93,16 +209,16 @@ def handle_fill(*, value: list[int], display_queue: queue.Queue, **kwargs):
     color_r = limit(value[0])
     color_g = limit(value[1])
     color_b = limit(value[2])
-    data = [color_r, color_g, color_b] * config.led_num
 
-    current_df_sequence = pd.DataFrame(
-        [data], index=range(1), columns=column_names, dtype=ubyte
+    current_df_sequence = create_filled_dataframe(
+        [color_r, color_g, color_b], config.led_num
     )
-    display_queue.put(current_df_sequence)
+    stop_playlist_for("fill")
+    state.publish_sequence(current_df_sequence)
 
 
-def handle_one(*, value: list[int], display_queue: queue.Queue, **kwargs):
-    # TODO: this requires testing. Cant seem to verify this by looking out the window
+def handle_one(*, value: list[int], **kwargs):
+    """highlight one led on top of whatever is playing [index, r, g, b]"""
     if type(value) != list:
         logger.getChild("set_one").error(
             f"trying to fill with something that is not a list {type(value)=}\n{value=}"
@@ -114,54 +230,184 @@ def handle_one(*, value: list[int], display_queue: queue.Queue, **kwargs):
         )
         return
     index = int(value[0])
-    color_r = int(value[1])
-    color_g = int(value[2])
-    color_b = int(value[3])
+    if not 0 <= index < config.led_num:
+        logger.getChild("set_one").error(f"{index=} is not a valid led")
+        return
+    color = [int(value[1]), int(value[2]), int(value[3])]
+    layer_stack.set_layer(
+        layers.single_led_layer("set_one", config.led_num, index, color)
+    )
 
-    data = [0, 0, 0] * config.led_num
-    data[index] = color_r
-    data[index + 1] = color_g
-    data[index + 2] = color_b
 
-    current_df_sequence = pd.DataFrame([data], index=range(1), columns=column_names)
-    display_queue.put(current_df_sequence)
+def set_layer_with_options(layer: layers.Layer, value: dict) -> None:
+    layer.opacity = min(max(float(value.get("opacity", 1.0)), 0.0), 1.0)
+    layer.z_order = int(value.get("z_order", 0))
+    layer_stack.set_layer(layer)
+
+
+def handle_plane(*, value: dict | list, **kwargs) -> None:
+    """light the leds near a plane {"axis": "x", "value": float, "color": [r, g, b],
+    "tolerance": float, "name": str, "opacity": float, "z_order": int}, or the older
+    [axis, value, r, g, b, tolerance]"""
+    local_logger = logger.getChild("plane")
+    if type(value) == list and len(value) == 6:
+        value = {
+            "axis": value[0],
+            "value": value[1],
+            "color": value[2:5],
+            "tolerance": value[5],
+        }
+    if type(value) != dict or "axis" not in value or "value" not in value:
+        local_logger.error(f"needed a dict with an axis and a value, got {value=}")
+        return
+    if str(value["axis"]).lower() not in ("x", "y", "z"):
+        local_logger.error(f"the axis has to be x, y or z, got {value['axis']}")
+        return
+    coordinates = layers.load_led_coordinates()
+    if coordinates is None:
+        local_logger.error("there are no led coordinates to draw a plane with")
+        return
+    layer = layers.plane_layer(
+        str(value.get("name", "plane")),
+        coordinates,
+        "xyz".index(str(value["axis"]).lower()),
+        float(value["value"]),
+        float(value.get("tolerance", 0.05)),
+        [int(channel) for channel in value.get("color", [0, 255, 0])],
+    )
+    set_layer_with_options(layer, value)
+
+
+def handle_mask(*, value: dict, **kwargs) -> None:
+    """{"name": str, "leds": [int], "color": [r, g, b], "opacity": float, "z_order": int}"""
+    local_logger = logger.getChild("mask")
+    if type(value) != dict:
+        local_logger.error(f"needed a dict, got {type(value)=}, {value=}")
+        return
+    layer = layers.mask_layer(
+        str(value.get("name", "mask")),
+        config.led_num,
+        value.get("leds", []),
+        value.get("color", [255, 255, 255]),
+    )
+    set_layer_with_options(layer, value)
+
+
+def handle_text(*, value: dict, **kwargs) -> None:
+    """{"text": str, "color": [r, g, b], "name": str, "opacity": float, "z_order": int}"""
+    local_logger = logger.getChild("text")
+    if type(value) != dict:
+        local_logger.error(f"needed a dict, got {type(value)=}, {value=}")
+        return
+    coordinates = layers.load_led_coordinates()
+    if coordinates is None:
+        local_logger.error("there are no led coordinates to draw text with")
+        return
+    layer = layers.text_layer(
+        str(value.get("name", "text")),
+        coordinates,
+        str(value.get("text", "")),
+        value.get("color", [255, 255, 255]),
+    )
+    set_layer_with_options(layer, value)
+
+
+def handle_layer_settings(*, value: dict, **kwargs) -> None:
+    """change a layer without redrawing it {"name": str, "opacity": float, "z_order": int}"""
+    local_logger = logger.getChild("layer")
+    if type(value) != dict or "name" not in value:
+        local_logger.error(f"needed a dict with a name, got {value=}")
+        return
+    if not layer_stack.update_layer(
+        value["name"], value.get("opacity"), value.get("z_order")
+    ):
+        local_logger.error(f"there is no layer called {value['name']}")
+
+
+def handle_remove_layer(*, value: str, **kwargs) -> None:
+    if not layer_stack.remove_layer(str(value)):
+        logger.getChild("remove_layer").warning(f"there is no layer called {value}")
+
+
+def handle_clear_layers(**kwargs) -> None:
+    layer_stack.clear()
+
+
+def handle_get_layers(*, send_back, send_queue: queue.Queue, **kwargs) -> None:
+    data = json.dumps(layer_stack.to_list()).encode("utf-8")
+    send_queue.put((send_back, data))
 
 
 def handle_getting_list_of_files(
     *, send_back, send_queue: queue.Queue, **kwargs
 ) -> None:
     """Return a list of the current CSV's that can be played"""
-    csv_file_path = Path("/home/pi/github/xmastree2023/examples")
+    csv_file_path = Path(config.sequence_folder)
     csv_files = list(map(str, list(csv_file_path.glob("*.csv"))))
     data = json.dumps(csv_files).encode("utf-8")
     send_queue.put((send_back, data))
 
 
-def handle_add_list(*, value: list[int], display_queue: queue.Queue, **kwargs) -> None:
-    if type(value) == list:
-        pass
-    else:
-        logger.getChild("add_list").warning(
-            f"needed a list, but got {type(value)} of {value=}"
+def handle_get_library(*, value, send_back, send_queue: queue.Queue, **kwargs) -> None:
+    """send back what the library index knows about each sequence. value can be a dict
+    {"search": str, "sort": column, "descending": bool, "limit": int,
+    "min_frames": int, "refresh": bool}. The answer is what the index has now, unless
+    refresh is false a refresh is started alongside so the next listing is up to date"""
+    local_logger = logger.getChild("get_library")
+    options = value if type(value) == dict else {}
+    if options.get("refresh", True):
+        library.refresh_in_background()
+    try:
+        sequences = library.query(
+            search=str(options.get("search", "")),
+            sort=str(options.get("sort", "name")),
+            descending=bool(options.get("descending", False)),
+            limit=options.get("limit"),
+            min_frames=int(options.get("min_frames", 0)),
         )
+        data = {"sequences": sequences}
+    except ValueError as e:
+        local_logger.error(f"{e}, got {options=}")
+        data = {"error": str(e)}
+    send_queue.put((send_back, json.dumps(data).encode("utf-8")))
+
+
+def handle_add_list(*, value: list[int], **kwargs) -> None:
+    """add one frame [r, g, b, r, g, b, ...] to the end of the sequence that is playing.
+    The first one moves the sequence into a FrameBuffer, after that each frame only
+    adds itself and the display picks it up without starting over"""
+    local_logger = logger.getChild("add_list")
+    if type(value) != list:
+        local_logger.warning(f"needed a list, but got {type(value)} of {value=}")
+        return
+    change = state.latest_sequence()[1]
+    if change is None:
+        local_logger.warning("there is no sequence to add to yet")
         return
 
-    # going to assume this is in order
-    # note that the rows and columns are one based and not zero based
-    working_df: pd.DataFrame = config.current_dataframe  # type: ignore
-    if "FRAME_ID" in working_df.columns:
-        working_df = working_df.drop("FRAME_ID", axis=1)
-
-    current_row, current_column = working_df.shape
-
-    if len(value) != current_column:
-        logger.getChild("add_list").warning(
-            f"needed a list of len({current_column}), but got {len(value)} of {value=}"
+    buffer = change.frames
+    led_num = buffer.led_num if isinstance(buffer, FrameBuffer) else config.led_num
+    if len(value) != led_num * 3:
+        local_logger.warning(
+            f"needed a list of len({led_num * 3}), but got {len(value)} of {value=}"
         )
         return
+    frame = np.asarray(value)
+    if frame.min() < 0 or frame.max() > 255:
+        local_logger.warning(f"colors have to be between 0 and 255, got {value=}")
+        return
 
-    config.current_dataframe.loc[current_row] = value  # type: ignore
-    display_queue.put(config.current_dataframe)
+    stop_playlist_for("addlist")
+    if isinstance(buffer, FrameBuffer):
+        buffer.append(frame.astype(np.uint8).reshape(led_num, 3))
+        return
+    frames = change.frames
+    if frames is None:
+        frames = convert_df_to_frames(change.dataframe)
+    buffer = FrameBuffer(led_num, capacity=2 * (len(frames) + 1))
+    buffer.append(frames)
+    buffer.append(frame.astype(np.uint8).reshape(led_num, 3))
+    state.publish_sequence(None, buffer, crossfade_frames=0, keep_position=True)
 
 
 def handle_show_df(*, send_back, send_queue: queue.Queue, **kwargs) -> None:
@@ -176,10 +422,50 @@ def handle_show_df(*, send_back, send_queue: queue.Queue, **kwargs) -> None:
         local_logger.error(f"got exception {e=}")
 
 
-def handle_get_current_df(*, send_back, send_queue: queue.Queue, **kwargs) -> None:
+def current_sequence_as_bytes(options: dict) -> bytes:
+    """{"format": "raw" | "npy", "start": int, "stop": int, "compress": bool}, the
+    formats are in common/sequence_binary.py. Empty when there is nothing to send"""
+    local_logger = logger.getChild("get_current_df")
+    frames = state.current_frames()
+    if frames is None:
+        working_df = state.current_dataframe()
+        if working_df is None:
+            local_logger.warning("there is no sequence to send")
+            return b""
+        frames = convert_df_to_frames(working_df)
+    start = options.get("start")
+    stop = options.get("stop")
+    frames = sequence_binary.slice_frames(
+        frames,
+        None if start is None else int(start),
+        None if stop is None else int(stop),
+    )
+    try:
+        data = sequence_binary.encode(
+            frames,
+            str(options.get("format", "raw")),
+            bool(options.get("compress", False)),
+        )
+    except sequence_binary.SequenceFormatError as e:
+        local_logger.error(f"{e}")
+        return b""
+    local_logger.debug(f"sending {len(frames)} frames as {len(data)}b")
+    return data
+
+
+def handle_get_current_df(
+    *, value, send_back, send_queue: queue.Queue, **kwargs
+) -> None:
+    """send back the sequence that is showing. With a dict of options it is sent as
+    bytes (see current_sequence_as_bytes), otherwise as JSON of the dataframe"""
     local_logger = logger.getChild("get_current_df")
+    if type(value) == dict:
+        send_queue.put((send_back, current_sequence_as_bytes(value)))
+        return
 
-    working_df = config.current_dataframe
+    working_df = state.current_dataframe()
+    if working_df is None:
+        working_df = pd.DataFrame()
     local_logger.debug(f"dumping the dataframe to a json string")
     json_text = working_df.to_json(orient="index")  # type: ignore
     json_data = json.dumps(json_text)
@@ -187,11 +473,9 @@ def handle_get_current_df(*, send_back, send_queue: queue.Queue, **kwargs) -> No
     send_queue.put((send_back, data))
 
 
-def handle_file(*, value: str, display_queue: queue.Queue, **kwargs):
-    # load a csv file
-    # load that into a dataframe
-    # check that it has the right size
-    # check that each element is a hex code
+def handle_file(*, value: str, **kwargs):
+    """load a sequence csv. It is checked and fixed up once here (see
+    normalize_sequence), get_sequence_report says what had to change"""
     local_logger = logger.getChild("handle_file")
 
     if type(value) != str:
@@ -202,24 +486,199 @@ def handle_file(*, value: str, display_queue: queue.Queue, **kwargs):
         local_logger.error(f"File dosn't exist. {file_path=}")
         return
 
-    results = None
+    frames, report = load_sequence(file_path, config.led_num)
+    if not report.is_playable():
+        local_logger.error(f"not loading {file_path.name}, {report.describe()}")
+        return
+    if report.is_clean():
+        local_logger.debug(f"loaded {file_path.name}, {report.describe()}")
+    else:
+        local_logger.warning(f"had to fix {file_path.name}, {report.describe()}")
+    stop_playlist_for("loadfile")
+    state.publish_sequence(None, frames, report=report)
 
-    start = time.time()
-    results = pd.read_csv(file_path)
-    results = results.astype(ubyte)
-    end = time.time()
-    local_logger.debug(f"loaded the file to a dataframe and it took {end-start:0.3f}s")
 
-    local_logger.debug(
-        f"loaded the file to a dataframe and it is using {results.memory_usage(deep=True).sum()}b"
+def handle_get_sequence_report(
+    *, send_back, send_queue: queue.Queue, **kwargs
+) -> None:
+    """send back what was fixed when the sequence that is showing was loaded, or null"""
+    change = state.latest_sequence()[1]
+    report = None if change is None or change.report is None else change.report.to_dict()
+    send_queue.put((send_back, json.dumps(report).encode("utf-8")))
+
+
+def handle_stream_begin(*, value: dict, send_back, **kwargs) -> None:
+    """start an upload on this connection, its frames follow as raw sequence messages
+    {"start_frames": int, "crossfade": int, "blend_mode": str}, all optional"""
+    options = value if type(value) == dict else {}
+    stop_playlist_for("stream_begin")
+    sequence_upload.forget_closed_uploads()
+    start_frames = options.get("start_frames")
+    crossfade = options.get("crossfade")
+    sequence_upload.uploads[send_back] = SequenceUpload(
+        config.led_num,
+        config.stream_start_frames if start_frames is None else int(start_frames),
+        None if crossfade is None else int(crossfade),
+        options.get("blend_mode"),
     )
 
-    current_df_sequence = results
-    display_queue.put(current_df_sequence)
+
+def handle_stream_frames(*, value: bytes, send_back, **kwargs) -> None:
+    """the next frames of the upload on this connection"""
+    local_logger = logger.getChild("stream_frames")
+    upload = sequence_upload.uploads.get(send_back)
+    if upload is None:
+        local_logger.warning(f"got {len(value)}b of frames without a stream_begin")
+        return
+    try:
+        upload.add(value)
+    except sequence_binary.SequenceFormatError as e:
+        local_logger.error(f"{e}")
+
+
+def handle_stream_end(
+    *, value: dict, send_back, send_queue: queue.Queue, **kwargs
+) -> None:
+    """the upload is over, {"ok": false} when the sender gave up on it part way.
+    Sends back {"frames": int, "playing": bool, "seconds": float}"""
+    local_logger = logger.getChild("stream_end")
+    complete = not (type(value) == dict and value.get("ok") is False)
+    upload = sequence_upload.uploads.pop(send_back, None)
+    if upload is None:
+        local_logger.warning("there was no upload to end")
+        summary = {"frames": 0, "playing": False, "seconds": 0.0}
+    else:
+        summary = upload.finish(complete)
+        local_logger.info(f"{'finished' if complete else 'abandoned'} {summary}")
+    send_queue.put((send_back, json.dumps(summary).encode("utf-8")))
+
+
+def handle_cluster_sync(
+    *, value: dict, send_back, send_queue: queue.Queue, **kwargs
+) -> None:
+    """a beacon from the cluster coordinator {"time": its clock, "epoch": when frame 0
+    was, "fps": float}. A null epoch leaves the cluster. Sends back where this pi is"""
+    if type(value) != dict or "time" not in value:
+        logger.getChild("cluster_sync").error(f"needed a beacon dict, got {value=}")
+        return
+    reply = cluster_clock.beacon(
+        value["time"], value.get("epoch"), value.get("fps", state.settings.fps)
+    )
+    sequence = state.current_frames()
+    reply["frames"] = 0 if sequence is None else len(sequence)
+    send_queue.put((send_back, json.dumps(reply).encode("utf-8")))
+
+
+def handle_playlist_add(*, value: dict, **kwargs) -> None:
+    """add an item to a playlist. value is the item with an optional "playlist" name"""
+    local_logger = logger.getChild("playlist_add")
+    if type(value) != dict:
+        local_logger.error(f"needed a dict, got {type(value)=}, {value=}")
+        return
+    item_values = dict(value)
+    name = item_values.pop("playlist", None)
+    position = item_values.pop("position", None)
+    item = playlist.PlaylistItem(**item_values)
+    working_playlist = playlist.player.get_playlist(name)
+    with playlist.player.lock:
+        if position is None:
+            working_playlist.items.append(item)
+        else:
+            working_playlist.items.insert(int(position), item)
+        working_playlist.reset_order()
+    local_logger.debug(f"added {item} to {working_playlist.name}")
+
+
+def handle_playlist_remove(*, value: dict, **kwargs) -> None:
+    """remove the item at {"index": int, "playlist": name} from a playlist"""
+    local_logger = logger.getChild("playlist_remove")
+    if type(value) != dict:
+        local_logger.error(f"needed a dict, got {type(value)=}, {value=}")
+        return
+    working_playlist = playlist.player.get_playlist(value.get("playlist"))
+    with playlist.player.lock:
+        index = int(value.get("index", -1))
+        if not 0 <= index < len(working_playlist.items):
+            local_logger.error(f"{index=} is not in {working_playlist.name}")
+            return
+        removed = working_playlist.items.pop(index)
+        working_playlist.reset_order()
+    local_logger.debug(f"removed {removed} from {working_playlist.name}")
+
+
+def handle_playlist_clear(*, value: str, **kwargs) -> None:
+    working_playlist = playlist.player.get_playlist(value or None)
+    with playlist.player.lock:
+        working_playlist.items.clear()
+        working_playlist.position = -1
+        working_playlist.reset_order()
+
+
+def handle_playlist_shuffle(*, value: dict, **kwargs) -> None:
+    """turn shuffle on or off with {"shuffle": bool, "playlist": name}"""
+    if type(value) != dict:
+        logger.getChild("playlist_shuffle").error(f"needed a dict, got {value=}")
+        return
+    working_playlist = playlist.player.get_playlist(value.get("playlist"))
+    with playlist.player.lock:
+        working_playlist.shuffle = bool(value.get("shuffle", True))
+        working_playlist.reset_order()
+
+
+def handle_playlist_play(**kwargs) -> None:
+    playlist.player.enabled = True
+
+
+def handle_playlist_stop(**kwargs) -> None:
+    playlist.player.enabled = False
+
+
+def handle_playlist_next(**kwargs) -> None:
+    playlist.player.skip_requested = True
+
+
+def handle_playlist_schedule(*, value: dict, **kwargs) -> None:
+    """play a playlist between two times of day {"start": "HH:MM", "end": "HH:MM", "playlist": name}"""
+    local_logger = logger.getChild("playlist_schedule")
+    if type(value) != dict:
+        local_logger.error(f"needed a dict, got {type(value)=}, {value=}")
+        return
+    try:
+        window = playlist.ScheduleWindow(
+            playlist.parse_time_of_day(value["start"]),
+            playlist.parse_time_of_day(value["end"]),
+            str(value["playlist"]),
+        )
+    except (KeyError, ValueError) as e:
+        local_logger.error(f"could not make a schedule from {value=}: {e}")
+        return
+    with playlist.player.lock:
+        playlist.player.schedules.append(window)
+    local_logger.debug(f"added {window}")
+
+
+def handle_playlist_clear_schedule(**kwargs) -> None:
+    with playlist.player.lock:
+        playlist.player.schedules.clear()
+
+
+def handle_playlist_save(**kwargs) -> None:
+    playlist.player.save(Path(config.playlist_file))
+
+
+def handle_get_playlist(*, send_back, send_queue: queue.Queue, **kwargs) -> None:
+    data = json.dumps(playlist.player.to_dict()).encode("utf-8")
+    send_queue.put((send_back, data))
+
+
+def handle_get_metrics(*, send_back, send_queue: queue.Queue, **kwargs) -> None:
+    """send back every metric in the Prometheus text format"""
+    data = metrics.registry.render().encode("utf-8")
+    send_queue.put((send_back, data))
 
 
 def toggle_fps(**kwargs) -> None:
-    config.show_fps = not config.show_fps
+    state.update_settings(show_fps=not state.settings.show_fps)
 
 
 def set_stop_event(*, stop_event: threading.Event, **kwargs) -> None:
@@ -236,19 +695,51 @@ def handle_verbose_logging(**kwargs) -> None:
 # this is a comment so that I can push an update; THANKS GIT
 all_commands = {
     "fps": handle_fps,
+    "playback": handle_playback,
     "brightness": handle_brightness,
+    "gamma": handle_gamma,
+    "white_balance": handle_white_balance,
+    "channel_limit": handle_channel_limit,
+    "power_budget": handle_power_budget,
+    "get_power": handle_get_power,
+    "crossfade": handle_crossfade,
     "temp": handle_getting_temp,
     "fill": handle_fill,
     "set_one": handle_one,
+    "plane": handle_plane,
+    "mask": handle_mask,
+    "text": handle_text,
+    "layer": handle_layer_settings,
+    "remove_layer": handle_remove_layer,
+    "clear_layers": handle_clear_layers,
+    "get_layers": handle_get_layers,
     "loadfile": handle_file,
     "get_list_of_files": handle_getting_list_of_files,
+    "get_library": handle_get_library,
     "get_log": handle_get_logs,
     "toggle_fps": toggle_fps,
     "stop": set_stop_event,
     "addlist": handle_add_list,
     "get_current_df": handle_get_current_df,
+    "get_sequence_report": handle_get_sequence_report,
+    "stream_begin": handle_stream_begin,
+    "stream_frames": handle_stream_frames,
+    "stream_end": handle_stream_end,
+    "cluster_sync": handle_cluster_sync,
     "verbose": handle_verbose_logging,
     "get_fps": handle_getting_last_fps,
+    "get_metrics": handle_get_metrics,
+    "playlist_add": handle_playlist_add,
+    "playlist_remove": handle_playlist_remove,
+    "playlist_clear": handle_playlist_clear,
+    "playlist_shuffle": handle_playlist_shuffle,
+    "playlist_play": handle_playlist_play,
+    "playlist_stop": handle_playlist_stop,
+    "playlist_next": handle_playlist_next,
+    "playlist_schedule": handle_playlist_schedule,
+    "playlist_clear_schedule": handle_playlist_clear_schedule,
+    "playlist_save": handle_playlist_save,
+    "get_playlist": handle_get_playlist,
 }
 
 
@@ -259,7 +750,6 @@ def error_func(*args, **kwargs):
 
 def handle_commands(
     command_queue: queue.Queue,
-    display_queue: queue.Queue,
     send_queue: queue.Queue,
     stop_event: threading.Event,
 ) -> None:
@@ -275,7 +765,12 @@ def handle_commands(
                 f"{type(current_request)=} {current_request=} is not of type dict"
             )
             current_request = {"error": "invalid request"}
-        local_logger.debug(f"{current_request=}")
+        if type(current_request.get("args")) == bytes:
+            local_logger.debug(
+                f"{current_request.get('command')} with {len(current_request['args'])}b"
+            )
+        else:
+            local_logger.debug(f"{current_request=}")
 
         target_command = current_request.get("command", "error")
         target_args = current_request.get("args", None)
@@ -283,15 +778,20 @@ def handle_commands(
 
         # cheeky way of doing commands?
         func = all_commands.get(target_command, error_func)
+        start = time.perf_counter()
         try:
             func(
                 send_back=send_back,
                 value=target_args,
-                display_queue=display_queue,
                 send_queue=send_queue,
                 stop_event=stop_event,
             )
         except Exception as e:
+            command_errors.inc()
             local_logger.error(f"{e}")
             pass
+        command_name = target_command if func is not error_func else "error"
+        command_seconds.labels(command=command_name).observe(
+            time.perf_counter() - start
+        )
     local_logger.info("Exiting")
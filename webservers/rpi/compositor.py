@@ -0,0 +1,243 @@
+from typing import Optional
+
+import numpy as np
+
+from frame_buffer import FrameBuffer
+
+# all of the blending is done in uint16 fixed point, where 256 is 1.0
+# a uint8 color times 256 is at most 65280, so nothing here can overflow a uint16
+fixed_one = 256
+blend_modes = ("alpha", "add", "wipe")
+
+
+class PlaybackClock:
+    """How far sequences move through their frames for each frame pushed to the leds.
+
+    Played by frame (the default) every push is the next frame. Played by time, the
+    position comes from the wall clock time each frame will be on the leds, times the
+    sequence fps and the speed, so the leds can be pushed as fast as they go and the
+    sequence still runs at its own pace. One clock is shared by every source, so both
+    sides of a transition move together. Following a cluster, target is the position
+    every source jumps to instead (see cluster_sync.py)"""
+
+    def __init__(self) -> None:
+        self.timed = False
+        self.step = 1.0  # frames of the sequence to move this push
+        self.due: Optional[float] = None  # when the frame being made will be shown
+        self.target: Optional[float] = None
+
+    def reset(self) -> None:
+        """the frames queued for the leds were thrown away, start timing from now"""
+        self.due = None
+
+    def tick(self, now: float, push_fps: float, frames_per_second: float) -> None:
+        """called once before each frame is made. push_fps is how fast the leds are
+        pushed and frames_per_second is how fast the sequence should move through them"""
+        if self.due is None or push_fps <= 0:
+            # nothing queued ahead of this frame, so it is shown about now
+            previous = now - 1.0 / push_fps if push_fps > 0 else now
+            self.due = now
+        else:
+            # a frame goes out every 1/push_fps, unless the leds ran dry while waiting
+            previous = self.due
+            self.due = max(now, self.due + 1.0 / push_fps)
+        self.step = (self.due - previous) * frames_per_second if self.timed else 1.0
+
+
+class FrameSource:
+    """Loops over a (frames, led_num, 3) uint8 array one frame at a time. Given a
+    FrameBuffer, frames added to it get played before it loops back around. With a
+    timed clock it moves clock.step frames each time instead, and a position between
+    two frames is blended from them in uint16 fixed point. A clock target overrides
+    both"""
+
+    def __init__(
+        self, frames: np.ndarray | FrameBuffer, clock: Optional[PlaybackClock] = None
+    ) -> None:
+        self.buffer: Optional[FrameBuffer] = None
+        if isinstance(frames, FrameBuffer):
+            self.buffer = frames
+            frames = frames.view()
+        self.frames = frames
+        self.clock = clock
+        self.index = 0
+        self.position = 0.0  # where a timed clock has got to, index is the frame of it
+        self.last_index = 0
+        # filled in by the power limiter, one fixed point scale per frame
+        self.power_scales: Optional[np.ndarray] = None
+        self.power_ma: Optional[np.ndarray] = None
+        self.power_key: tuple = ()
+        # only made the first time a frame is interpolated
+        self.work_from: Optional[np.ndarray] = None
+        self.work_to: Optional[np.ndarray] = None
+        self.output: Optional[np.ndarray] = None
+
+    def next_frame(self) -> np.ndarray:
+        clock = self.clock
+        if clock is not None and clock.target is not None:
+            self.position = clock.target
+            return self.next_timed_frame(0.0, blend=clock.timed)
+        if clock is not None and clock.timed:
+            return self.next_timed_frame(clock.step)
+        self.last_index = self.index
+        frame = self.frames[self.index]
+        self.index += 1
+        if self.index >= len(self.frames):
+            if self.buffer is not None:
+                self.frames = self.buffer.view()
+            if self.index >= len(self.frames):
+                self.index = 0
+        self.position = float(self.index)
+        return frame
+
+    def next_timed_frame(self, step: float, blend: bool = True) -> np.ndarray:
+        if self.buffer is not None and self.position + 1 >= len(self.frames):
+            # frames may have been added since, which come before looping around
+            self.frames = self.buffer.view()
+        frame_count = len(self.frames)
+        self.position %= frame_count
+        index = min(int(self.position), frame_count - 1)
+        amount = int((self.position - index) * fixed_one) if blend else 0
+        following = index + 1 if index + 1 < frame_count else 0
+        self.index = index
+        self.position += max(step, 0.0)
+        if amount == 0:
+            self.last_index = index
+            return self.frames[index]
+
+        # a blend of two frames draws no more than the brighter one does
+        self.last_index = index
+        if self.power_ma is not None and following < len(self.power_ma):
+            if self.power_ma[following] > self.power_ma[index]:
+                self.last_index = following
+        return self.interpolate(self.frames[index], self.frames[following], amount)
+
+    def interpolate(
+        self, from_frame: np.ndarray, to_frame: np.ndarray, amount: int
+    ) -> np.ndarray:
+        if self.output is None or self.output.shape != from_frame.shape:
+            self.work_from = np.zeros(from_frame.shape, dtype=np.uint16)
+            self.work_to = np.zeros(from_frame.shape, dtype=np.uint16)
+            self.output = np.zeros(from_frame.shape, dtype=np.uint8)
+        # copied in first, multiplying the uint8 frames straight into uint16 casts them
+        # through a temporary
+        np.copyto(self.work_from, from_frame)
+        np.copyto(self.work_to, to_frame)
+        np.multiply(self.work_from, fixed_one - amount, out=self.work_from)
+        np.multiply(self.work_to, amount, out=self.work_to)
+        np.add(self.work_from, self.work_to, out=self.work_from)
+        np.right_shift(self.work_from, 8, out=self.work_from)
+        np.copyto(self.output, self.work_from, casting="unsafe")
+        return self.output
+
+
+def wipe_order_from_coordinates(
+    coordinates: Optional[np.ndarray], led_num: int, axis: int = 2
+) -> np.ndarray:
+    """Fixed point position (0-256) of every led along one axis of the GIFT coordinates.
+    Without coordinates the wipe runs along the strip instead."""
+    if coordinates is None or len(coordinates) < led_num:
+        position = np.arange(led_num, dtype=np.float64)
+    else:
+        position = coordinates[:led_num, axis].astype(np.float64)
+    span = position.max() - position.min()
+    if span == 0:
+        span = 1.0
+    scaled = (position - position.min()) / span * fixed_one
+    return scaled.astype(np.int32).reshape(led_num, 1)
+
+
+class Compositor:
+    """Blend two frames together with preallocated buffers so nothing is allocated per frame"""
+
+    def __init__(
+        self, led_num: int, wipe_order: Optional[np.ndarray] = None, wipe_edge: int = 32
+    ) -> None:
+        shape = (led_num, 3)
+        self.work_from = np.zeros(shape, dtype=np.uint16)
+        self.work_to = np.zeros(shape, dtype=np.uint16)
+        self.output = np.zeros(shape, dtype=np.uint8)
+        self.led_weight = np.zeros((led_num, 1), dtype=np.uint16)
+        self.led_weight_inverse = np.zeros((led_num, 1), dtype=np.uint16)
+        self.wipe_work = np.zeros((led_num, 1), dtype=np.int32)
+        if wipe_order is None:
+            wipe_order = wipe_order_from_coordinates(None, led_num)
+        self.wipe_order = wipe_order
+        self.wipe_edge = max(int(wipe_edge), 1)
+
+    def alpha(self, from_frame: np.ndarray, to_frame: np.ndarray, amount: int) -> None:
+        np.multiply(from_frame, fixed_one - amount, out=self.work_from, dtype=np.uint16)
+        np.multiply(to_frame, amount, out=self.work_to, dtype=np.uint16)
+        np.add(self.work_from, self.work_to, out=self.work_from)
+        np.right_shift(self.work_from, 8, out=self.work_from)
+
+    def add(self, from_frame: np.ndarray, to_frame: np.ndarray, amount: int) -> None:
+        # the new frame ramps up over the first half while the old one is still at
+        # full strength, then the old one ramps down over the second half
+        from_scale = min(2 * (fixed_one - amount), fixed_one)
+        to_scale = min(2 * amount, fixed_one)
+        np.multiply(from_frame, from_scale, out=self.work_from, dtype=np.uint16)
+        np.multiply(to_frame, to_scale, out=self.work_to, dtype=np.uint16)
+        np.right_shift(self.work_from, 8, out=self.work_from)
+        np.right_shift(self.work_to, 8, out=self.work_to)
+        np.add(self.work_from, self.work_to, out=self.work_from)
+        np.minimum(self.work_from, 255, out=self.work_from)
+
+    def wipe(self, from_frame: np.ndarray, to_frame: np.ndarray, amount: int) -> None:
+        # the edge sweeps from below the lowest led to past the highest one
+        sweep = amount * (fixed_one + self.wipe_edge) // fixed_one
+        np.subtract(sweep, self.wipe_order, out=self.wipe_work)
+        np.multiply(self.wipe_work, fixed_one // self.wipe_edge, out=self.wipe_work)
+        np.clip(self.wipe_work, 0, fixed_one, out=self.wipe_work)
+        np.copyto(self.led_weight, self.wipe_work, casting="unsafe")
+        np.subtract(fixed_one, self.led_weight, out=self.led_weight_inverse)
+        np.multiply(
+            from_frame, self.led_weight_inverse, out=self.work_from, dtype=np.uint16
+        )
+        np.multiply(to_frame, self.led_weight, out=self.work_to, dtype=np.uint16)
+        np.add(self.work_from, self.work_to, out=self.work_from)
+        np.right_shift(self.work_from, 8, out=self.work_from)
+
+    def blend(
+        self, from_frame: np.ndarray, to_frame: np.ndarray, amount: int, mode: str
+    ) -> np.ndarray:
+        """amount is fixed point, 0 is all from_frame and 256 is all to_frame"""
+        amount = min(max(int(amount), 0), fixed_one)
+        if mode == "add":
+            self.add(from_frame, to_frame, amount)
+        elif mode == "wipe":
+            self.wipe(from_frame, to_frame, amount)
+        else:
+            self.alpha(from_frame, to_frame, amount)
+        np.copyto(self.output, self.work_from, casting="unsafe")
+        return self.output
+
+
+class Transition:
+    """Plays two sources at once and blends from one to the other over a number of frames"""
+
+    def __init__(
+        self,
+        outgoing: FrameSource,
+        incoming: FrameSource,
+        frames: int,
+        mode: str,
+        compositor: Compositor,
+    ) -> None:
+        self.outgoing = outgoing
+        self.incoming = incoming
+        self.frames = max(int(frames), 1)
+        self.mode = mode if mode in blend_modes else "alpha"
+        self.compositor = compositor
+        self.step = 0
+
+    @property
+    def done(self) -> bool:
+        return self.step >= self.frames
+
+    def next_frame(self) -> np.ndarray:
+        self.step += 1
+        amount = self.step * fixed_one // (self.frames + 1)
+        return self.compositor.blend(
+            self.outgoing.next_frame(), self.incoming.next_frame(), amount, self.mode
+        )
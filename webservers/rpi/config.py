@@ -1,20 +1,56 @@
-from io import StringIO
+import os
 
 
+# what the pi boots with, once running these live in shared_state.state.settings
 fps: float = 10
 show_fps: bool = False
+# played by time the leds are pushed at max_push_fps and the sequence moves at
+# fps * playback_speed, blending between frames, instead of a frame per push
+timed_playback: bool = False
+playback_speed: float = 1.0
+max_push_fps: float = 60  # about what 500 ws281x leds can be refreshed at
 frame_rate_arr: list[float] = []
 
 
 host: str = "192.168.2.39"
 rx_port: int = 12345
 tx_port: int = 12346
-log_capture: StringIO = StringIO()
+log_capture = None  # the RingBufferHandler that main.py puts on the root logger
+log_capture_records: int = 5000
+
+coordinates_file: str = "/home/pi/github/xmastree2023/coords_2021.csv"
+crossfade_frames: int = 0  # used when switching without the playlist
+blend_mode: str = "alpha"
+wipe_axis: str = "z"  # which GIFT axis a wipe transition sweeps along
+
+playlist_file: str = "/home/pi/github/xmastree2023/playlist.json"
+sequence_folder: str = "/home/pi/github/xmastree2023/examples"
+# what is known about every sequence in sequence_folder, see library.py
+library_index_file: str = "/home/pi/github/xmastree2023/library.sqlite"
 
 
 led_num: int = 500
 led_pin: int = 12
-brightness: float = 1.0
-pixels = {}  # I dont like this
-current_dataframe = {}  # I dont like this
-fast_array = {}  # I dont like this
+# to push more leds at the same frame rate, split them over strips on their own pins
+# that are pushed at the same time. Each entry takes the next count leds, e.g.
+# [{"count": 250, "pin": 18, "dma": 10},
+#  {"count": 250, "pin": 10, "dma": 11, "reverse": True}]
+# pin 18 is PWM, 10 is SPI and 21 is PCM, each of those can drive one strip. The two
+# PWM channels (pins 12/18 and 13/19) can not be split up this way, every strip sets
+# up the PWM block on its own. Empty is the one strip on led_pin
+led_segments: list[dict] = []
+# ws281x, neopixel or simulated (an in memory strip for running off the pi)
+led_backend: str = os.environ.get("LED_BACKEND", "ws281x")
+display_process: bool = True  # push to the leds from a separate process
+# frames the renderer can get ahead of the leds. Rendering shares the GIL with the
+# rest of the control process, so this is how long that can hold it (like a library
+# refresh loading csvs) before the leds go without, 32 is about 0.5s at max_push_fps
+frame_ring_slots: int = 32
+stream_start_frames: int = 25  # frames of an upload that arrive before it plays
+brightness: float = 1.0  # boot value, see shared_state
+gamma: float = 1.0
+white_balance: list[float] = [1.0, 1.0, 1.0]  # red, green, blue multipliers
+channel_limit: int = 255  # highest value any one channel is allowed to reach
+power_budget_ma: float = 10_000  # what the power supply can give the leds, 0 is no limit
+ma_per_channel: float = 20.0  # current of one color channel at full brightness
+idle_ma_per_led: float = 1.0  # current of an led that is turned off
@@ -3,98 +3,86 @@ import pandas as pd
 import numpy as np
 import time
 import threading
-import queue
+import multiprocessing
+from multiprocessing.connection import Connection
+from multiprocessing.process import BaseProcess
 
 import config
-from common.file_parser import grb_to_int
+from shared_state import SequenceChange, SharedState, state as shared_state
+from compositor import (
+    Compositor,
+    FrameSource,
+    PlaybackClock,
+    Transition,
+    wipe_order_from_coordinates,
+)
+from layers import layer_stack, load_led_coordinates
+from color_correction import color_correction
+from power_limiter import power_limiter
+from cluster_sync import ClusterClock, cluster_clock as shared_cluster_clock
+from led_backends import LedBackend, create_backend, pack_frame
+import frame_ring
+from frame_ring import FrameRing
 from common.common_objects import (
     all_standard_column_names,
     setup_common_logger,
-    sanitize_column_names,
+    RateLimitedLog,
 )
-
-# used for pushing the data out
-# https://github.com/rpi-ws281x/rpi-ws281x-python/blob/master/library/rpi_ws281x/rpi_ws281x.py
-# https://github.com/richardghirst/rpi_ws281x/blob/master/ws2811.c
-from rpi_ws281x import Color, PixelStrip, ws, RGBW
+from common import metrics
+from common.sequence_validation import normalize_sequence
 
 
 logger = logging.getLogger("display")
 logger = setup_common_logger(logger)
 column_names = all_standard_column_names(config.led_num)
 
+frames_shown = metrics.counter("display_frames_total", "Frames pushed to the leds")
+late_frames = metrics.counter(
+    "display_late_frames_total", "Frames that took longer than 1/fps to pack and push"
+)
+sequence_changes = metrics.counter(
+    "display_sequence_changes_total", "Times the display switched to a new sequence"
+)
+render_seconds = metrics.histogram(
+    "display_render_seconds", "Time to build a frame and put it in the ring"
+)
+pack_seconds = metrics.histogram(
+    "display_pack_seconds", "Time to load a frame into the strip"
+)
+push_seconds = metrics.histogram("display_push_seconds", "Time to push a frame out")
+sleep_seconds = metrics.histogram(
+    "display_sleep_seconds", "Time spent waiting for the next frame"
+)
+actual_fps = metrics.gauge("display_fps", "Frame rate of the last frame")
+ring_depth = metrics.gauge("display_ring_depth", "Frames rendered and waiting to go out")
+ring_underruns = metrics.counter(
+    "display_ring_underruns_total", "Times the output was ready before the next frame"
+)
+
 
-def setup() -> PixelStrip:
+def setup(backend_name: str | None = None) -> LedBackend:
     # set up the leds
-    LED_FREQ_HZ = 800000  # LED signal frequency in hertz (usually 800khz)
-    LED_DMA = 10  # DMA channel to use for generating signal (try 10)
-    LED_BRIGHTNESS = 255  # Set to 0 for darkest and 255 for brightest
-    LED_INVERT = (
-        False  # True to invert the signal (when using NPN transistor level shift)
-    )
-    LED_CHANNEL = 0
-    # LED_STRIP = ws.SK6812_STRIP_RGBW
-    LED_STRIP = ws.WS2811_STRIP_GRB
-
-    pixels = PixelStrip(
-        config.led_num,
-        config.led_pin,
-        LED_FREQ_HZ,
-        LED_DMA,
-        LED_INVERT,
-        LED_BRIGHTNESS,
-        LED_CHANNEL,
-        LED_STRIP,
-    )
+    if backend_name is None:
+        backend_name = config.led_backend
+    pixels = create_backend(backend_name)
     pixels.begin()
-    pixels[0 : config.led_num] = 0
-    pixels.show()
-
-    config.frame_rate_arr = np.zeros(1000, dtype=np.float64)
-
-    config.pixels = pixels
+    logger.getChild("setup").info(f"using the {pixels.name} led backend")
     return pixels
 
 
-def convert_row_to_color(
-    input_row: list[int], number_of_columns: int = 1500
-) -> list[RGBW]:
-    return_list = [0] * (number_of_columns // 3)
-    for pixel_num in range(0, number_of_columns, 3):
-        led_pixel_index = pixel_num // 3
-        led_pixel_color = grb_to_int(
-            input_row[pixel_num], input_row[pixel_num + 1], input_row[pixel_num + 2]
-        )
-        return_list[led_pixel_index] = RGBW(led_pixel_color)
-    return return_list
-
-
-def convert_df_to_list_of_int_speedy(input_df: pd.DataFrame) -> list[list[int]]:
-    local_logger = logger.getChild("df_2_int")
+def convert_df_to_frames(input_df: pd.DataFrame) -> np.ndarray:
+    """convert a sequence dataframe to a (frames, led_num, 3) array of RGB bytes"""
+    local_logger = logger.getChild("df_2_frames")
     local_logger.debug("starting conversion")
     start_time = time.time()
-    working_df = input_df.copy(deep=True)
-    time_2 = time.time()
-    working_df = sanitize_column_names(working_df)
-    working_df.reindex(column_names, axis=1)
-    time_3 = time.time()
-    raw_data = working_df.to_numpy(dtype=np.ubyte)
-    raw_data = raw_data.astype(dtype=np.ubyte)
-    time_4 = time.time()
-
-    results = np.apply_along_axis(convert_row_to_color, 1, raw_data)
-    returned_list = results.tolist()
+    frames, report = normalize_sequence(input_df, config.led_num)
     end_time = time.time()
+    if not report.is_clean():
+        local_logger.warning(f"had to fix the sequence, {report.describe()}")
 
-    copy_time = time_2 - start_time
-    clean_time = time_3 - time_2
-    unit_change_time = time_4 - time_3
-    enumerate_time = end_time - time_4
-    total_time = end_time - start_time
-
-    # Benchmark
+    # Benchmark (per pixel python loops, before reshaping the whole array at once)
     # copy:0.01650 clean:0.04447 types:0.00295 looping:7.64509 total:7.70900
-    # after cashing the grb_to_int function
+    # after cashing the grb_to_int function (since replaced by common/colors.py)
     # copy:0.01680 clean:0.04479 types:0.00313 looping:3.85402 total:3.91874
     # after using numpy apply along axis
     # copy:0.01663 clean:0.04498 types:0.00311 looping:11.00467 total:11.06938
@@ -105,71 +93,317 @@ def convert_df_to_list_of_int_speedy(input_df: pd.DataFrame) -> list[list[int]]:
     # using np.apply_along_axis for frames and looping for rows and casheing all the colors
     # copy:0.01617 clean:0.04324 types:0.00275 looping:2.50638 total:2.56854
 
-    # using the np.apply_along_axis for rows and cashed looping ints as that seems to cleanest/fastest combo
+    local_logger.debug(f"total:{end_time-start_time:0.5f}")
+    return frames
 
-    local_logger.debug(
-        f"copy:{copy_time:0.5f} clean:{clean_time:0.5f} types:{unit_change_time:0.5f} looping:{enumerate_time:0.5f} total:{total_time:0.5f}"
-    )
 
-    return returned_list
+def load_wipe_order() -> np.ndarray:
+    # without coordinates this wipes along the strip
+    axis = "xyz".index(config.wipe_axis)
+    return wipe_order_from_coordinates(load_led_coordinates(), config.led_num, axis)
 
 
-def show_data_on_leds(stop_event: threading.Event, display_queue: queue.Queue) -> None:
-    global pixels
+class OutputStats:
+    """Copies what the output stage wrote into the ring over to the metrics and the fps
+    history here, since the output may be in another process"""
+
+    def __init__(self, ring: FrameRing) -> None:
+        self.ring = ring
+        self.frames = 0
+        self.late = 0
+        self.underruns = 0
+
+    def update(self) -> None:
+        counters = self.ring.counters
+        shown = int(counters[frame_ring.FRAMES_SHOWN])
+        if shown == self.frames:
+            return
+        late = int(counters[frame_ring.LATE_FRAMES])
+        underruns = int(counters[frame_ring.UNDERRUNS])
+        frames_shown.inc(shown - self.frames)
+        late_frames.inc(late - self.late)
+        ring_underruns.inc(underruns - self.underruns)
+        self.frames, self.late, self.underruns = shown, late, underruns
+
+        # only the last frame is known, so the histograms get one sample per update
+        stats = self.ring.stats
+        pack_seconds.observe(float(stats[frame_ring.LOAD_SECONDS]))
+        push_seconds.observe(float(stats[frame_ring.PUSH_SECONDS]))
+        sleep_seconds.observe(float(stats[frame_ring.SLEEP_SECONDS]))
+        fps = float(stats[frame_ring.FPS])
+        actual_fps.set(fps)
+        ring_depth.set(self.ring.queued())
+        config.frame_rate_arr = np.roll(config.frame_rate_arr, 1)
+        config.frame_rate_arr[0] = fps
+
+    def describe(self) -> str:
+        stats = self.ring.stats
+        return (
+            f"Loading Array:{stats[frame_ring.LOAD_SECONDS]:.3f}s "
+            f"Pushing Pixels:{stats[frame_ring.PUSH_SECONDS]:.3f}s "
+            f"sleeping:{stats[frame_ring.SLEEP_SECONDS]:.3f}s "
+            f"actual_FPS:{stats[frame_ring.FPS]:.3f}"
+        )
+
+
+def start_transition(
+    change: SequenceChange,
+    transition: Transition | None,
+    source: FrameSource,
+    new_source: FrameSource,
+    compositor: Compositor,
+) -> Transition | None:
+    """the fade to a new sequence, None to cut straight to it"""
+    if change.crossfade_frames <= 0:
+        return None
+    # fading out whatever is on screen right now, even mid transition
+    outgoing = transition if transition is not None else source
+    return Transition(
+        outgoing,
+        new_source,
+        change.crossfade_frames,
+        change.blend_mode,
+        compositor,
+    )
+
+
+def render_frames(
+    stop_event: threading.Event,
+    ring: FrameRing,
+    control: Connection,
+    state: SharedState = shared_state,
+    cluster_clock: ClusterClock = shared_cluster_clock,
+) -> None:
+    """Build every frame (sequence, transition, layers, color correction and the power
+    limit) and hand it to the output stage through the ring, as far ahead as the ring
+    has room for. The frame rate and skips are sent to the output over control"""
+    config.frame_rate_arr = np.zeros(1000, dtype=np.float64)
     local_logger = logger.getChild("running")
     local_logger.info("Starting")
+    # one line a second is plenty, every frame would swamp the log
+    fps_log = RateLimitedLog(1.0)
+    output_stats = OutputStats(ring)
     data = [100, 0, 0] * config.led_num
     working_df = pd.DataFrame([data], index=range(1), columns=column_names)
-    fast_array = convert_df_to_list_of_int_speedy(working_df)
-    config.fast_array = fast_array
-    led_amount = int(config.led_num)
+    # every source shares it, played by time it says how far they move each push
+    clock = PlaybackClock()
+    source = FrameSource(convert_df_to_frames(working_df), clock)
+    power_limiter.precompute(source)
+    transition: Transition | None = None
+    compositor = Compositor(config.led_num, load_wipe_order())
+    pack_work = np.zeros((config.led_num, 3), dtype=np.uint32)
+    shown_version = 0
+    sent_settings = None
+    rendered_with: tuple = ()
+    synced_epoch = cluster_clock.epoch
+    # set when what is queued in the ring is out of date, the next frame skips over it
+    skip_queued = False
 
     while not stop_event.is_set():
-        if not display_queue.empty():
-            try:
-                working_df: pd.DataFrame = display_queue.get()
-                config.current_dataframe = working_df
-                # working_df = working_df.mul(config.brightness)
-                local_logger.info("Changing to new df")
-                fast_array = convert_df_to_list_of_int_speedy(working_df)
-                # config.fast_array = fast_array
-            except queue.Empty as e:
-                pass
-        # fast_array = config.fast_array
-        for row in fast_array:
-            if stop_event.is_set() or not display_queue.empty():
-                break
-            time1 = time.time()
-            for led_pixel_index in range(led_amount):
-                pixels[led_pixel_index] = row[led_pixel_index]
-            time2 = time.time()
-            pixels.show()
-            time3 = time.time()
-            loop_time = time3 - time1
-            fps_time = 1.0 / config.fps
-            sleep_time = fps_time - loop_time
-            if sleep_time < 0:
-                sleep_time = 0
-            while config.fps == 0:
-                time.sleep(0.5)
+        version, change = state.latest_sequence()
+        if version != shown_version and change is not None:
+            # only the newest sequence matters, anything published in between is skipped
+            shown_version = version
+            sequence_changes.inc()
+            local_logger.info("Changing to new df")
+            frames = change.frames
+            if frames is None:
+                frames = convert_df_to_frames(change.dataframe)
+            new_source = FrameSource(frames, clock)
+            if change.keep_position and transition is None:
+                # the same frames with more added, so what is in the ring is still
+                # right and only the added frames need their power estimated
+                new_source.index = source.index % len(new_source.frames)
+                new_source.position = source.position % len(new_source.frames)
+                new_source.power_ma = source.power_ma
+                new_source.power_scales = source.power_scales
+                new_source.power_key = source.power_key
+                power_limiter.precompute(new_source)
+                source = new_source
             else:
-                time.sleep(sleep_time)
-            time4 = time.time()
-
-            total_time = time4 - time1
-            total_fps = 1 / total_time
-            config.frame_rate_arr = np.roll(config.frame_rate_arr, 1)
-            config.frame_rate_arr[0] = total_fps
-            # Loading Array:0.034s Pushing Pixels:0.018s sleeping:0.000s actual_FPS:19.146
-            # Loading Array:0.007s Pushing Pixels:0.019s sleeping:0.000s actual_FPS:38.318
-            if config.show_fps:
-                packing_the_pixels = time2 - time1
-                pushing_the_pixels = time3 - time2
-                sleeping_time = time4 - time3
-                local_logger.debug(
-                    f"Loading Array:{packing_the_pixels:.3f}s Pushing Pixels:{pushing_the_pixels:.3f}s sleeping:{sleeping_time:.3f}s actual_FPS:{total_fps:.3f}"
+                power_limiter.precompute(new_source)
+                transition = start_transition(
+                    change, transition, source, new_source, compositor
                 )
+                source = new_source
+                skip_queued = True
+        settings = state.settings
+        if settings is not sent_settings:
+            control.send(("fps", settings.push_fps()))
+            clock.timed = settings.timed_playback
+            sent_settings = settings
+            skip_queued = True
+        current_look = (
+            layer_stack.prepared,
+            color_correction.version,
+            power_limiter.version,
+        )
+        if any(now is not then for now, then in zip(current_look, rendered_with)):
+            skip_queued = True
+        rendered_with = current_look
+        if cluster_clock.epoch != synced_epoch:
+            # joined or left a cluster, what is queued was made for the old clock
+            synced_epoch = cluster_clock.epoch
+            skip_queued = True
+
+        output_stats.update()
+        if settings.show_fps and fps_log.ready():
+            local_logger.debug(
+                f"{output_stats.describe()} ({fps_log.take_skipped()} frames not logged)"
+            )
+
+        slot = ring.writable_slot()
+        if slot is None:
+            # the output is a whole ring behind, wait for it or for something to change
+            push_fps = settings.push_fps()
+            wait = min(1.0 / push_fps, 0.05) if push_fps else 0.05
+            state.wait_for_change(wait)
+            continue
+
+        time1 = time.perf_counter()
+        if skip_queued:
+            # what is queued is about to be skipped, so this frame is the next shown
+            clock.reset()
+        clock.tick(time1, settings.push_fps(), settings.sequence_fps())
+        clock.target = cluster_clock.position_at(clock.due)  # type: ignore
+        # the source the frame came straight out of, so its precomputed power can be used
+        unchanged_source: FrameSource | None = None
+        if transition is not None:
+            frame = transition.next_frame()
+            if transition.done:
+                transition = None
+        else:
+            frame = source.next_frame()
+            unchanged_source = source
+        layered_frame = layer_stack.apply(frame)
+        if layered_frame is not frame:
+            unchanged_source = None
+        frame = color_correction.apply(layered_frame)
+        if unchanged_source is not None and not power_limiter.is_current(
+            unchanged_source
+        ):
+            # brightness or the budget changed since this sequence was loaded
+            power_limiter.precompute(unchanged_source)
+        frame = power_limiter.limit(frame, unchanged_source)
+        pack_frame(frame, slot, pack_work)
+        position = ring.commit()
+        if skip_queued:
+            control.send(("skip_to", position))
+            skip_queued = False
+        render_seconds.observe(time.perf_counter() - time1)
+    local_logger.info("Exiting")
+
+
+def output_frames(ring: FrameRing, control: Connection, pixels: LedBackend) -> None:
+    """Push frames out of the ring to the leds at the frame rate. It only talks to the
+    renderer through the ring and control, so it can run in its own process where
+    nothing else competes with it for the GIL. Paused until the first fps arrives"""
+    local_logger = logger.getChild("output")
+    local_logger.info("Starting")
+    counters = ring.counters
+    stats = ring.stats
+    fps = 0.0
+    running = True
+    starved = False
+
+    def handle_message() -> str:
+        nonlocal fps, running
+        name, value = control.recv()
+        if name == "fps":
+            fps = float(value)
+        elif name == "skip_to":
+            ring.skip_to(int(value))
+        elif name == "stop":
+            running = False
+        return name
+
+    while running:
+        while control.poll():
+            handle_message()
+        if not running:
+            break
+        if fps <= 0:
+            control.poll(0.5)
+            continue
+
+        time1 = time.perf_counter()
+        frame = ring.readable_slot()
+        if frame is None:
+            # the renderer fell behind, the leds keep showing the last frame
+            if not starved:
+                counters[frame_ring.UNDERRUNS] += 1
+                starved = True
+            control.poll(0.001)
+            continue
+        starved = False
+        pixels.load_packed(frame)
+        ring.release()
+        time2 = time.perf_counter()
+        pixels.show()
+        time3 = time.perf_counter()
+
+        next_frame_time = time1 + 1.0 / fps
+        if time3 > next_frame_time:
+            counters[frame_ring.LATE_FRAMES] += 1
+        # the pipe doubles as the sleep, so a skip or stop cuts it short
+        while running and (remaining := next_frame_time - time.perf_counter()) > 0:
+            if control.poll(remaining) and handle_message() == "skip_to":
+                break
+        time4 = time.perf_counter()
+
+        stats[frame_ring.LOAD_SECONDS] = time2 - time1
+        stats[frame_ring.PUSH_SECONDS] = time3 - time2
+        stats[frame_ring.SLEEP_SECONDS] = time4 - time3
+        stats[frame_ring.FPS] = 1.0 / (time4 - time1)
+        counters[frame_ring.FRAMES_SHOWN] += 1
     local_logger.info("Exiting")
 
 
-pixels = setup()
+def run_output_process(
+    ring_name: str, slots: int, led_num: int, control: Connection, backend_name: str
+) -> None:
+    """entry point of the display process"""
+    ring = FrameRing.attach(ring_name, slots, led_num)
+    try:
+        output_frames(ring, control, setup(backend_name))
+    finally:
+        ring.close()
+
+
+def show_data_on_leds(
+    stop_event: threading.Event,
+    pixels: LedBackend | None = None,
+    state: SharedState = shared_state,
+) -> None:
+    """Render frames in this thread and push them from a display process. When given a
+    backend that lives in this process (like the simulated strip) the output runs in
+    a thread instead"""
+    ring = FrameRing.create(config.frame_ring_slots, config.led_num)
+    control, output_end = multiprocessing.Pipe()
+    output: threading.Thread | BaseProcess
+    if pixels is None and config.display_process:
+        # spawn, since forking with the other threads running can copy held locks
+        output = multiprocessing.get_context("spawn").Process(
+            target=run_output_process,
+            args=(ring.name, ring.slots, ring.led_num, output_end, config.led_backend),
+            name="display_output",
+            daemon=True,
+        )
+    else:
+        if pixels is None:
+            pixels = setup()
+        output = threading.Thread(
+            target=output_frames, args=(ring, output_end, pixels), name="display_output"
+        )
+    output.start()
+    try:
+        render_frames(stop_event, ring, control, state)
+    finally:
+        control.send(("stop", None))
+        if isinstance(output, BaseProcess):
+            output.join(timeout=5)
+            if output.is_alive():
+                output.terminate()
+        else:
+            output.join()
+        ring.close()
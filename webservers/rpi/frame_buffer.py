@@ -0,0 +1,48 @@
+import threading
+
+import numpy as np
+
+
+class FrameBuffer:
+    """(frames, led_num, 3) uint8 frames that can be added to while they play.
+
+    When it runs out of room the storage doubles, so adding a frame is amortised O(1).
+    A new storage array is filled in before it is swapped in and the count goes up
+    last, so a reader that takes the count and then the storage (which view() does)
+    never sees a frame that is not there yet."""
+
+    def __init__(self, led_num: int, capacity: int = 64) -> None:
+        self.led_num = led_num
+        self.lock = threading.Lock()
+        self.storage = np.zeros((max(capacity, 1), led_num, 3), dtype=np.uint8)
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    @property
+    def capacity(self) -> int:
+        return len(self.storage)
+
+    def append(self, frames: np.ndarray) -> int:
+        """add (n, led_num, 3) frames, or a single (led_num, 3) frame. Returns the count"""
+        if frames.ndim == 2:
+            frames = frames.reshape(1, self.led_num, 3)
+        with self.lock:
+            start = self.count
+            end = start + len(frames)
+            if end > len(self.storage):
+                capacity = len(self.storage)
+                while capacity < end:
+                    capacity *= 2
+                grown = np.zeros((capacity, self.led_num, 3), dtype=np.uint8)
+                grown[:start] = self.storage[:start]
+                self.storage = grown
+            self.storage[start:end] = frames
+            self.count = end
+        return end
+
+    def view(self) -> np.ndarray:
+        """every frame added so far, without copying"""
+        count = self.count
+        return self.storage[:count]
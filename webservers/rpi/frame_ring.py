@@ -0,0 +1,114 @@
+from multiprocessing import shared_memory
+from typing import Optional
+
+import numpy as np
+
+
+# slots in the int64 counters at the start of the block
+HEAD = 0  # frames the renderer has written, only the renderer changes it
+TAIL = 1  # frames the output has used up, only the output changes it
+FRAMES_SHOWN = 2
+LATE_FRAMES = 3
+UNDERRUNS = 4  # times the output was ready for a frame and the ring was empty
+counter_count = 8
+
+# slots in the float64 stats the output fills in about the last frame it showed
+LOAD_SECONDS = 0
+PUSH_SECONDS = 1
+SLEEP_SECONDS = 2
+FPS = 3
+stat_count = 8
+
+
+class FrameRing:
+    """A fixed number of frames in shared memory, written by one renderer and read by
+    one output stage, which can be in another process. Each slot is a (led_num,)
+    uint32 frame already packed the way the strip wants it (see pack_frame), so
+    nothing is converted or allocated between the ring and the leds.
+
+    head and tail only ever count up, frame n lives in slot n % slots. The renderer
+    only writes head and the output only writes tail, so neither needs a lock."""
+
+    def __init__(
+        self, memory: shared_memory.SharedMemory, slots: int, led_num: int, owner: bool
+    ) -> None:
+        self.memory = memory
+        self.slots = slots
+        self.led_num = led_num
+        self.owner = owner
+        offset = 0
+        self.counters = np.ndarray(
+            (counter_count,), dtype=np.int64, buffer=memory.buf, offset=offset
+        )
+        offset += self.counters.nbytes
+        self.stats = np.ndarray(
+            (stat_count,), dtype=np.float64, buffer=memory.buf, offset=offset
+        )
+        offset += self.stats.nbytes
+        self.frames = np.ndarray(
+            (slots, led_num), dtype=np.uint32, buffer=memory.buf, offset=offset
+        )
+
+    @staticmethod
+    def size_for(slots: int, led_num: int) -> int:
+        return counter_count * 8 + stat_count * 8 + slots * led_num * 4
+
+    @classmethod
+    def create(cls, slots: int, led_num: int) -> "FrameRing":
+        memory = shared_memory.SharedMemory(create=True, size=cls.size_for(slots, led_num))
+        ring = cls(memory, slots, led_num, owner=True)
+        ring.counters[:] = 0
+        ring.stats[:] = 0
+        return ring
+
+    @classmethod
+    def attach(cls, name: str, slots: int, led_num: int) -> "FrameRing":
+        """open a ring that another process created"""
+        # a spawned child shares the creator's resource tracker, so opening it here
+        # does not make anything else responsible for unlinking it
+        memory = shared_memory.SharedMemory(name=name)
+        return cls(memory, slots, led_num, owner=False)
+
+    @property
+    def name(self) -> str:
+        return self.memory.name
+
+    def queued(self) -> int:
+        return int(self.counters[HEAD] - self.counters[TAIL])
+
+    def writable_slot(self) -> Optional[np.ndarray]:
+        """the slot for the next frame, None when the output has not caught up yet"""
+        head = int(self.counters[HEAD])
+        if head - int(self.counters[TAIL]) >= self.slots:
+            return None
+        return self.frames[head % self.slots]
+
+    def commit(self) -> int:
+        """hand the frame written into writable_slot to the output, returns its number"""
+        position = int(self.counters[HEAD])
+        self.counters[HEAD] = position + 1
+        return position
+
+    def readable_slot(self) -> Optional[np.ndarray]:
+        tail = int(self.counters[TAIL])
+        if tail >= int(self.counters[HEAD]):
+            return None
+        return self.frames[tail % self.slots]
+
+    def release(self) -> None:
+        """the output is done with the frame from readable_slot"""
+        self.counters[TAIL] += 1
+
+    def skip_to(self, position: int) -> None:
+        """drop every frame before position, output side only"""
+        tail = int(self.counters[TAIL])
+        position = min(position, int(self.counters[HEAD]))
+        if position > tail:
+            self.counters[TAIL] = position
+
+    def close(self) -> None:
+        # the arrays have to go before the buffer under them can be closed
+        del self.counters, self.stats, self.frames
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
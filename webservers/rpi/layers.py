@@ -0,0 +1,243 @@
+import logging
+import threading
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+import config
+from common.common_objects import setup_common_logger
+from common.file_parser import read_GIFT_array
+from compositor import fixed_one
+
+
+logger = logging.getLogger("layers")
+logger = setup_common_logger(logger)
+
+
+# 3 wide by 5 tall, one string per row, read left to right
+small_font: dict[str, tuple[str, ...]] = {
+    " ": ("000", "000", "000", "000", "000"),
+    "0": ("111", "101", "101", "101", "111"),
+    "1": ("010", "110", "010", "010", "111"),
+    "2": ("111", "001", "111", "100", "111"),
+    "3": ("111", "001", "111", "001", "111"),
+    "4": ("101", "101", "111", "001", "001"),
+    "5": ("111", "100", "111", "001", "111"),
+    "6": ("111", "100", "111", "101", "111"),
+    "7": ("111", "001", "010", "010", "010"),
+    "8": ("111", "101", "111", "101", "111"),
+    "9": ("111", "101", "111", "001", "111"),
+    "A": ("010", "101", "111", "101", "101"),
+    "B": ("110", "101", "110", "101", "110"),
+    "C": ("011", "100", "100", "100", "011"),
+    "D": ("110", "101", "101", "101", "110"),
+    "E": ("111", "100", "110", "100", "111"),
+    "F": ("111", "100", "110", "100", "100"),
+    "G": ("011", "100", "101", "101", "011"),
+    "H": ("101", "101", "111", "101", "101"),
+    "I": ("111", "010", "010", "010", "111"),
+    "J": ("001", "001", "001", "101", "010"),
+    "K": ("101", "101", "110", "101", "101"),
+    "L": ("100", "100", "100", "100", "111"),
+    "M": ("101", "111", "111", "101", "101"),
+    "N": ("110", "101", "101", "101", "101"),
+    "O": ("010", "101", "101", "101", "010"),
+    "P": ("110", "101", "110", "100", "100"),
+    "Q": ("010", "101", "101", "110", "011"),
+    "R": ("110", "101", "110", "101", "101"),
+    "S": ("011", "100", "010", "001", "110"),
+    "T": ("111", "010", "010", "010", "010"),
+    "U": ("101", "101", "101", "101", "111"),
+    "V": ("101", "101", "101", "101", "010"),
+    "W": ("101", "101", "111", "111", "101"),
+    "X": ("101", "101", "010", "101", "101"),
+    "Y": ("101", "101", "010", "010", "010"),
+    "Z": ("111", "001", "010", "100", "111"),
+    "!": ("010", "010", "010", "000", "010"),
+    "-": ("000", "000", "111", "000", "000"),
+}
+
+
+@dataclass
+class Layer:
+    name: str
+    colors: np.ndarray  # (led_num, 3) uint8
+    coverage: np.ndarray  # (led_num, 1) 0.0 to 1.0, how much of each led this layer covers
+    opacity: float = 1.0
+    z_order: int = 0
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "opacity": self.opacity,
+            "z_order": self.z_order,
+            "leds": int(np.count_nonzero(self.coverage)),
+        }
+
+
+class PreparedLayer:
+    """The fixed point numbers for a layer, worked out once so that blending it onto a
+    frame is a multiply and an add"""
+
+    def __init__(self, layer: Layer) -> None:
+        weight = np.clip(layer.coverage * layer.opacity, 0.0, 1.0) * fixed_one
+        weight = weight.astype(np.uint16)
+        self.layer = layer
+        # spread over all three channels, a (led_num, 1) column would be broadcast
+        # through a temporary on every frame
+        self.inverse_weight = np.repeat(fixed_one - weight, 3, axis=1).astype(np.uint16)
+        self.weighted_colors = (layer.colors.astype(np.uint16) * weight).astype(
+            np.uint16
+        )
+
+
+class LayerStack:
+    """Overlays drawn on top of whatever sequence is playing, lowest z_order first"""
+
+    def __init__(self, led_num: int) -> None:
+        self.led_num = led_num
+        self.lock = threading.Lock()
+        self.layers: dict[str, Layer] = {}
+        # swapped as a whole, so the display thread never needs the lock
+        self.prepared: tuple[PreparedLayer, ...] = ()
+        self.work = np.zeros((led_num, 3), dtype=np.uint16)
+        self.output = np.zeros((led_num, 3), dtype=np.uint8)
+
+    def rebuild(self) -> None:
+        ordered = sorted(self.layers.values(), key=lambda layer: layer.z_order)
+        self.prepared = tuple(
+            PreparedLayer(layer) for layer in ordered if layer.opacity > 0
+        )
+
+    def set_layer(self, layer: Layer) -> None:
+        with self.lock:
+            self.layers[layer.name] = layer
+            self.rebuild()
+
+    def update_layer(
+        self, name: str, opacity: Optional[float] = None, z_order: Optional[int] = None
+    ) -> bool:
+        with self.lock:
+            layer = self.layers.get(name)
+            if layer is None:
+                return False
+            if opacity is not None:
+                layer.opacity = min(max(float(opacity), 0.0), 1.0)
+            if z_order is not None:
+                layer.z_order = int(z_order)
+            self.rebuild()
+            return True
+
+    def remove_layer(self, name: str) -> bool:
+        with self.lock:
+            removed = self.layers.pop(name, None)
+            self.rebuild()
+            return removed is not None
+
+    def clear(self) -> None:
+        with self.lock:
+            self.layers.clear()
+            self.rebuild()
+
+    def to_list(self) -> list[dict]:
+        with self.lock:
+            return [layer.to_dict() for layer in self.layers.values()]
+
+    def apply(self, frame: np.ndarray) -> np.ndarray:
+        """blend every layer onto a (led_num, 3) frame. Hands back the same frame when
+        there is nothing to draw"""
+        prepared = self.prepared
+        if not prepared:
+            return frame
+        np.copyto(self.work, frame)
+        for layer in prepared:
+            np.multiply(self.work, layer.inverse_weight, out=self.work)
+            np.add(self.work, layer.weighted_colors, out=self.work)
+            np.right_shift(self.work, 8, out=self.work)
+        np.copyto(self.output, self.work, casting="unsafe")
+        return self.output
+
+
+@lru_cache(maxsize=1)
+def load_led_coordinates() -> Optional[np.ndarray]:
+    """the GIFT coordinates of every led, or None if they cant be loaded"""
+    try:
+        coordinates = read_GIFT_array(Path(config.coordinates_file))
+    except Exception as e:
+        logger.getChild("coordinates").warning(
+            f"could not load {config.coordinates_file}. {e}"
+        )
+        return None
+    if len(coordinates) < config.led_num:
+        logger.getChild("coordinates").warning(
+            f"{config.coordinates_file} only has {len(coordinates)} leds"
+        )
+        return None
+    return coordinates[: config.led_num]
+
+
+layer_stack = LayerStack(config.led_num)
+
+
+def blank_layer(name: str, led_num: int, color: list[int]) -> Layer:
+    colors = np.zeros((led_num, 3), dtype=np.uint8)
+    colors[:] = np.clip(np.asarray(color, dtype=np.int32), 0, 255)
+    coverage = np.zeros((led_num, 1), dtype=np.float64)
+    return Layer(name, colors, coverage)
+
+
+def single_led_layer(name: str, led_num: int, index: int, color: list[int]) -> Layer:
+    layer = blank_layer(name, led_num, color)
+    layer.coverage[index] = 1.0
+    return layer
+
+
+def mask_layer(name: str, led_num: int, leds: list[int], color: list[int]) -> Layer:
+    layer = blank_layer(name, led_num, color)
+    indexes = np.asarray(leds, dtype=np.int64)
+    layer.coverage[indexes[(indexes >= 0) & (indexes < led_num)]] = 1.0
+    return layer
+
+
+def plane_layer(
+    name: str,
+    coordinates: np.ndarray,
+    axis: int,
+    value: float,
+    tolerance: float,
+    color: list[int],
+) -> Layer:
+    """light every led within tolerance of the plane axis == value"""
+    led_num = len(coordinates)
+    layer = blank_layer(name, led_num, color)
+    distance = np.abs(coordinates[:, axis] - value)
+    layer.coverage[distance <= tolerance, 0] = 1.0
+    return layer
+
+
+def text_layer(
+    name: str, coordinates: np.ndarray, text: str, color: list[int]
+) -> Layer:
+    """draw text across the front of the tree (x across, z up) in the small font"""
+    led_num = len(coordinates)
+    layer = blank_layer(name, led_num, color)
+    glyphs = [small_font.get(letter, small_font[" "]) for letter in text.upper()]
+    if not glyphs:
+        return layer
+    # one blank column between letters
+    rows = ["0".join(glyph[row] for glyph in glyphs) for row in range(5)]
+    bitmap = np.array([[bit == "1" for bit in row] for row in rows], dtype=bool)
+    height, width = bitmap.shape
+
+    x = coordinates[:, 0]
+    z = coordinates[:, 2]
+    x_span = max(x.max() - x.min(), 1e-9)
+    z_span = max(z.max() - z.min(), 1e-9)
+    column = ((x - x.min()) / x_span * (width - 1)).round().astype(np.int64)
+    # row 0 is the top of the letters
+    row = ((z.max() - z) / z_span * (height - 1)).round().astype(np.int64)
+    layer.coverage[bitmap[row, column], 0] = 1.0
+    return layer
@@ -0,0 +1,322 @@
+import ctypes
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+import numpy as np
+
+import config
+from common import colors
+
+
+def encode_frame(frame: np.ndarray) -> list[int]:
+    """pack a (led_num, 3) RGB frame into the ints that rpi_ws281x wants"""
+    return colors.pack_grb(frame).tolist()
+
+
+def pack_frame(frame: np.ndarray, out: np.ndarray, work: np.ndarray) -> np.ndarray:
+    """colors.pack_grb into a (led_num,) uint32 array without allocating anything.
+    work is a (led_num, 3) uint32 scratch array"""
+    np.copyto(work, frame)
+    np.left_shift(work[:, 1], 16, out=out)
+    np.left_shift(work[:, 0], 8, out=work[:, 0])
+    np.bitwise_or(out, work[:, 0], out=out)
+    np.bitwise_or(out, work[:, 2], out=out)
+    return out
+
+
+def unpack_frame(packed: np.ndarray, out: np.ndarray, work: np.ndarray) -> np.ndarray:
+    """the other way, packed GRB uint32 back to a (led_num, 3) RGB uint8 frame.
+    The shifts stay in uint32 because a ufunc casting into out would allocate"""
+    np.right_shift(packed, 8, out=work[:, 0])
+    np.right_shift(packed, 16, out=work[:, 1])
+    np.copyto(work[:, 2], packed)
+    np.bitwise_and(work, 0xFF, out=work)
+    np.copyto(out, work, casting="unsafe")
+    return out
+
+
+class LedBackend(ABC):
+    """Where frames end up. load() gets the strip ready with a (led_num, 3) RGB frame and
+    show() pushes it out, they are split so the two can be timed separately.
+    load_packed() takes the (led_num,) uint32 frames from the frame ring instead"""
+
+    name = "base"
+
+    def __init__(self, led_num: int) -> None:
+        self.led_num = led_num
+        self.unpacked = np.zeros((led_num, 3), dtype=np.uint8)
+        self.unpack_work = np.zeros((led_num, 3), dtype=np.uint32)
+
+    def begin(self) -> None:
+        pass
+
+    @abstractmethod
+    def load(self, frame: np.ndarray) -> None:
+        pass
+
+    @abstractmethod
+    def show(self) -> None:
+        pass
+
+    def load_packed(self, packed: np.ndarray) -> None:
+        self.load(unpack_frame(packed, self.unpacked, self.unpack_work))
+
+    def clear(self) -> None:
+        self.load(np.zeros((self.led_num, 3), dtype=np.uint8))
+        self.show()
+
+
+class Ws281xBackend(LedBackend):
+    """rpi_ws281x driving the strip with PWM and DMA"""
+
+    name = "ws281x"
+
+    def __init__(
+        self, led_num: int, led_pin: int, channel: int = 0, dma: int = 10
+    ) -> None:
+        super().__init__(led_num)
+        # used for pushing the data out
+        # https://github.com/rpi-ws281x/rpi-ws281x-python/blob/master/library/rpi_ws281x/rpi_ws281x.py
+        # https://github.com/richardghirst/rpi_ws281x/blob/master/ws2811.c
+        from rpi_ws281x import PixelStrip, ws
+
+        LED_FREQ_HZ = 800000  # LED signal frequency in hertz (usually 800khz)
+        LED_DMA = dma  # DMA channel to use for generating signal (try 10)
+        LED_BRIGHTNESS = 255  # Set to 0 for darkest and 255 for brightest
+        LED_INVERT = (
+            False  # True to invert the signal (when using NPN transistor level shift)
+        )
+        LED_CHANNEL = channel  # PWM channel 0 is gpio 12 or 18, 1 is gpio 13 or 19
+        # LED_STRIP = ws.SK6812_STRIP_RGBW
+        LED_STRIP = ws.WS2811_STRIP_GRB
+
+        self.packed = np.zeros(led_num, dtype=np.uint32)
+        self.pack_work = np.zeros((led_num, 3), dtype=np.uint32)
+        self.pixels = PixelStrip(
+            led_num,
+            led_pin,
+            LED_FREQ_HZ,
+            LED_DMA,
+            LED_INVERT,
+            LED_BRIGHTNESS,
+            LED_CHANNEL,
+            LED_STRIP,
+        )
+
+    def begin(self) -> None:
+        self.pixels.begin()
+        self.leds = self.map_leds()
+        self.clear()
+
+    def map_leds(self) -> np.ndarray:
+        """the strip's own (led_num,) uint32 buffer, the one show() sends out, as a
+        numpy array over the same memory. The driver only allocates it in begin()"""
+        from rpi_ws281x import ws
+
+        # a swig pointer turns into its address as an int
+        address = int(ws.ws2811_channel_t_leds_get(self.pixels._channel))
+        buffer = (ctypes.c_uint32 * self.led_num).from_address(address)
+        return np.ctypeslib.as_array(buffer)
+
+    def load(self, frame: np.ndarray) -> None:
+        self.load_packed(pack_frame(frame, self.packed, self.pack_work))
+
+    def load_packed(self, packed: np.ndarray) -> None:
+        # already in the strip's own format, so one copy straight into its buffer
+        np.copyto(self.leds, packed)
+
+    def show(self) -> None:
+        self.pixels.show()
+
+
+class NeopixelBackend(LedBackend):
+    """Adafruit neopixel (the same setup as test_neopixels.py)"""
+
+    name = "neopixel"
+
+    def __init__(self, led_num: int, led_pin: int) -> None:
+        super().__init__(led_num)
+        import board
+        import neopixel
+
+        self.pixels = neopixel.NeoPixel(
+            getattr(board, f"D{led_pin}"),
+            led_num,
+            bpp=3,
+            auto_write=False,
+            pixel_order=neopixel.GRB,
+        )
+
+    def load(self, frame: np.ndarray) -> None:
+        self.pixels[0 : self.led_num] = [tuple(color) for color in frame.tolist()]
+
+    def show(self) -> None:
+        self.pixels.show()
+
+
+class SimulatedBackend(LedBackend):
+    """An in memory strip that keeps the last frames it was shown and when. It can pretend
+    to take as long as a real strip to push (WS2811 is about 30us per led). With
+    keep_frames=0 it keeps nothing, so showing a frame allocates nothing"""
+
+    name = "simulated"
+
+    def __init__(
+        self, led_num: int, keep_frames: int = 1000, push_time_per_led: float = 0.0
+    ) -> None:
+        super().__init__(led_num)
+        self.pixels = np.zeros((led_num, 3), dtype=np.uint8)
+        self.packed = np.zeros(led_num, dtype=np.uint32)
+        self.frames: deque[np.ndarray] = deque(maxlen=keep_frames)
+        self.show_times: deque[float] = deque(maxlen=keep_frames)
+        self.push_time = push_time_per_led * led_num
+        self.show_count = 0
+
+    def load(self, frame: np.ndarray) -> None:
+        np.copyto(self.pixels, frame)
+
+    def load_packed(self, packed: np.ndarray) -> None:
+        np.copyto(self.packed, packed)
+        unpack_frame(self.packed, self.pixels, self.unpack_work)
+
+    def show(self) -> None:
+        if self.push_time > 0:
+            time.sleep(self.push_time)
+        if self.frames.maxlen:
+            self.frames.append(self.pixels.copy())
+            self.show_times.append(time.perf_counter())
+        self.show_count += 1
+
+    def frame_intervals(self) -> np.ndarray:
+        """seconds between each recorded show"""
+        return np.diff(np.asarray(self.show_times, dtype=np.float64))
+
+
+@dataclass
+class Segment:
+    """a run of the logical leds that goes out on one physical strip. reverse is for a
+    strip wired from the far end, so its first led is the run's last"""
+
+    start: int
+    count: int
+    reverse: bool = False
+
+    def of(self, frames: np.ndarray) -> np.ndarray:
+        """this segment's part of a (led_num, ...) frame, as a view"""
+        part = frames[self.start : self.start + self.count]
+        return part[::-1] if self.reverse else part
+
+
+class SegmentedBackend(LedBackend):
+    """Splits the leds over several strips, each on its own pin and channel, and
+    pushes them all at once. A strip takes about 30us per led to push, so with the
+    leds split evenly over n strips a frame goes out about n times faster.
+
+    rpi_ws281x returns from show() once the DMA is started, so those strips overlap
+    on their own. Each strip is shown from a thread of its own as well, so backends
+    that block for the whole push (SPI, the simulated one) overlap too"""
+
+    name = "segmented"
+
+    def __init__(self, strips: list[tuple[Segment, LedBackend]]) -> None:
+        led_num = sum(segment.count for segment, _ in strips)
+        super().__init__(led_num)
+        covered = np.zeros(led_num, dtype=np.int64)
+        for segment, strip in strips:
+            if segment.count != strip.led_num:
+                raise ValueError(
+                    f"{segment} needs {segment.count} leds, its strip has {strip.led_num}"
+                )
+            covered[segment.start : segment.start + segment.count] += 1
+        if len(covered) and not np.all(covered == 1):
+            raise ValueError("the segments have to cover every led exactly once")
+        self.strips = strips
+        self.name = "+".join(strip.name for _, strip in strips)
+        self.executor = ThreadPoolExecutor(
+            max_workers=max(len(strips) - 1, 1), thread_name_prefix="segment"
+        )
+
+    def begin(self) -> None:
+        for _, strip in self.strips:
+            strip.begin()
+
+    def load(self, frame: np.ndarray) -> None:
+        for segment, strip in self.strips:
+            strip.load(segment.of(frame))
+
+    def load_packed(self, packed: np.ndarray) -> None:
+        for segment, strip in self.strips:
+            strip.load_packed(segment.of(packed))
+
+    def show(self) -> None:
+        # the first strip is shown from here while the others go in the pool
+        pushes = [self.executor.submit(strip.show) for _, strip in self.strips[1:]]
+        self.strips[0][1].show()
+        for push in pushes:
+            push.result()
+
+
+# the block of the pi that rpi_ws281x drives each pin with. Every strip sets up its
+# own, so two strips on the same one (like PWM channel 0 and 1) undo each other
+ws281x_pin_peripherals = {
+    12: "PWM",
+    18: "PWM",
+    13: "PWM",
+    19: "PWM",
+    21: "PCM",
+    10: "SPI",
+}
+
+
+def check_segment_pins(segments: list[dict]) -> None:
+    """raise if two segments would need the same PWM, PCM or SPI block"""
+    used: dict[str, int] = {}
+    for settings in segments:
+        pin = int(settings.get("pin", config.led_pin))
+        peripheral = ws281x_pin_peripherals.get(pin)
+        if peripheral is None:
+            # left for rpi_ws281x to turn down when the strip starts
+            continue
+        if peripheral in used:
+            raise ValueError(
+                f"pins {used[peripheral]} and {pin} both need {peripheral}, "
+                "only one strip can use each of PWM, PCM and SPI"
+            )
+        used[peripheral] = pin
+
+
+def create_strip(name: str, led_num: int, settings: dict) -> LedBackend:
+    led_pin = int(settings.get("pin", config.led_pin))
+    if name == "ws281x":
+        return Ws281xBackend(
+            led_num,
+            led_pin,
+            int(settings.get("channel", 0)),
+            int(settings.get("dma", 10)),
+        )
+    if name == "neopixel":
+        return NeopixelBackend(led_num, led_pin)
+    if name == "simulated":
+        return SimulatedBackend(led_num)
+    raise ValueError(f"{name} is not an led backend, try ws281x, neopixel or simulated")
+
+
+def create_backend(name: str) -> LedBackend:
+    """the strip on config.led_pin, or one strip per entry of config.led_segments"""
+    if not config.led_segments:
+        return create_strip(name, config.led_num, {})
+    if name != "simulated":
+        check_segment_pins(config.led_segments)
+    strips = []
+    start = 0
+    for settings in config.led_segments:
+        count = int(settings["count"])
+        segment = Segment(start, count, bool(settings.get("reverse", False)))
+        strips.append((segment, create_strip(name, count, settings)))
+        start += count
+    if start != config.led_num:
+        raise ValueError(f"led_segments have {start} leds, led_num is {config.led_num}")
+    return SegmentedBackend(strips)
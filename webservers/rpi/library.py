@@ -0,0 +1,232 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Optional
+
+import numpy as np
+
+import config
+from common.colors import rgb_to_hex
+from common.common_objects import setup_common_logger
+from common.file_parser import load_sequence
+from shared_state import state
+
+
+logger = logging.getLogger("library")
+logger = setup_common_logger(logger)
+
+thumbnail_length = 32  # colors in the strip, each the average of one frame
+sort_columns = (
+    "name",
+    "frames",
+    "size",
+    "duration",
+    "average_brightness",
+    "peak_brightness",
+    "indexed_at",
+)
+
+
+def file_checksum(file_path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 16), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def native_fps(file_path: Path) -> Optional[float]:
+    """the fps a sequence was made for, from a name.json next to it with {"fps": 30}"""
+    sidecar = file_path.with_suffix(".json")
+    try:
+        return float(json.loads(sidecar.read_text())["fps"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def describe_frames(frames: np.ndarray) -> dict:
+    """brightness is the mean of every channel from 0 to 1, averaged over the whole
+    sequence and for its brightest frame. The thumbnail is the average color of frames
+    spread evenly through it"""
+    if len(frames) == 0:
+        return {"average_brightness": 0.0, "peak_brightness": 0.0, "thumbnail": []}
+    frame_brightness = frames.reshape(len(frames), -1).mean(axis=1) / 255.0
+    picked = np.linspace(0, len(frames) - 1, min(thumbnail_length, len(frames)))
+    strip = frames[picked.astype(np.intp)].mean(axis=1).round().astype(np.uint8)
+    return {
+        "average_brightness": round(float(frame_brightness.mean()), 4),
+        "peak_brightness": round(float(frame_brightness.max()), 4),
+        "thumbnail": rgb_to_hex(strip).tolist(),
+    }
+
+
+class LibraryIndex:
+    """What is known about every sequence in a folder, kept in SQLite so listing the
+    library never loads a sequence. refresh() only loads files whose size or modified
+    time changed since they were indexed, and forgets ones that are gone"""
+
+    def __init__(self, index_file: Path, folder: Path) -> None:
+        self.index_file = index_file
+        self.folder = folder
+        # only one refresh at a time, reading can go on while it runs
+        self.refresh_lock = threading.Lock()
+        self.created = False
+
+    @contextmanager
+    def connect(self) -> Iterator[sqlite3.Connection]:
+        """a connection of its own, so any thread can use the index. Committed if
+        nothing went wrong and closed either way"""
+        connection = sqlite3.connect(self.index_file, timeout=10)
+        connection.row_factory = sqlite3.Row
+        try:
+            with connection:
+                self.create_table(connection)
+                yield connection
+        finally:
+            connection.close()
+
+    def create_table(self, connection: sqlite3.Connection) -> None:
+        if not self.created:
+            connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS sequences (
+                    path TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    checksum TEXT NOT NULL,
+                    frames INTEGER NOT NULL,
+                    led_num INTEGER NOT NULL,
+                    fps REAL,
+                    average_brightness REAL NOT NULL,
+                    peak_brightness REAL NOT NULL,
+                    thumbnail TEXT NOT NULL,
+                    indexed_at REAL NOT NULL
+                )
+                """
+            )
+            self.created = True
+
+    def refresh(self, wait: bool = True) -> Optional[dict]:
+        """Bring the index up to date with the folder and return what changed. Only
+        the files are stat'ed when nothing changed, so it is cheap to call before
+        every listing. Without wait, None is returned straight away if another refresh
+        is already running"""
+        if not self.refresh_lock.acquire(blocking=wait):
+            return None
+        try:
+            return self.refresh_locked()
+        finally:
+            self.refresh_lock.release()
+
+    def refresh_in_background(self) -> bool:
+        """start a refresh on a thread of its own, so whoever asked can answer from the
+        index as it is. False if one was already running"""
+        if self.refresh_lock.locked():
+            return False
+        threading.Thread(
+            target=self.refresh, args=(False,), name="library_refresh", daemon=True
+        ).start()
+        return True
+
+    def refresh_locked(self) -> dict:
+        local_logger = logger.getChild("refresh")
+        start = time.perf_counter()
+        counts = {"added": 0, "updated": 0, "removed": 0, "failed": 0, "unchanged": 0}
+        with self.connect() as connection:
+            known = {
+                row["path"]: (row["size"], row["mtime_ns"])
+                for row in connection.execute(
+                    "SELECT path, size, mtime_ns FROM sequences"
+                )
+            }
+            found = set()
+            for file_path in sorted(self.folder.glob("*.csv")):
+                path = str(file_path)
+                found.add(path)
+                stat = file_path.stat()
+                if known.get(path) == (stat.st_size, stat.st_mtime_ns):
+                    counts["unchanged"] += 1
+                    continue
+                try:
+                    row = self.index_file_row(file_path, stat)
+                except Exception as e:
+                    local_logger.error(f"could not index {file_path.name}: {e}")
+                    counts["failed"] += 1
+                    continue
+                connection.execute(
+                    f"INSERT OR REPLACE INTO sequences ({', '.join(row)}) "
+                    f"VALUES ({', '.join('?' * len(row))})",
+                    tuple(row.values()),
+                )
+                # each file on its own, so the index is not locked while the next loads
+                connection.commit()
+                counts["updated" if path in known else "added"] += 1
+            gone = [path for path in known if path not in found]
+            connection.executemany(
+                "DELETE FROM sequences WHERE path = ?", [(path,) for path in gone]
+            )
+            counts["removed"] = len(gone)
+        counts["seconds"] = round(time.perf_counter() - start, 3)
+        if counts["added"] or counts["updated"] or counts["removed"]:
+            local_logger.info(f"{counts}")
+        return counts
+
+    def index_file_row(self, file_path: Path, stat) -> dict:
+        # the sequence as it is in the file, not resized to this tree
+        frames, report = load_sequence(file_path)
+        description = describe_frames(frames)
+        return {
+            "path": str(file_path),
+            "name": file_path.name,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "checksum": file_checksum(file_path),
+            "frames": report.frames,
+            "led_num": report.source_leds,
+            "fps": native_fps(file_path),
+            "average_brightness": description["average_brightness"],
+            "peak_brightness": description["peak_brightness"],
+            "thumbnail": json.dumps(description["thumbnail"]),
+            "indexed_at": time.time(),
+        }
+
+    def query(
+        self,
+        search: str = "",
+        sort: str = "name",
+        descending: bool = False,
+        limit: Optional[int] = None,
+        min_frames: int = 0,
+    ) -> list[dict]:
+        """every sequence whose name contains search. duration is in seconds, at the
+        sequence's own fps or the current one when it does not have one"""
+        if sort not in sort_columns:
+            raise ValueError(f"can only sort by one of {sort_columns}")
+        fps = state.settings.fps or float(config.fps)
+        query = (
+            "SELECT *, frames / COALESCE(fps, ?) AS duration FROM sequences "
+            "WHERE name LIKE ? AND frames >= ? "
+            f"ORDER BY {sort} {'DESC' if descending else 'ASC'}, name"
+        )
+        parameters: list = [fps, f"%{search}%", min_frames]
+        if limit is not None:
+            query += " LIMIT ?"
+            parameters.append(int(limit))
+        with self.connect() as connection:
+            rows = connection.execute(query, parameters).fetchall()
+        results = []
+        for row in rows:
+            entry = dict(row)
+            entry["thumbnail"] = json.loads(entry["thumbnail"])
+            del entry["mtime_ns"]
+            results.append(entry)
+        return results
+
+
+library = LibraryIndex(Path(config.library_index_file), Path(config.sequence_folder))
@@ -6,7 +6,6 @@ import time
 # used for multi-threading
 import threading
 import queue
-from io import StringIO
 
 
 # used for being able to import stuff from other folders
@@ -19,22 +18,27 @@ webservers_directory = os.path.abspath(os.path.join(current_directory, ".."))
 sys.path.append(webservers_directory)
 
 
+from pathlib import Path
+
 # used for sharing data between modules
 import config
 
 
-from common.common_objects import setup_common_logger
+from common.common_objects import setup_common_logger, RingBufferHandler
 from commands import handle_commands
+from command_queue import CommandQueue
 from networking import handle_networking
 from display import show_data_on_leds
+from playlist import run_playlist, player, PlaylistItem
+from library import library
 
 
 logger = logging.getLogger("light_driver")
 logger = setup_common_logger(logger)
 
 # set up the capture on the root logger so it capture everything
-log_capture = StringIO()
-logging.getLogger().addHandler(logging.StreamHandler(log_capture))
+log_capture = RingBufferHandler(config.log_capture_records)
+logging.getLogger().addHandler(log_capture)
 
 config.log_capture = log_capture
 
@@ -42,23 +46,30 @@ config.log_capture = log_capture
 # set up the queues and events
 stop_event = threading.Event()
 stop_event.clear()
-display_queue = queue.Queue()
-command_queue = queue.Queue()
+# coalesces superseded commands and lets stop jump the line
+command_queue = CommandQueue()
 send_queue = queue.Queue()
 
-# put something in the command_queue right away so that it can boot to something
-command_queue.put(
-    {
-        "command": "loadfile",
-        "args": "/home/pi/github/xmastree2023/examples/rainbow-implosion.csv",
-    }
-)
-
 
+# the display process is spawned and imports this file again, so everything that
+# should only happen once is under here
 if __name__ == "__main__":
     total_running_time_s = 0
     stop_event.clear()
 
+    # start the playlist right away so that it can boot to something
+    playlist_file = Path(config.playlist_file)
+    if playlist_file.exists():
+        player.load(playlist_file)
+    else:
+        player.get_playlist().items.append(
+            PlaylistItem(
+                "loadfile",
+                str(Path(config.sequence_folder) / "rainbow-implosion.csv"),
+            )
+        )
+        player.enabled = True
+
     web_server_thread = threading.Thread(
         target=handle_networking,
         args=(config.host, config.rx_port, stop_event, command_queue, send_queue),
@@ -66,33 +77,42 @@ if __name__ == "__main__":
 
     command_thread = threading.Thread(
         target=handle_commands,
-        args=(command_queue, display_queue, send_queue, stop_event),
+        args=(command_queue, send_queue, stop_event),
     )
 
     running_thread = threading.Thread(
-        target=show_data_on_leds, args=(stop_event, display_queue)
+        target=show_data_on_leds, args=(stop_event,)
     )
 
+    playlist_thread = threading.Thread(
+        target=run_playlist,
+        args=(command_queue, stop_event),
+    )
+
+    # catch the library index up with any sequences added while the pi was off
+    library_thread = threading.Thread(target=library.refresh, daemon=True)
+
     # Start the threads
     web_server_thread.start()
     command_thread.start()
     running_thread.start()
+    playlist_thread.start()
+    library_thread.start()
 
     try:
         while not stop_event.is_set():
             time.sleep(1)
             total_running_time_s += 1
             if total_running_time_s % 10 == 0:
-                stop_message = "press ctrl+c to stop\n"
-                log_contents = config.log_capture.getvalue()
-                log_contents = log_contents[-50:]
+                stop_message = "press ctrl+c to stop"
+                last_record = log_capture.get_records(limit=1)
 
-                if not log_contents.endswith(stop_message):
-                    logger.getChild("main_loop").info(stop_message.strip())
-                config.log_capture.truncate(100_000)
+                if not last_record or not last_record[0].endswith(stop_message):
+                    logger.getChild("main_loop").info(stop_message)
     except KeyboardInterrupt:
         stop_event.set()
         web_server_thread.join()
         command_thread.join()
         running_thread.join()
+        playlist_thread.join()
     logger.info("Application Stopped")
@@ -17,12 +17,26 @@ from common.common_objects import (
     setup_common_logger,
     log_when_functions_start_and_stop,
 )
-from common.common_send_recv import send_message, receive_message
+from common.common_send_recv import MessageBuffer, send_message
+from common import metrics
+from common import sequence_binary
 
 
 logger = logging.getLogger("networking")
 logger = setup_common_logger(logger)
 
+connections_total = metrics.counter(
+    "network_connections_total", "Connections accepted by the pi"
+)
+connections_open = metrics.gauge("network_connections_open", "Connections open now")
+invalid_messages = metrics.counter(
+    "network_invalid_messages_total", "Messages that were not a JSON command"
+)
+
+# a reply that can not be sent in this long is given up on, reading never waits
+send_timeout = 10.0
+receive_chunk_size = 65536
+
 
 def confirm_and_handle_json_command(
     received_data: str,
@@ -37,10 +51,12 @@ def confirm_and_handle_json_command(
         command_queue.put(command)
 
     except json.JSONDecodeError as JDE:
+        invalid_messages.inc()
         logger.error(
             f"{JDE}\n\nInvalid JSON format. Please provide valid JSON data.\n{received_data=}"
         )
     except TypeError as TE:
+        invalid_messages.inc()
         logger.error(
             f"{TE}\n\nInvalid dictionary format. Please provide valid dictionary data.\n{received_data=}"
         )
@@ -48,6 +64,17 @@ def confirm_and_handle_json_command(
         logger.error(f"General Error:{e}")
 
 
+def handle_binary_frames(
+    received_data: bytes,
+    sock: socket.socket,
+    command_queue: queue.Queue,
+) -> None:
+    """a message that is a raw sequence is the next part of a streamed upload"""
+    command_queue.put(
+        {"command": "stream_frames", "args": received_data, "send_back": sock}
+    )
+
+
 def send_back_networked_message(sock: socket.socket, data: bytes) -> None:
     send_message(sock, data)
 
@@ -64,7 +91,11 @@ def send_back_manager(stop_event: threading.Event, send_queue: queue.Queue) -> N
         # send queue should be full of bytes objects
         sending_medium, data = current_request
         if isinstance(sending_medium, socket.socket):
-            send_back_networked_message(sending_medium, data)
+            try:
+                send_back_networked_message(sending_medium, data)
+            except OSError as e:
+                # the client went away before its reply, that is its problem only
+                local_logger.warning(f"could not send back {len(data)} bytes, {e}")
         else:
             local_logger.error(
                 f"Was told to send back message of {data=} on the medium {type(sending_medium)} {sending_medium=}"
@@ -94,31 +125,58 @@ def handle_networking(
         server_socket.bind((host, port))
         server_socket.listen(5)
 
-        connected_clients = []
+        # each client's half arrived message and where it connected from, which is
+        # kept since a reset socket can not say who it was connected to any more
+        connected_clients: dict[socket.socket, tuple[MessageBuffer, tuple]] = {}
+
+        def close_client(sock: socket.socket, reason: str) -> None:
+            buffer, client_address = connected_clients.pop(sock)
+            if buffer.partial():
+                common_send_recv.framing_errors.inc()
+            local_logger.info(f"Connection from {client_address} {reason}")
+            try:
+                sock.close()
+            except OSError:
+                pass
+            connections_open.dec()
 
         while not stop_event.is_set():
             readable, _, _ = select.select(
-                [server_socket] + connected_clients, [], [], 0.2
+                [server_socket] + list(connected_clients), [], [], 0.2
             )
             for sock in readable:
                 if sock is server_socket:
                     # New connection, accept it
-                    client_socket, client_address = sock.accept()
-                    client_socket.setblocking(0)
+                    try:
+                        client_socket, client_address = sock.accept()
+                    except OSError as e:
+                        local_logger.warning(f"could not accept a connection, {e}")
+                        continue
+                    # only sends wait, select says when there is something to read
+                    client_socket.settimeout(send_timeout)
                     local_logger.info(f"New connection from {client_address}")
-                    connected_clients.append(client_socket)
-                else:
-                    # Data received from an existing client
-                    data = receive_message(sock)
-                    if data:
+                    connected_clients[client_socket] = (MessageBuffer(), client_address)
+                    connections_total.inc()
+                    connections_open.inc()
+                    continue
+
+                # Data received from an existing client, only what is there already
+                # is taken so a slow client never holds up the others
+                try:
+                    chunk = sock.recv(receive_chunk_size)
+                except OSError as e:
+                    close_client(sock, f"dropped, {e}")
+                    continue
+                if not chunk:
+                    close_client(sock, "closed")
+                    continue
+                for data in connected_clients[sock][0].feed(chunk):
+                    if data.startswith(sequence_binary.magic):
+                        handle_binary_frames(data, sock, command_queue)
+                    elif data:
                         confirm_and_handle_json_command(
-                            data.decode("utf-8"), sock, command_queue
+                            data.decode("utf-8", errors="replace"), sock, command_queue
                         )
-                    else:
-                        # No data received, the client has closed the connection
-                        local_logger.info(f"Connection closed by {sock.getpeername()}")
-                        connected_clients.remove(sock)
-                        sock.close()
 
     except KeyboardInterrupt:
         pass
@@ -0,0 +1,292 @@
+import logging
+import queue
+import random
+import threading
+import time
+import json
+from dataclasses import dataclass, field, asdict
+from datetime import datetime, time as day_time
+from pathlib import Path
+from typing import Any, Optional
+
+import numpy as np
+
+import config
+from shared_state import state
+from common.common_objects import setup_common_logger, create_filled_dataframe
+from common.file_parser import load_sequence
+from common.sequence_validation import SequenceReport, normalize_sequence
+
+
+logger = logging.getLogger("playlist")
+logger = setup_common_logger(logger)
+
+default_playlist_name = "default"
+
+
+@dataclass
+class PlaylistItem:
+    command: str
+    args: Any = None
+    duration: float = 0.0  # seconds, 0 means use the loop count instead
+    loops: int = 1
+    crossfade: int = 0  # frames to fade from the previous item
+    transition: str = "alpha"  # how to fade, one of compositor.blend_modes
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+@dataclass
+class ScheduleWindow:
+    start: day_time
+    end: day_time
+    playlist: str
+
+    def is_active(self, now: day_time) -> bool:
+        if self.start <= self.end:
+            return self.start <= now < self.end
+        # the window wraps past midnight
+        return now >= self.start or now < self.end
+
+    def to_dict(self) -> dict:
+        return {
+            "start": self.start.strftime("%H:%M"),
+            "end": self.end.strftime("%H:%M"),
+            "playlist": self.playlist,
+        }
+
+
+@dataclass
+class Playlist:
+    name: str
+    items: list[PlaylistItem] = field(default_factory=list)
+    shuffle: bool = False
+    position: int = -1
+    _order: list[int] = field(default_factory=list, repr=False)
+
+    def next_index(self) -> int:
+        """advance to the next item, reshuffling once every item has played"""
+        if not self.items:
+            return -1
+        if not self.shuffle:
+            self.position = (self.position + 1) % len(self.items)
+            return self.position
+        if not self._order:
+            self._order = list(range(len(self.items)))
+            random.shuffle(self._order)
+        self.position = self._order.pop(0)
+        return self.position
+
+    def reset_order(self) -> None:
+        self._order = []
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "shuffle": self.shuffle,
+            "position": self.position,
+            "items": [item.to_dict() for item in self.items],
+        }
+
+
+@dataclass
+class PreparedItem:
+    item: PlaylistItem
+    frames: Optional[np.ndarray]
+    report: Optional[SequenceReport] = None
+
+
+def parse_time_of_day(value: str) -> day_time:
+    return datetime.strptime(value, "%H:%M").time()
+
+
+renderable_commands = ("loadfile", "fill")
+
+
+def render_item(item: PlaylistItem) -> Optional[tuple[np.ndarray, SequenceReport]]:
+    """turn an item into clean frames. Returns None for items that are plain commands"""
+    if item.command == "loadfile":
+        return load_sequence(Path(item.args), config.led_num)
+    if item.command == "fill":
+        filled = create_filled_dataframe(item.args, config.led_num)
+        return normalize_sequence(filled, config.led_num)
+    return None
+
+
+class PlaylistPlayer:
+    """Holds every playlist and schedule, and decides what should be playing next"""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.playlists: dict[str, Playlist] = {
+            default_playlist_name: Playlist(default_playlist_name)
+        }
+        self.schedules: list[ScheduleWindow] = []
+        self.enabled: bool = False
+        self.preload_seconds: float = 3.0
+        self.skip_requested: bool = False
+        self.current: Optional[PlaylistItem] = None
+
+    def get_playlist(self, name: Optional[str] = None) -> Playlist:
+        if name is None:
+            name = default_playlist_name
+        with self.lock:
+            if name not in self.playlists:
+                self.playlists[name] = Playlist(name)
+            return self.playlists[name]
+
+    def active_playlist(self, now: Optional[day_time] = None) -> Playlist:
+        if now is None:
+            now = datetime.now().time()
+        with self.lock:
+            for window in self.schedules:
+                if window.is_active(now) and window.playlist in self.playlists:
+                    return self.playlists[window.playlist]
+            return self.playlists[default_playlist_name]
+
+    def pick_next_item(self) -> Optional[PlaylistItem]:
+        playlist = self.active_playlist()
+        with self.lock:
+            index = playlist.next_index()
+            if index < 0:
+                return None
+            return playlist.items[index]
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {
+                "enabled": self.enabled,
+                "current": None if self.current is None else self.current.to_dict(),
+                "playlists": [p.to_dict() for p in self.playlists.values()],
+                "schedules": [s.to_dict() for s in self.schedules],
+            }
+
+    def save(self, file_path: Path) -> None:
+        file_path.write_text(json.dumps(self.to_dict(), indent=2))
+
+    def load(self, file_path: Path) -> None:
+        contents = json.loads(file_path.read_text())
+        with self.lock:
+            self.playlists = {}
+            for raw_playlist in contents.get("playlists", []):
+                items = [PlaylistItem(**raw) for raw in raw_playlist.get("items", [])]
+                self.playlists[raw_playlist["name"]] = Playlist(
+                    raw_playlist["name"], items, bool(raw_playlist.get("shuffle"))
+                )
+            self.playlists.setdefault(
+                default_playlist_name, Playlist(default_playlist_name)
+            )
+            self.schedules = [
+                ScheduleWindow(
+                    parse_time_of_day(raw["start"]),
+                    parse_time_of_day(raw["end"]),
+                    raw["playlist"],
+                )
+                for raw in contents.get("schedules", [])
+            ]
+            self.enabled = bool(contents.get("enabled", True))
+
+
+player = PlaylistPlayer()
+
+
+def prepare_item(item: PlaylistItem) -> PreparedItem:
+    local_logger = logger.getChild("prepare")
+    try:
+        rendered = render_item(item)
+    except Exception as e:
+        local_logger.error(f"could not load {item=}: {e}")
+        return PreparedItem(item, None)
+    if rendered is None:
+        return PreparedItem(item, None)
+    frames, report = rendered
+    if not report.is_playable():
+        local_logger.error(f"skipping {item.args}, {report.describe()}")
+        return PreparedItem(item, None)
+    if not report.is_clean():
+        local_logger.warning(f"had to fix {item.args}, {report.describe()}")
+    return PreparedItem(item, frames, report)
+
+
+def item_duration(prepared: PreparedItem) -> float:
+    item = prepared.item
+    if item.duration > 0:
+        return item.duration
+    fps = state.settings.sequence_fps()
+    if prepared.frames is None or fps <= 0:
+        return 0.0
+    return max(item.loops, 1) * len(prepared.frames) / fps
+
+
+def run_playlist(
+    command_queue: queue.Queue,
+    stop_event: threading.Event,
+) -> None:
+    """Play the active playlist, loading the next item in the background before the
+    current one ends so the display never waits on a file load"""
+    local_logger = logger.getChild("runner")
+    local_logger.info("Starting")
+
+    switch_time = 0.0
+    upcoming: Optional[PlaylistItem] = None
+    preload_thread: Optional[threading.Thread] = None
+    preloaded: list[PreparedItem] = []
+
+    def preload(item: PlaylistItem) -> None:
+        preloaded.append(prepare_item(item))
+
+    while not stop_event.is_set():
+        if not player.enabled:
+            if preload_thread is not None:
+                preload_thread.join()
+                preload_thread = None
+            player.current = None
+            upcoming = None
+            preloaded.clear()
+            switch_time = 0.0
+            stop_event.wait(0.5)
+            continue
+
+        now = time.monotonic()
+        if upcoming is None:
+            upcoming = player.pick_next_item()
+            if upcoming is None:
+                stop_event.wait(0.5)
+                continue
+
+        time_left = switch_time - now
+        if preload_thread is None and not preloaded and (
+            time_left <= player.preload_seconds or player.skip_requested
+        ):
+            preload_thread = threading.Thread(target=preload, args=(upcoming,))
+            preload_thread.start()
+
+        if time_left > 0 and not player.skip_requested:
+            stop_event.wait(min(time_left, 0.05))
+            continue
+
+        if preload_thread is not None:
+            preload_thread.join()
+            preload_thread = None
+        prepared = preloaded.pop() if preloaded else prepare_item(upcoming)
+        player.skip_requested = False
+
+        if upcoming.command not in renderable_commands:
+            # a plain command like "fps" or "brightness", let the dispatcher do it
+            command_queue.put({"command": upcoming.command, "args": upcoming.args})
+        elif prepared.frames is not None:
+            state.publish_sequence(
+                None,
+                prepared.frames,
+                upcoming.crossfade,
+                upcoming.transition,
+                report=prepared.report,
+            )
+        local_logger.info(f"now playing {upcoming}")
+        player.current = upcoming
+        # never spin faster than this, even on a playlist of only plain commands
+        switch_time = time.monotonic() + max(item_duration(prepared), 0.1)
+        upcoming = None
+
+    local_logger.info("Exiting")
@@ -0,0 +1,135 @@
+import numpy as np
+
+import config
+from color_correction import color_correction
+from compositor import FrameSource, fixed_one
+
+
+class PowerLimiter:
+    """Estimate how much current a frame draws and dim it when it is over budget.
+
+    For a sequence the scale for every frame is worked out once when it loads, so
+    playing it back costs a single multiply on the frames that are over budget. Frames
+    that were blended or had layers drawn on them get estimated as they go out."""
+
+    def __init__(self, led_num: int) -> None:
+        self.led_num = led_num
+        self.version = 0
+        self.work = np.zeros((led_num, 3), dtype=np.uint16)
+        # the frame is copied in before summing, summing the uint8 frame directly
+        # casts it through a temporary
+        self.sum_work = np.zeros((led_num, 3), dtype=np.uint32)
+        self.output = np.zeros((led_num, 3), dtype=np.uint8)
+        self.frames_total = 0
+        self.frames_limited = 0
+        self.last_ma = 0.0
+        self.peak_ma = 0.0
+
+    def settings_changed(self) -> None:
+        """the budget or the per channel current changed, precomputed scales are stale"""
+        self.version += 1
+
+    def ma_per_step(self) -> float:
+        """current of one channel step, config is the current of a channel at 255"""
+        return config.ma_per_channel / 255.0
+
+    def channel_budget_ma(self) -> float:
+        return config.power_budget_ma - config.idle_ma_per_led * self.led_num
+
+    def scales_for(self, channel_ma: np.ndarray) -> np.ndarray:
+        """fixed point scale (256 is untouched) for each channel current estimate"""
+        budget = self.channel_budget_ma()
+        if config.power_budget_ma <= 0:
+            return np.full(channel_ma.shape, fixed_one, dtype=np.uint16)
+        with np.errstate(divide="ignore"):
+            ratio = np.where(channel_ma > budget, budget / channel_ma, 1.0)
+        return (np.clip(ratio, 0.0, 1.0) * fixed_one).astype(np.uint16)
+
+    def scale_for(self, channel_ma: float) -> int:
+        """scales_for of a single estimate, without making arrays for it every frame"""
+        budget = self.channel_budget_ma()
+        if config.power_budget_ma <= 0 or channel_ma <= budget:
+            return fixed_one
+        if channel_ma <= 0:
+            # a budget the idle current alone is over
+            return 0
+        return int(min(max(budget / channel_ma, 0.0), 1.0) * fixed_one)
+
+    def estimate(self, frames: np.ndarray) -> np.ndarray:
+        """channel current of each frame with the current color correction"""
+        lut = color_correction.lut
+        channel_steps = np.zeros(len(frames), dtype=np.uint64)
+        for channel in range(3):
+            channel_lut = lut[channel * 256 : (channel + 1) * 256]
+            corrected = np.take(channel_lut, frames[:, :, channel])
+            channel_steps += corrected.sum(axis=1, dtype=np.uint64)
+        return channel_steps * self.ma_per_step()
+
+    def precompute(self, source: FrameSource) -> None:
+        """estimate every frame of a source. When the source only grew since the last
+        time, only the frames added to it are estimated"""
+        done = 0
+        if source.power_key[:2] == (color_correction.version, self.version):
+            done = len(source.power_ma)  # type: ignore
+        added_ma = self.estimate(source.frames[done:])
+        if done:
+            source.power_ma = np.concatenate([source.power_ma[:done], added_ma])  # type: ignore
+            source.power_scales = np.concatenate(
+                [source.power_scales[:done], self.scales_for(added_ma)]  # type: ignore
+            )
+        else:
+            source.power_ma = added_ma
+            source.power_scales = self.scales_for(added_ma)
+        source.power_key = (color_correction.version, self.version, len(source.frames))
+
+    def is_current(self, source: FrameSource) -> bool:
+        # a source playing a FrameBuffer can grow, new frames need estimating too
+        key = (color_correction.version, self.version, len(source.frames))
+        return source.power_key == key
+
+    def limit(self, frame: np.ndarray, source: FrameSource | None = None) -> np.ndarray:
+        """dim the frame if it is over budget. Pass the source when the frame came
+        straight from it to use the precomputed scale"""
+        if (
+            source is not None
+            and source.power_scales is not None
+            and source.last_index < len(source.power_scales)
+        ):
+            scale = int(source.power_scales[source.last_index])
+            channel_ma = float(source.power_ma[source.last_index])  # type: ignore
+        else:
+            np.copyto(self.sum_work, frame)
+            channel_steps = self.sum_work.sum(dtype=np.uint32)
+            channel_ma = float(channel_steps) * self.ma_per_step()
+            scale = self.scale_for(channel_ma)
+
+        self.frames_total += 1
+        idle_ma = config.idle_ma_per_led * self.led_num
+        self.last_ma = channel_ma * scale / fixed_one + idle_ma
+        self.peak_ma = max(self.peak_ma, self.last_ma)
+        if scale >= fixed_one:
+            return frame
+        self.frames_limited += 1
+        np.copyto(self.work, frame)
+        np.multiply(self.work, scale, out=self.work)
+        np.right_shift(self.work, 8, out=self.work)
+        np.copyto(self.output, self.work, casting="unsafe")
+        return self.output
+
+    def to_dict(self) -> dict:
+        return {
+            "budget_ma": config.power_budget_ma,
+            "frames_total": self.frames_total,
+            "frames_limited": self.frames_limited,
+            "limited_percent": 100.0 * self.frames_limited / max(self.frames_total, 1),
+            "last_ma": self.last_ma,
+            "peak_ma": self.peak_ma,
+        }
+
+    def reset_counters(self) -> None:
+        self.frames_total = 0
+        self.frames_limited = 0
+        self.peak_ma = 0.0
+
+
+power_limiter = PowerLimiter(config.led_num)
@@ -0,0 +1,101 @@
+import logging
+import socket
+import time
+from typing import Optional
+
+import numpy as np
+
+from frame_buffer import FrameBuffer
+from shared_state import state
+from common import metrics
+from common import sequence_binary
+from common.common_objects import setup_common_logger
+
+
+logger = logging.getLogger("sequence_upload")
+logger = setup_common_logger(logger)
+
+uploads_started = metrics.counter("uploads_total", "Streamed uploads started")
+upload_frames = metrics.counter(
+    "upload_frames_total", "Frames that arrived through streamed uploads"
+)
+
+
+def fit_to_leds(frames: np.ndarray, led_num: int) -> np.ndarray:
+    """cut off the leds past led_num, or pad the missing ones with black"""
+    if frames.shape[1] == led_num:
+        return frames
+    if frames.shape[1] > led_num:
+        return frames[:, :led_num]
+    fitted = np.zeros((len(frames), led_num, 3), dtype=np.uint8)
+    fitted[:, : frames.shape[1]] = frames
+    return fitted
+
+
+class SequenceUpload:
+    """A sequence arriving over one connection as a run of raw sequence messages (see
+    common/sequence_binary.py). The frames go into a FrameBuffer that starts playing
+    once start_frames of them are in, the rest join it as they arrive"""
+
+    def __init__(
+        self,
+        led_num: int,
+        start_frames: int,
+        crossfade_frames: Optional[int] = None,
+        blend_mode: Optional[str] = None,
+    ) -> None:
+        self.buffer = FrameBuffer(led_num)
+        self.start_frames = max(start_frames, 1)
+        self.crossfade_frames = crossfade_frames
+        self.blend_mode = blend_mode
+        self.playing = False
+        self.started = time.perf_counter()
+        uploads_started.inc()
+
+    def add(self, data: bytes) -> int:
+        """add the frames of one message, returns how many there are now"""
+        frames = sequence_binary.decode_frames(data)
+        count = self.buffer.append(fit_to_leds(frames, self.buffer.led_num))
+        upload_frames.inc(len(frames))
+        if not self.playing and count >= self.start_frames:
+            self.play()
+        return count
+
+    def play(self) -> None:
+        self.playing = True
+        state.publish_sequence(
+            None, self.buffer, self.crossfade_frames, self.blend_mode
+        )
+        logger.getChild("play").info(
+            f"playing after {len(self.buffer)} frames and {self.elapsed():0.3f}s"
+        )
+
+    def finish(self, complete: bool) -> dict:
+        """a complete upload too short to have started yet starts now. One with no
+        frames in it is never played"""
+        if complete and not self.playing:
+            if len(self.buffer):
+                self.play()
+            else:
+                logger.getChild("finish").error("the upload had no frames to play")
+        return {
+            "frames": len(self.buffer),
+            "playing": self.playing,
+            "seconds": round(self.elapsed(), 3),
+        }
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+
+# each connection can be sending one upload
+uploads: dict[socket.socket, SequenceUpload] = {}
+
+
+def forget_closed_uploads() -> None:
+    """drop uploads whose connection went away before they finished"""
+    for sock in [sock for sock in uploads if sock.fileno() == -1]:
+        logger.getChild("forget").warning(
+            f"an upload of {len(uploads[sock].buffer)} frames was never finished"
+        )
+        del uploads[sock]
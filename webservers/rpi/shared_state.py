@@ -0,0 +1,169 @@
+import dataclasses
+import threading
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+import config
+from frame_buffer import FrameBuffer
+from common.common_objects import all_standard_column_names
+from common.sequence_validation import SequenceReport
+
+
+@dataclass(frozen=True)
+class DisplaySettings:
+    """Everything the display reads every frame. It is never changed, a new one is made
+    and swapped in, so a frame always sees one consistent set of settings"""
+
+    fps: float
+    brightness: float
+    gamma: float
+    white_balance: tuple[float, float, float]
+    channel_limit: int
+    crossfade_frames: int
+    blend_mode: str
+    show_fps: bool
+    timed_playback: bool
+    speed: float
+
+    @classmethod
+    def from_config(cls) -> "DisplaySettings":
+        """the settings the pi boots with"""
+        return cls(
+            fps=float(config.fps),
+            brightness=float(config.brightness),
+            gamma=float(config.gamma),
+            white_balance=tuple(float(x) for x in config.white_balance),  # type: ignore
+            channel_limit=int(config.channel_limit),
+            crossfade_frames=int(config.crossfade_frames),
+            blend_mode=str(config.blend_mode),
+            show_fps=bool(config.show_fps),
+            timed_playback=bool(config.timed_playback),
+            speed=float(config.playback_speed),
+        )
+
+    def sequence_fps(self) -> float:
+        """how many frames of the sequence go by each second"""
+        return self.fps * self.speed
+
+    def push_fps(self) -> float:
+        """how often a frame is pushed to the leds. Played by time that is as fast as
+        the leds go and frames in between are interpolated, otherwise it is a frame of
+        the sequence each push"""
+        if self.timed_playback:
+            return float(config.max_push_fps) if self.sequence_fps() > 0 else 0.0
+        return self.sequence_fps()
+
+
+@dataclass(frozen=True)
+class SequenceChange:
+    """a new sequence for the display. frames is None when it still needs converting,
+    and a streamed upload has frames in a FrameBuffer and no dataframe. keep_position
+    is for the same sequence handed over again, it carries on from the same frame.
+    report is what was fixed when it was loaded, when it came from a file"""
+
+    dataframe: Optional[pd.DataFrame]
+    frames: Optional[np.ndarray | FrameBuffer]
+    crossfade_frames: int
+    blend_mode: str
+    keep_position: bool = False
+    report: Optional[SequenceReport] = None
+
+
+class SharedState:
+    """How the command, playlist and display threads hand things to each other.
+
+    The display only ever needs the latest sequence, so there is one slot instead of a
+    queue. The slot holds a (version, SequenceChange) tuple and the settings are a
+    frozen DisplaySettings, both are replaced in a single assignment so the display
+    reads them without taking a lock. Writers take write_lock only so two of them can
+    not hand out the same version. changed wakes the display when it is waiting for
+    the next frame."""
+
+    def __init__(self, settings: DisplaySettings) -> None:
+        self.write_lock = threading.Lock()
+        self.sequence_slot: tuple[int, Optional[SequenceChange]] = (0, None)
+        self.settings = settings
+        self.settings_version = 0
+        self.changed = threading.Event()
+
+    def publish_sequence(
+        self,
+        dataframe: Optional[pd.DataFrame],
+        frames: Optional[np.ndarray | FrameBuffer] = None,
+        crossfade_frames: Optional[int] = None,
+        blend_mode: Optional[str] = None,
+        keep_position: bool = False,
+        report: Optional[SequenceReport] = None,
+    ) -> int:
+        """show a new sequence. The fade defaults to the crossfade setting. One with no
+        frames is refused here, the display would have nothing to loop over"""
+        sequence = frames if frames is not None else dataframe
+        if sequence is None or len(sequence) == 0:
+            raise ValueError("a sequence needs at least one frame to be shown")
+        settings = self.settings
+        change = SequenceChange(
+            dataframe,
+            frames,
+            settings.crossfade_frames if crossfade_frames is None else crossfade_frames,
+            settings.blend_mode if blend_mode is None else blend_mode,
+            keep_position,
+            report,
+        )
+        with self.write_lock:
+            version = self.sequence_slot[0] + 1
+            self.sequence_slot = (version, change)
+        self.changed.set()
+        return version
+
+    def latest_sequence(self) -> tuple[int, Optional[SequenceChange]]:
+        return self.sequence_slot
+
+    @property
+    def sequence_version(self) -> int:
+        return self.sequence_slot[0]
+
+    def current_dataframe(self) -> Optional[pd.DataFrame]:
+        """the last sequence that was published, the one showing or about to be.
+        Sequences published as frames only get a dataframe made when one is asked for"""
+        change = self.sequence_slot[1]
+        if change is None:
+            return None
+        if change.dataframe is None and change.frames is not None:
+            frames = change.frames
+            if isinstance(frames, FrameBuffer):
+                frames = frames.view()
+            return pd.DataFrame(
+                frames.reshape(len(frames), -1),
+                columns=all_standard_column_names(frames.shape[1]),
+            )
+        return change.dataframe
+
+    def current_frames(self) -> Optional[np.ndarray]:
+        """the frames of the last sequence, if whoever published it converted them"""
+        change = self.sequence_slot[1]
+        if change is None:
+            return None
+        if isinstance(change.frames, FrameBuffer):
+            return change.frames.view()
+        return change.frames
+
+    def update_settings(self, **changes) -> DisplaySettings:
+        with self.write_lock:
+            settings = dataclasses.replace(self.settings, **changes)
+            self.settings = settings
+            self.settings_version += 1
+        self.changed.set()
+        return settings
+
+    def wait_for_change(self, timeout: Optional[float]) -> bool:
+        """sleep until something is published or the timeout runs out"""
+        woken = self.changed.wait(timeout)
+        if woken:
+            self.changed.clear()
+        return woken
+
+
+state = SharedState(DisplaySettings.from_config())
@@ -0,0 +1,350 @@
+"""Times every stage from a CSV file to frames going out to the leds, for every file in
+examples/, and saves the results as JSON so that runs on different commits can be compared.
+
+    python benchmark_pipeline.py                      # run everything, save the results
+    python benchmark_pipeline.py --quick              # fewer repeats, small files only
+    python benchmark_pipeline.py --compare old.json   # show how this run compares
+"""
+import argparse
+import json
+import logging
+import platform
+import socket
+import statistics
+import subprocess
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+from typing import Callable
+
+import os
+import sys
+
+# run the display path with the in memory strip
+os.environ.setdefault("LED_BACKEND", "simulated")
+
+# Add the root directory and the rpi directory to the Python path
+current_directory = os.path.dirname(os.path.abspath(__file__))
+webservers_directory = os.path.abspath(os.path.join(current_directory, ".."))
+repo_directory = os.path.abspath(os.path.join(webservers_directory, ".."))
+sys.path.append(webservers_directory)
+sys.path.append(os.path.join(webservers_directory, "rpi"))
+
+import numpy as np
+
+import config
+
+config.coordinates_file = os.path.join(repo_directory, "coords_2021.csv")
+
+import common.common_send_recv as common_send_recv
+from common.file_parser import read_from_csv, read_sequence_dataframe
+import commands
+import display
+from color_correction import color_correction
+from compositor import Compositor, FrameSource, blend_modes
+from frame_ring import FrameRing
+from layers import LayerStack, mask_layer
+from led_backends import SimulatedBackend, encode_frame, pack_frame
+from power_limiter import power_limiter
+from shared_state import state
+
+examples_directory = Path(repo_directory) / "examples"
+default_results_directory = Path(current_directory) / "benchmark_results"
+
+
+def time_it(func: Callable, repeat: int, number: int = 1) -> dict[str, float]:
+    """seconds per call of func, number calls at a time, repeat times"""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        samples.append((time.perf_counter() - start) / number)
+    return {
+        "min_s": min(samples),
+        "median_s": statistics.median(samples),
+        "mean_s": statistics.fmean(samples),
+        "calls": repeat * number,
+    }
+
+
+def bench_loading(file_path: Path, repeat: int) -> dict[str, dict]:
+    results = {}
+    results["read_sequence_dataframe"] = time_it(
+        lambda: read_sequence_dataframe(file_path), repeat
+    )
+    results["read_from_csv"] = time_it(lambda: read_from_csv(file_path), 1)
+
+    def load_with_handle_file():
+        commands.handle_file(value=str(file_path))
+
+    results["handle_file"] = time_it(load_with_handle_file, repeat)
+    return results
+
+
+def bench_frames(frames: np.ndarray, repeat: int) -> dict[str, dict]:
+    results = {}
+    led_num = frames.shape[1]
+    frame_count = len(frames)
+    frame = frames[frame_count // 2]
+    other = frames[0]
+
+    results["encode_frame"] = time_it(lambda: encode_frame(frame), repeat, 100)
+
+    compositor = Compositor(led_num, display.load_wipe_order())
+    for mode in blend_modes:
+        results[f"blend_{mode}"] = time_it(
+            lambda: compositor.blend(other, frame, 100, mode), repeat, 100
+        )
+
+    stack = LayerStack(led_num)
+    every_seventh_led = list(range(0, led_num, 7))
+    stack.set_layer(mask_layer("benchmark", led_num, every_seventh_led, [255, 0, 0]))
+    results["layers_apply"] = time_it(lambda: stack.apply(frame), repeat, 100)
+
+    color_correction.rebuild(state.update_settings(gamma=2.2))
+    results["color_correction"] = time_it(
+        lambda: color_correction.apply(frame), repeat, 100
+    )
+
+    source = FrameSource(frames)
+    results["power_precompute"] = time_it(
+        lambda: power_limiter.precompute(source), repeat
+    )
+
+    def limit_next_frame():
+        power_limiter.limit(source.next_frame(), source)
+
+    results["power_limit"] = time_it(limit_next_frame, repeat, 100)
+    color_correction.rebuild(state.update_settings(gamma=1.0))
+    return results
+
+
+def connected_tcp_pair() -> tuple[socket.socket, socket.socket]:
+    # send_message turns off Nagle, so this needs to be TCP rather than socketpair()
+    with socket.create_server(("127.0.0.1", 0)) as server:
+        left = socket.create_connection(server.getsockname())
+        right, _ = server.accept()
+    return left, right
+
+
+def bench_framing(payload_sizes: list[int], repeat: int) -> dict[str, dict]:
+    """send_message and receive_message over a local socket pair and back"""
+    results = {}
+    common_send_recv.verbose = False
+    left, right = connected_tcp_pair()
+    try:
+        for size in payload_sizes:
+            payload = bytes(size)
+
+            def round_trip():
+                sender = threading.Thread(
+                    target=common_send_recv.send_message, args=(left, payload)
+                )
+                sender.start()
+                received = common_send_recv.receive_message(right)
+                sender.join()
+                assert len(received) == size
+
+            results[f"round_trip_{size}b"] = time_it(round_trip, repeat)
+    finally:
+        left.close()
+        right.close()
+    return results
+
+
+def bench_push_loop(
+    file_path: Path, frame_count: int, push_time_per_led: float
+) -> dict[str, float]:
+    """run the real display loop against the simulated strip as fast as it can go"""
+    state.update_settings(fps=10_000)
+    backend = SimulatedBackend(
+        config.led_num, keep_frames=frame_count, push_time_per_led=push_time_per_led
+    )
+    state.publish_sequence(read_sequence_dataframe(file_path))
+    stop_event = threading.Event()
+    display_thread = threading.Thread(
+        target=display.show_data_on_leds, args=(stop_event, backend)
+    )
+    display_thread.start()
+    # let it change over to the file before measuring
+    while backend.show_count < 5:
+        time.sleep(0.01)
+    backend.frames.clear()
+    backend.show_times.clear()
+    while len(backend.show_times) < frame_count:
+        time.sleep(0.01)
+    stop_event.set()
+    display_thread.join()
+
+    intervals = backend.frame_intervals()
+    return {
+        "frames": int(len(intervals)),
+        "median_frame_s": float(np.median(intervals)),
+        "p99_frame_s": float(np.percentile(intervals, 99)),
+        "max_frame_s": float(intervals.max()),
+        "fps": float(1.0 / np.mean(intervals)),
+    }
+
+
+def bench_ring_allocations(frames: np.ndarray, frame_count: int) -> dict:
+    """Run frames through the frame ring and the simulated strip the same way
+    render_frames and output_frames do, and use tracemalloc to check that nothing the
+    size of a frame gets allocated once it is warmed up"""
+    led_num = frames.shape[1]
+    ring = FrameRing.create(config.frame_ring_slots, led_num)
+    backend = SimulatedBackend(led_num, keep_frames=0)
+    pack_work = np.zeros((led_num, 3), dtype=np.uint32)
+
+    def push(count: int) -> None:
+        for index in range(count):
+            slot = ring.writable_slot()
+            pack_frame(frames[index % len(frames)], slot, pack_work)
+            ring.commit()
+            backend.load_packed(ring.readable_slot())
+            ring.release()
+            backend.show()
+
+    try:
+        push(100)
+        tracemalloc.start()
+        before, _ = tracemalloc.get_traced_memory()
+        start = time.perf_counter()
+        push(frame_count)
+        elapsed = time.perf_counter() - start
+        after, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        ring.close()
+    frame_bytes = led_num * 4
+    return {
+        "frames": frame_count,
+        "frame_bytes": frame_bytes,
+        "net_bytes": after - before,
+        "peak_bytes": peak - before,
+        # the only things made per frame are the small view objects, never a frame
+        "allocation_free": peak - before < frame_bytes,
+        "median_frame_s": elapsed / frame_count,
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=repo_directory,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+def run_all(quick: bool) -> dict:
+    repeat = 3 if quick else 10
+    files = sorted(examples_directory.glob("*.csv"))
+    if quick:
+        files = [f for f in files if f.stat().st_size < 1_000_000]
+
+    results: dict = {
+        "commit": git_commit(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "quick": quick,
+        "files": {},
+    }
+    for file_path in files:
+        print(f"benchmarking {file_path.name}")
+        file_results = bench_loading(file_path, repeat)
+        dataframe = read_sequence_dataframe(file_path)
+        frames = display.convert_df_to_frames(dataframe)
+        file_results["convert_df_to_frames"] = time_it(
+            lambda: display.convert_df_to_frames(dataframe), repeat
+        )
+        file_results.update(bench_frames(frames, repeat))
+        file_results["frame_count"] = len(frames)
+        results["files"][file_path.name] = file_results
+
+    print("benchmarking socket framing")
+    results["framing"] = bench_framing([100, 100_000, 10_000_000], repeat)
+
+    print("benchmarking the push loop")
+    push_file = examples_directory / "rainbow-implosion.csv"
+    results["push_loop"] = bench_push_loop(push_file, 200 if quick else 1000, 0.0)
+    results["push_loop_ws2811_timing"] = bench_push_loop(push_file, 100, 30e-6)
+
+    print("checking the ring push path for allocations")
+    push_frames = display.convert_df_to_frames(read_sequence_dataframe(push_file))
+    results["ring_allocations"] = bench_ring_allocations(push_frames, 10_000)
+    allocations = results["ring_allocations"]
+    print(
+        f"{allocations['frames']} frames through the ring: "
+        f"{allocations['net_bytes']}b kept, {allocations['peak_bytes']}b peak, "
+        f"a frame is {allocations['frame_bytes']}b"
+    )
+    return results
+
+
+def flatten(results: dict, prefix: str = "") -> dict[str, float]:
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            if "median_s" in value:
+                flat[name] = value["median_s"]
+            else:
+                flat.update(flatten(value, f"{name}/"))
+        elif key in ("median_frame_s", "p99_frame_s"):
+            flat[name] = value
+    return flat
+
+
+def compare(current: dict, previous: dict, threshold: float = 1.2) -> None:
+    """print every timing that got slower (or faster) by more than the threshold"""
+    current_flat = flatten(current)
+    previous_flat = flatten(previous)
+    print(f"comparing {current['commit']} against {previous.get('commit')}")
+    for name, now in sorted(current_flat.items()):
+        before = previous_flat.get(name)
+        if not before:
+            continue
+        ratio = now / before
+        if ratio >= threshold:
+            print(f"SLOWER  {ratio:6.2f}x {name}: {before*1e3:.3f}ms -> {now*1e3:.3f}ms")
+        elif ratio <= 1 / threshold:
+            print(f"faster  {ratio:6.2f}x {name}: {before*1e3:.3f}ms -> {now*1e3:.3f}ms")
+
+
+def print_summary(results: dict) -> None:
+    for name, seconds in sorted(flatten(results).items()):
+        print(f"{seconds*1e3:12.4f}ms {name}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--quick", action="store_true")
+    parser.add_argument(
+        "--output", type=Path, default=None, help="defaults to benchmark_results/"
+    )
+    parser.add_argument("--compare", type=Path, default=None)
+    arguments = parser.parse_args()
+    # the debug logging would end up being what gets measured
+    logging.disable(logging.INFO)
+
+    results = run_all(arguments.quick)
+    print_summary(results)
+
+    output = arguments.output
+    if output is None:
+        default_results_directory.mkdir(exist_ok=True)
+        output = default_results_directory / f"{results['commit']}.json"
+    output.write_text(json.dumps(results, indent=2))
+    print(f"saved the results to {output}")
+
+    if arguments.compare is not None:
+        compare(results, json.loads(arguments.compare.read_text()))
@@ -0,0 +1,187 @@
+"""Several pis on this machine, for trying the cluster coordinator without the
+hardware. Each controller is its own process running the networking, command and
+display threads of rpi/main.py with the simulated strip on a port of its own. A
+sequence whose red is the frame number is played across all of them, the beacons'
+skew reports are printed and afterwards the frames each one really showed are
+compared to measure the skew independently of the beacons.
+
+    python cluster_standin.py                              # 3 controllers for 10s
+    python cluster_standin.py --controllers 4 --seconds 20 --frame-mode
+"""
+import argparse
+import multiprocessing
+import socket
+import threading
+import time
+
+import numpy as np
+
+import os
+import sys
+
+# Add the root directory and the rpi directory to the Python path
+current_directory = os.path.dirname(os.path.abspath(__file__))
+webservers_directory = os.path.abspath(os.path.join(current_directory, ".."))
+sys.path.append(webservers_directory)
+sys.path.append(os.path.join(webservers_directory, "rpi"))
+sys.path.append(os.path.join(webservers_directory, "external"))
+
+
+def run_controller(port: int, led_num: int, keep_frames: int, stop, results) -> None:
+    """one stand in pi, until stop is set. What it showed and when is put on results"""
+    os.environ["LED_BACKEND"] = "simulated"
+    import config
+
+    # before anything else is imported, since they size themselves from config
+    config.host = "127.0.0.1"
+    config.rx_port = port
+    config.led_num = led_num
+    config.display_process = False
+
+    import queue
+
+    from command_queue import CommandQueue
+    from commands import handle_commands
+    from display import show_data_on_leds
+    from led_backends import SimulatedBackend
+    from networking import handle_networking
+
+    stop_event = threading.Event()
+    command_queue = CommandQueue()
+    send_queue: queue.Queue = queue.Queue()
+    pixels = SimulatedBackend(led_num, keep_frames=keep_frames)
+    threads = [
+        threading.Thread(
+            target=handle_networking,
+            args=(config.host, port, stop_event, command_queue, send_queue),
+        ),
+        threading.Thread(
+            target=handle_commands, args=(command_queue, send_queue, stop_event)
+        ),
+        threading.Thread(target=show_data_on_leds, args=(stop_event, pixels)),
+    ]
+    for thread in threads:
+        thread.start()
+    stop.wait()
+    stop_event.set()
+    for thread in threads:
+        thread.join()
+    reds = [int(frame[0, 0]) for frame in pixels.frames]
+    results.put((port, list(pixels.show_times), reds))
+
+
+def wait_for_port(port: int, timeout: float = 20.0) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def measured_skew(
+    shown: dict, frame_count: int, start: float, stop: float
+) -> tuple[float, float]:
+    """Frames between the furthest ahead and behind controllers over start to stop
+    (perf_counter times, which every process on the machine shares), from the red of
+    the frame each one had on its leds. The median and the worst of it, the worst
+    includes the frame blended from the last one back to the first"""
+    times = np.linspace(start, stop, 500)
+    positions = []
+    for show_times, reds in shown.values():
+        showing = np.searchsorted(np.asarray(show_times), times, side="right") - 1
+        positions.append(np.asarray(reds, dtype=np.float64)[showing])
+    # the sequence loops, so each is compared to the first the shortest way round
+    ahead = (np.array(positions) - positions[0] + frame_count / 2) % frame_count
+    ahead -= frame_count / 2
+    spread = ahead.max(axis=0) - ahead.min(axis=0)
+    return float(np.median(spread)), float(spread.max())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--controllers", type=int, default=3)
+    parser.add_argument("--leds", type=int, default=100, help="on each controller")
+    parser.add_argument("--port", type=int, default=23450, help="of the first one")
+    parser.add_argument("--fps", type=float, default=20.0)
+    parser.add_argument("--frames", type=int, default=200, help="at most 256")
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--interval", type=float, default=1.0, help="between beacons")
+    parser.add_argument(
+        "--frame-mode", action="store_true", help="a frame per push, not timed"
+    )
+    args = parser.parse_args()
+
+    from cluster import Cluster, Controller
+
+    context = multiprocessing.get_context("spawn")
+    stop = context.Event()
+    results = context.Queue()
+    ports = [args.port + number for number in range(args.controllers)]
+    keep_frames = int((args.seconds + 10) * 120)
+    processes = [
+        context.Process(
+            target=run_controller,
+            args=(port, args.leds, keep_frames, stop, results),
+            name=f"standin_{port}",
+        )
+        for port in ports
+    ]
+    for process in processes:
+        process.start()
+    try:
+        for port in ports:
+            wait_for_port(port)
+        cluster = Cluster(
+            [
+                Controller(
+                    f"standin_{number}",
+                    "127.0.0.1",
+                    port,
+                    led_start=number * args.leds,
+                    led_count=args.leds,
+                )
+                for number, port in enumerate(ports)
+            ]
+        )
+
+        frames = np.zeros((args.frames, cluster.led_num, 3), dtype=np.uint8)
+        frames[:, :, 0] = np.arange(args.frames, dtype=np.uint8)[:, None]
+        cluster.broadcast("fps", args.fps)
+        cluster.broadcast("playback", {"timed": not args.frame_mode, "speed": 1.0})
+        cluster.play(frames, args.fps)
+        synced_from = time.perf_counter() + 1.0
+
+        finish = time.monotonic() + args.seconds
+        while time.monotonic() < finish:
+            time.sleep(args.interval)
+            report = cluster.beacon()
+            skews = ", ".join(
+                f"{c['name']} {c['skew_frames']:+.3f}"
+                if c["skew_frames"] is not None
+                else f"{c['name']} -"
+                for c in report["controllers"]
+            )
+            print(f"beacon skew {report['skew_frames']} frames ({skews})")
+        synced_until = time.perf_counter() - 0.5
+    finally:
+        stop.set()
+        shown = {}
+        for _ in processes:
+            port, show_times, reds = results.get(timeout=30)
+            shown[port] = (show_times, reds)
+        for process in processes:
+            process.join(timeout=10)
+
+    median, worst = measured_skew(shown, args.frames, synced_from, synced_until)
+    print(
+        f"measured skew {median:.3f} frames ({median / args.fps * 1000:.1f}ms), "
+        f"at most {worst:.3f}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Frames going from render_frames through the frame ring to a strip should not leave
+anything behind, or the display would slowly use up the pi's memory.
+
+    python -m pytest test_frame_ring.py
+"""
+import tracemalloc
+
+import os
+import sys
+
+os.environ.setdefault("LED_BACKEND", "simulated")
+
+# Add the root directory and the rpi directory to the Python path
+current_directory = os.path.dirname(os.path.abspath(__file__))
+webservers_directory = os.path.abspath(os.path.join(current_directory, ".."))
+sys.path.append(webservers_directory)
+sys.path.append(os.path.join(webservers_directory, "rpi"))
+
+import numpy as np
+import pytest
+
+import config
+from color_correction import color_correction
+from compositor import FrameSource, PlaybackClock
+from frame_ring import FrameRing
+from layers import LayerStack, mask_layer
+from led_backends import SimulatedBackend, pack_frame
+from power_limiter import power_limiter
+from shared_state import state
+
+
+@pytest.fixture
+def corrected():
+    """gamma and a power budget the frames go over, so every step does its work"""
+    budget = config.power_budget_ma
+    config.power_budget_ma = 2_000
+    power_limiter.settings_changed()
+    color_correction.rebuild(state.update_settings(gamma=2.2))
+    yield
+    config.power_budget_ma = budget
+    power_limiter.settings_changed()
+    color_correction.rebuild(state.update_settings(gamma=1.0))
+
+
+@pytest.mark.parametrize("timed", [False, True])
+def test_render_and_output_do_not_grow(corrected, timed: bool) -> None:
+    led_num = config.led_num
+    frames = np.random.default_rng(0).integers(0, 256, (50, led_num, 3), np.uint8)
+    clock = PlaybackClock()
+    clock.timed = timed
+    source = FrameSource(frames, clock)
+    power_limiter.precompute(source)
+    layer_stack = LayerStack(led_num)
+    every_seventh_led = list(range(0, led_num, 7))
+    layer_stack.set_layer(mask_layer("test", led_num, every_seventh_led, [255, 0, 0]))
+    ring = FrameRing.create(config.frame_ring_slots, led_num)
+    strip = SimulatedBackend(led_num, keep_frames=0)
+    pack_work = np.zeros((led_num, 3), dtype=np.uint32)
+
+    def push(count: int) -> None:
+        """the render step of render_frames then the output step of output_frames"""
+        for _ in range(count):
+            clock.tick(clock.due or 0.0, 60.0, 20.0)
+            frame = layer_stack.apply(source.next_frame())
+            frame = power_limiter.limit(color_correction.apply(frame))
+            pack_frame(frame, ring.writable_slot(), pack_work)
+            ring.commit()
+            strip.load_packed(ring.readable_slot())
+            ring.release()
+            strip.show()
+
+    try:
+        push(200)
+        tracemalloc.start()
+        push(200)
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        push(2000)
+        after, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    finally:
+        ring.close()
+    assert strip.show_count == 2400
+    # a frame a time left behind would be 2000 of them, the few bytes allowed for
+    # are the interpreter's own bookkeeping
+    assert after - before < led_num * 4
+    # and nothing frame sized is made and dropped again on the way either
+    assert peak - before < led_num * 4